@@ -0,0 +1,362 @@
+import json
+import os
+import threading
+import time
+from datetime import datetime
+from typing import Optional
+
+from cryptography.fernet import InvalidToken
+
+from encrypt import Encryptor
+from stats import stats
+
+encryptor = Encryptor()
+
+AUDIT_PATH = os.environ.get("SFS_AUDIT_PATH", "json/audit")
+# Bytes a segment grows to before the next one is started
+AUDIT_SEGMENT_BYTES = int(os.environ.get("SFS_AUDIT_SEGMENT_BYTES", 1024 * 1024))
+# Seconds events wait in memory before they're flushed
+AUDIT_FLUSH = float(os.environ.get("SFS_AUDIT_FLUSH", 1.0))
+# Buffered events that trigger an early flush
+AUDIT_BUFFER = int(os.environ.get("SFS_AUDIT_BUFFER", 1024))
+
+SEGMENT_SUFFIX = ".log"
+INDEX_SUFFIX = ".idx"
+UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+
+
+def parseTime(text: str) -> float:
+    "Parses an ISO date or a duration ago like 30s, 10m, 2h or 7d"
+    if text[-1:] in UNITS and text[:-1].isdigit():
+        return time.time() - int(text[:-1]) * UNITS[text[-1]]
+
+    return datetime.fromisoformat(text).timestamp()
+
+
+def formatEvent(event: dict) -> str:
+    when = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(event["time"]))
+    return (
+        f"{when}  {event['user']:<12}{event['op']:<8}{event['result']:<9}"
+        f"{event['ms']:>9.2f} ms  {event['path'] or '/'}"
+    )
+
+
+def newIndex() -> dict:
+    return {"events": 0, "bytes": 0, "first": None, "last": None, "users": set(), "paths": set(), "ops": set()}
+
+
+def indexEvents(index: dict, events: list[dict]):
+    "Adds a batch of events to the summary of a segment"
+    index["events"] += len(events)
+    index["first"] = index["first"] or events[0]["time"]
+    index["last"] = events[-1]["time"]
+    index["users"].update(event["user"] for event in events)
+    index["paths"].update(event["path"] for event in events)
+    index["ops"].update(event["op"] for event in events)
+
+
+def pathMatches(path: str, prefix: Optional[str]) -> bool:
+    return not prefix or path == prefix or path.startswith(prefix + "/")
+
+
+class AuditLog:
+    """Append-only encrypted record of who accessed which node, and how.
+
+    record() only appends to an in-memory buffer, so commands never wait for
+    the disk. A background thread flushes the buffer every `interval` seconds,
+    or once maxBuffer events piled up, as one encrypted line appended to the
+    current segment. Each segment has a small encrypted index (time range,
+    users, paths and operations), a query decrypts only the segments whose
+    index can match. Segments are never rewritten, a full one is left as is
+    and the next one started.
+    """
+
+    def __init__(
+        self,
+        path: str = AUDIT_PATH,
+        segmentBytes: int = AUDIT_SEGMENT_BYTES,
+        interval: float = AUDIT_FLUSH,
+        maxBuffer: int = AUDIT_BUFFER,
+    ) -> None:
+        self.path = path
+        self.segmentBytes = segmentBytes
+        self.interval = interval
+        self.maxBuffer = maxBuffer
+
+        self.buffer: list[dict] = []
+        self.segment: Optional[int] = None  # number of the open segment
+        self.index: Optional[dict] = None  # of the open segment
+        self.indexes: dict[int, dict] = {}  # of full segments, which never change
+
+        self.lock = threading.Lock()  # the buffer
+        self.writeLock = threading.RLock()  # segments and indexes
+
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def __repr__(self) -> str:
+        return f"AuditLog(path={self.path}, segment={self.segment}, buffered={len(self.buffer)})"
+
+    def segmentPath(self, number: int, suffix: str = SEGMENT_SUFFIX) -> str:
+        return os.path.join(self.path, f"{number:06d}{suffix}")
+
+    def segments(self) -> list[int]:
+        try:
+            names = os.listdir(self.path)
+        except FileNotFoundError:
+            return []
+
+        return sorted(int(name[: -len(SEGMENT_SUFFIX)]) for name in names if name.endswith(SEGMENT_SUFFIX))
+
+    def record(self, user: str, op: str, path: str, result: str, seconds: float):
+        "Buffers an access event, flushed in the background"
+        event = {
+            "time": time.time(),
+            "user": user,
+            "op": op,
+            "path": path,
+            "result": result,
+            "ms": seconds * 1000,
+        }
+
+        with self.lock:
+            self.buffer.append(event)
+            full = len(self.buffer) >= self.maxBuffer
+
+        stats.incr("audit.events")
+        if full:
+            self._wake.set()
+
+    def open(self):
+        "Picks up the last segment of a previous run, or starts the first one"
+        os.makedirs(self.path, exist_ok=True)
+
+        if not (numbers := self.segments()):
+            self.segment, self.index = 1, newIndex()
+            return
+
+        last = numbers[-1]
+        index = self.readIndex(last)
+
+        size = os.path.getsize(self.segmentPath(last))
+        torn = False
+        if size:
+            with open(self.segmentPath(last), "rb") as f:
+                f.seek(-1, os.SEEK_END)
+                torn = f.read(1) != b"\n"
+
+        if torn or size >= self.segmentBytes:
+            # never append behind a half written line
+            self.indexes[last] = index
+            self.segment, self.index = last + 1, newIndex()
+        else:
+            self.segment, self.index = last, index
+
+    @stats.timed("audit.flush")
+    def flush(self) -> int:
+        "Appends the buffered events to the open segment, returns their number"
+        with self.lock:
+            events, self.buffer = self.buffer, []
+
+        if not events:
+            return 0
+
+        with self.writeLock:
+            if self.segment is None:
+                self.open()
+
+            line = encryptor.encrypt(json.dumps(events).encode()) + b"\n"
+            try:
+                with open(self.segmentPath(self.segment), "ab") as f:
+                    f.write(line)
+                    f.flush()
+                    os.fsync(f.fileno())
+            except OSError:
+                # kept for the next flush, ahead of newer events
+                with self.lock:
+                    self.buffer[:0] = events
+                raise
+
+            indexEvents(self.index, events)
+            self.index["bytes"] += len(line)
+            # not synced, a lost index is rebuilt from its segment
+            self.writeIndex(self.segment, self.index)
+
+            if self.index["bytes"] >= self.segmentBytes:
+                self.indexes[self.segment] = self.index
+                self.segment, self.index = self.segment + 1, newIndex()
+
+        return len(events)
+
+    def writeIndex(self, number: int, index: dict):
+        data = dict(index, **{key: sorted(index[key]) for key in ["users", "paths", "ops"]})
+        path = self.segmentPath(number, INDEX_SUFFIX)
+
+        with open(path + ".tmp", "wb") as f:
+            f.write(encryptor.encrypt(json.dumps(data).encode()))
+
+        os.replace(path + ".tmp", path)
+
+    def readIndex(self, number: int) -> dict:
+        "Loads the index of a segment, rebuilding it if it's missing or stale"
+        try:
+            with open(self.segmentPath(number, INDEX_SUFFIX), "rb") as f:
+                data = json.loads(encryptor.decrypt(f.read()))
+
+            index = dict(data, **{key: set(data[key]) for key in ["users", "paths", "ops"]})
+            if index["bytes"] == os.path.getsize(self.segmentPath(number)):
+                return index
+        except (FileNotFoundError, InvalidToken, ValueError, KeyError):
+            pass
+
+        stats.incr("audit.indexRebuilt")
+        index = newIndex()
+        for line in self.lines(number):
+            indexEvents(index, json.loads(encryptor.decrypt(line)))
+            index["bytes"] += len(line) + 1
+
+        self.writeIndex(number, index)
+        return index
+
+    def lines(self, number: int) -> list[bytes]:
+        "Returns the complete lines of a segment, dropping a torn last one"
+        with open(self.segmentPath(number), "rb") as f:
+            lines = f.read().split(b"\n")
+
+        # the part after the last newline is empty or torn
+        return lines[:-1]
+
+    def events(self, number: int):
+        "Yields the events of a segment"
+        stats.incr("audit.segmentsRead")
+
+        for line in self.lines(number):
+            yield from json.loads(encryptor.decrypt(line))
+
+    def query(
+        self,
+        user: Optional[str] = None,
+        path: Optional[str] = None,
+        op: Optional[str] = None,
+        since: Optional[float] = None,
+        until: Optional[float] = None,
+        limit: Optional[int] = None,
+    ) -> list[dict]:
+        "Returns the matching events, oldest first, the newest limit ones if given"
+        self.flush()
+
+        def matches(event: dict) -> bool:
+            return (
+                (user is None or event["user"] == user)
+                and (op is None or event["op"] == op)
+                and pathMatches(event["path"], path)
+                and (since is None or event["time"] >= since)
+                and (until is None or event["time"] <= until)
+            )
+
+        found = []
+        with self.writeLock:
+            if self.segment is None:
+                self.open()
+
+            for number in self.segments():
+                if number == self.segment:
+                    index = self.index
+                elif (index := self.indexes.get(number)) is None:
+                    index = self.indexes[number] = self.readIndex(number)
+
+                if not (
+                    index["events"]
+                    and (user is None or user in index["users"])
+                    and (op is None or op in index["ops"])
+                    and any(pathMatches(p, path) for p in index["paths"])
+                    and (since is None or index["last"] >= since)
+                    and (until is None or index["first"] <= until)
+                ):
+                    stats.incr("audit.segmentsSkipped")
+                    continue
+
+                found.extend(event for event in self.events(number) if matches(event))
+
+        return found[-limit:] if limit else found
+
+    def rotateKeys(self) -> int:
+        "Re-encrypts every segment and index under the primary key, returns the files changed"
+        self.flush()
+
+        changed = 0
+        with self.writeLock:
+            for number in self.segments():
+                lines = self.lines(number)
+                rotated = [encryptor.rotateToken(line) for line in lines]
+
+                if any(token is not None for token in rotated):
+                    path = self.segmentPath(number)
+                    with open(path + ".tmp", "wb") as f:
+                        for line, token in zip(lines, rotated):
+                            f.write((token or line) + b"\n")
+                        f.flush()
+                        os.fsync(f.fileno())
+
+                    os.replace(path + ".tmp", path)
+                    changed += 1
+
+                # line lengths changed, the index is rewritten either way
+                index = self.index if number == self.segment else self.readIndex(number)
+                index["bytes"] = os.path.getsize(self.segmentPath(number))
+                self.writeIndex(number, index)
+
+        return changed
+
+    def start(self):
+        "Flushes in the background every interval"
+        if self._thread is None:
+            self._thread = threading.Thread(target=self.run, daemon=True)
+            self._thread.start()
+
+    def run(self):
+        while not self._stop.is_set():
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except OSError:
+                stats.incr("audit.flushErrors")
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout=1)
+            self._thread = None
+
+        self.flush()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(prog="audit")
+    parser.add_argument("--user", type=str)
+    parser.add_argument("--path", type=str)
+    parser.add_argument("--op", type=str)
+    parser.add_argument("--since", type=str, help="ISO date or 30s, 10m, 2h, 7d ago")
+    parser.add_argument("--until", type=str)
+    parser.add_argument("--limit", type=int, default=0)
+    parser.add_argument("--json", action="store_true")
+    args = parser.parse_args()
+
+    events = AuditLog().query(
+        user=args.user,
+        path=args.path,
+        op=args.op,
+        since=args.since and parseTime(args.since),
+        until=args.until and parseTime(args.until),
+        limit=args.limit,
+    )
+
+    if args.json:
+        print(json.dumps(events, indent=2))
+    else:
+        print(*map(formatEvent, events), sep="\n")
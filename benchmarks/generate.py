@@ -0,0 +1,182 @@
+"""Generates a synthetic files/ tree with matching permissions and users.
+
+The workspace is self contained (its own fernet.key, files/ and json/), the
+repo modules resolve those relative to the working directory, so callers
+chdir into the workspace before importing them. Use workspace() for that.
+"""
+
+import json
+import os
+import random
+import sys
+from contextlib import contextmanager
+
+REPO_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PASSWORD = "benchmark"
+
+
+@contextmanager
+def workspace(path: str):
+    "Runs the block from inside the workspace with the repo importable"
+    if REPO_PATH not in sys.path:
+        sys.path.insert(0, REPO_PATH)
+
+    previous = os.getcwd()
+    os.chdir(path)
+    try:
+        yield
+    finally:
+        os.chdir(previous)
+
+
+def initWorkspace(path: str):
+    "Creates an empty workspace with a fresh key"
+    from cryptography.fernet import Fernet
+
+    os.makedirs(os.path.join(path, "files"), exist_ok=True)
+    os.makedirs(os.path.join(path, "json"), exist_ok=True)
+
+    with open(os.path.join(path, "fernet.key"), "w") as f:
+        f.write(Fernet.generate_key().decode())
+
+
+def generate(
+    path: str,
+    depth: int = 3,
+    fanout: int = 3,
+    filesPerDir: int = 3,
+    fileSize: int = 1024,
+    users: int = 4,
+    groups: int = 2,
+    bcryptRounds: int = 12,
+    seed: int = 0,
+) -> dict:
+    """Builds a workspace with one home directory per user.
+
+    Every home holds a tree `depth` levels deep with `fanout` sub directories
+    and `filesPerDir` files of `fileSize` bytes per directory. Users are spread
+    round robin over `groups` groups and all share the PASSWORD password.
+    """
+
+    import bcrypt
+
+    initWorkspace(path)
+    rng = random.Random(seed)
+
+    with workspace(path):
+        from encrypt import Encryptor
+
+        encryptor = Encryptor()
+        encryptor.loadKeys()
+
+        hashedPass = bcrypt.hashpw(PASSWORD.encode(), bcrypt.gensalt(bcryptRounds)).decode()
+        groupNames = [f"group{i}" for i in range(groups)]
+        userNames = [f"user{i}" for i in range(users)]
+
+        userData = [{"name": "admin", "password": hashedPass, "joinedGroups": groupNames}]
+        userData.extend(
+            {
+                "name": name,
+                "password": hashedPass,
+                "joinedGroups": [groupNames[i % groups]] if groups else [],
+            }
+            for i, name in enumerate(userNames)
+        )
+
+        def node(name, owner, isShared=False):
+            allowedUsers = [{"name": owner, "isRead": True, "isWrite": True}]
+            allowedGroups = []
+
+            if isShared and groups:
+                group = groupNames[userNames.index(owner) % groups]
+                allowedGroups.append({"name": group, "isRead": True, "isWrite": False})
+
+            return {
+                "name": name,
+                "owner": owner,
+                "allowedUsers": allowedUsers,
+                "allowedGroups": allowedGroups,
+            }
+
+        nodes = [node("", "admin")]
+        fileCount = 0
+
+        def build(name, encryptedPath, owner, level):
+            nonlocal fileCount
+
+            for i in range(filesPerDir):
+                fileName = f"{name}/file{i}.txt"
+                contents = "".join(rng.choices("abcdefghijklmnopqrstuvwxyz ", k=fileSize))
+
+                with open(os.path.join(encryptedPath, encryptor.encryptString(f"file{i}.txt")), "wb") as f:
+                    f.write(encryptor.encryptString(contents).encode())
+
+                nodes.append(node(fileName, owner, isShared=i == 0))
+                fileCount += 1
+
+            if level == depth:
+                return
+
+            for i in range(fanout):
+                dirName = f"{name}/dir{i}"
+                dirPath = os.path.join(encryptedPath, encryptor.encryptString(f"dir{i}"))
+                os.mkdir(dirPath)
+
+                nodes.append(node(dirName, owner, isShared=i == 0))
+                build(dirName, dirPath, owner, level + 1)
+
+        for name in userNames:
+            homePath = os.path.join("files", encryptor.encryptString(name))
+            os.mkdir(homePath)
+
+            nodes.append(node(name, name))
+            build(name, homePath, name, 1)
+
+        encryptor.encryptJson(nodes, "json/permissions.json")
+        encryptor.encryptJson(userData, "json/users.json")
+
+        from graph import Graph
+
+        # the first load builds the usage rollups and writes them back
+        Graph("json/encrypted_permissions.json")
+
+    return {
+        "depth": depth,
+        "fanout": fanout,
+        "filesPerDir": filesPerDir,
+        "fileSize": fileSize,
+        "users": users,
+        "groups": groups,
+        "nodes": len(nodes),
+        "files": fileCount,
+        "deepestFile": f"user0{'/dir0' * (depth - 1)}/file0.txt" if users else None,
+    }
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(prog="generate")
+    parser.add_argument("path")
+    parser.add_argument("--depth", type=int, default=3)
+    parser.add_argument("--fanout", type=int, default=3)
+    parser.add_argument("--files-per-dir", type=int, default=3)
+    parser.add_argument("--file-size", type=int, default=1024)
+    parser.add_argument("--users", type=int, default=4)
+    parser.add_argument("--groups", type=int, default=2)
+    parser.add_argument("--bcrypt-rounds", type=int, default=12)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    summary = generate(
+        args.path,
+        depth=args.depth,
+        fanout=args.fanout,
+        filesPerDir=args.files_per_dir,
+        fileSize=args.file_size,
+        users=args.users,
+        groups=args.groups,
+        bcryptRounds=args.bcrypt_rounds,
+        seed=args.seed,
+    )
+    print(json.dumps(summary, indent=2))
@@ -0,0 +1,119 @@
+"""Measures the memory held per graph node.
+
+Compares the slotted, packed-ACL Node with the previous representation
+(a __dict__ per Node and per Permission, a list of Permission objects per
+ACL) on the same node data, and checks both dump to the same JSON.
+
+    python -m benchmarks.memory --nodes 100000
+"""
+
+import gc
+import json
+import shutil
+import tempfile
+import tracemalloc
+
+from benchmarks.generate import initWorkspace, workspace
+
+
+class LegacyPermission:
+    def __init__(self, name, isRead, isWrite) -> None:
+        self.name = name
+        self.isRead = isRead
+        self.isWrite = isWrite
+
+    def dump(self) -> dict:
+        return {"name": self.name, "isRead": self.isRead, "isWrite": self.isWrite}
+
+
+class LegacyNode:
+    def __init__(self, name, owner, allowedUsers=[], allowedGroups=[]) -> None:
+        self.name = name
+        self.owner = owner
+        self.allowedUsers = [LegacyPermission(**user) for user in allowedUsers]
+        self.allowedGroups = [LegacyPermission(**group) for group in allowedGroups]
+
+    def dump(self) -> dict:
+        return {
+            "name": self.name,
+            "owner": self.owner,
+            "allowedUsers": [p.dump() for p in self.allowedUsers],
+            "allowedGroups": [p.dump() for p in self.allowedGroups],
+        }
+
+
+def nodeData(count: int, users: int = 100, groups: int = 10) -> str:
+    "Permissions JSON shaped like a real tree, owner plus shared entries per node"
+    data = []
+    for i in range(count):
+        owner = f"user{i % users}"
+        data.append(
+            {
+                "name": f"{owner}/dir{i // 10}/file{i}.txt",
+                "owner": owner,
+                "allowedUsers": [
+                    {"name": owner, "isRead": True, "isWrite": True},
+                    {"name": "all", "isRead": True, "isWrite": False},
+                ],
+                "allowedGroups": [
+                    {"name": f"group{i % groups}", "isRead": True, "isWrite": False}
+                ],
+            }
+        )
+
+    return json.dumps(data)
+
+
+def bytesPerNode(cls, text: str) -> float:
+    "Traced bytes retained per node when loading the JSON like Graph does"
+    gc.collect()
+    tracemalloc.start()
+    before, _ = tracemalloc.get_traced_memory()
+
+    nodes = {node["name"]: cls(**node) for node in json.loads(text)}
+
+    gc.collect()
+    after, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return (after - before) / len(nodes)
+
+
+def measure(count: int) -> dict:
+    "Needs to run inside a workspace, graph imports the Encryptor"
+    from graph import Node
+
+    text = nodeData(count)
+    legacy = bytesPerNode(LegacyNode, text)
+    current = bytesPerNode(Node, text)
+
+    def dump(node: Node) -> dict:
+        out = node.dump()
+        del out["usage"]  # rollups, which the old format did not have
+        return out
+
+    sample = json.loads(text)[:1000]
+    assert json.dumps([LegacyNode(**n).dump() for n in sample]) == json.dumps(
+        [dump(Node(**n)) for n in sample]
+    ), "dump() output changed"
+
+    return {"nodes": count, "legacyBytesPerNode": legacy, "bytesPerNode": current}
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(prog="benchmarks.memory")
+    parser.add_argument("--nodes", type=int, default=100_000)
+    args = parser.parse_args()
+
+    path = tempfile.mkdtemp(prefix="sfs-bench-")
+    try:
+        initWorkspace(path)
+        with workspace(path):
+            result = measure(args.nodes)
+    finally:
+        shutil.rmtree(path)
+
+    print(f"before: {result['legacyBytesPerNode']:.1f} bytes/node")
+    print(f"after:  {result['bytesPerNode']:.1f} bytes/node")
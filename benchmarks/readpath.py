@@ -0,0 +1,116 @@
+"""Compares peak memory and throughput of reading one large file.
+
+"whole" is the read path before chunking: the file is a single token, read,
+decoded to str, re-encoded and decrypted in one piece. "chunked" streams the
+chunked format through fileio.readChunks from a memory map. Each mode runs in
+its own interpreter so the peak RSS of one doesn't hide the other.
+
+    python -m benchmarks.readpath --size 64M
+"""
+
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks.generate import REPO_PATH, initWorkspace, workspace
+from util import formatSize, parseSize
+
+MODES = ["whole", "chunked"]
+
+
+def peakRss() -> int:
+    "Peak resident set size of this process in bytes"
+    # ru_maxrss survives exec on Linux, it would report the parent's peak
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except FileNotFoundError:
+        pass
+
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == "darwin" else rss * 1024
+
+
+def child(mode: str):
+    "Reads the benchmark file once, run inside the workspace"
+    import fileio
+    from encrypt import Encryptor
+
+    encryptor = Encryptor()
+    before = peakRss()
+    start = time.perf_counter()
+
+    if mode == "whole":
+        with open(os.path.join(fileio.FILE_PATH, fileio.findPath("whole")), "rb") as f:
+            size = len(encryptor.decryptString(f.read().decode()))
+    else:
+        size = sum(len(chunk) for chunk in fileio.readChunks("chunked"))
+
+    print(
+        json.dumps(
+            {"size": size, "seconds": time.perf_counter() - start, "peak": peakRss() - before}
+        )
+    )
+
+
+def run(path: str, size: int) -> dict:
+    with workspace(path):
+        import fileio
+        from encrypt import Encryptor
+
+        contents = "x" * size
+
+        # the single token layout files had before chunking
+        with open(os.path.join(fileio.FILE_PATH, fileio.makePath("whole", isFile=True)), "wb") as f:
+            f.write(Encryptor().encryptString(contents).encode())
+
+        fileio.writeFile("chunked", contents)
+        del contents
+
+    env = dict(os.environ, PYTHONPATH=REPO_PATH)
+    results = {}
+    for mode in MODES:
+        out = subprocess.run(
+            [sys.executable, "-m", "benchmarks.readpath", "--child", mode],
+            cwd=path,
+            env=env,
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout
+        results[mode] = json.loads(out)
+
+    return results
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(prog="benchmarks.readpath")
+    parser.add_argument("--size", type=str, default="64M", help="plaintext bytes")
+    parser.add_argument("--child", choices=MODES, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(args.child)
+        sys.exit(0)
+
+    path = tempfile.mkdtemp(prefix="sfs-bench-")
+    try:
+        initWorkspace(path)
+        results = run(path, parseSize(args.size))
+    finally:
+        shutil.rmtree(path)
+
+    for mode, result in results.items():
+        print(
+            f"{mode:<8}{result['size'] / 1_000_000 / result['seconds']:>10.1f} MB/s"
+            f"   peak RSS +{formatSize(result['peak'])}"
+        )
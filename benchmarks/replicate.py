@@ -0,0 +1,90 @@
+"""Compares shipping changes incrementally with copying the whole tree.
+
+Generates a tree, brings a standby up to date, then rewrites a fraction of
+the files and reports what a full copy (what rsync of files/ plus both
+metadata files amounts to) and the incremental ship send, and how long the
+digest check of the standby takes.
+
+    python -m benchmarks.replicate --depth 4 --fanout 4 --changed 0.01
+"""
+
+import os
+import random
+import shutil
+import tempfile
+import time
+
+from benchmarks.generate import generate, workspace
+from util import formatSize
+
+
+def run(path: str, changed: float) -> dict:
+    with workspace(path):
+        import fileio
+        import replicate
+        from graph import Graph
+        from stats import stats
+        from user import Users
+        from writeback import WriteBack
+
+        graph = Graph("json/encrypted_permissions.json")
+        users = Users("json/encrypted_users.json")
+        writeback = WriteBack({"graph": graph, "users": users})
+        replicator = replicate.Replicator(
+            graph, users, writeback, replicate.LocalTransport(os.path.join(path, "standby"))
+        )
+        replicator.attach()
+
+        start = time.perf_counter()
+        replicator.ship()
+        full = {"seconds": time.perf_counter() - start, "bytes": stats.counters["replica.bytes"]}
+
+        files = [name for name, node in graph.nodes.items() if not node.isFolder and name]
+        rng = random.Random(0)
+        for name in rng.sample(files, max(1, int(len(files) * changed))):
+            graph.writeFile(name, "".join(rng.choices("abcdefghijklmnopqrstuvwxyz ", k=1024)))
+
+        before = stats.counters["replica.bytes"]
+        start = time.perf_counter()
+        replicator.ship()
+        incremental = {
+            "seconds": time.perf_counter() - start,
+            "bytes": stats.counters["replica.bytes"] - before,
+        }
+
+        start = time.perf_counter()
+        problems = replicator.verify()
+        verify = {"seconds": time.perf_counter() - start, "consistent": not problems}
+
+        fileio.changeListeners.clear()
+
+    return {"files": len(files), "full": full, "incremental": incremental, "verify": verify}
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(prog="benchmarks.replicate")
+    parser.add_argument("--depth", type=int, default=4)
+    parser.add_argument("--fanout", type=int, default=4)
+    parser.add_argument("--files-per-dir", type=int, default=3)
+    parser.add_argument("--changed", type=float, default=0.01, help="fraction of files rewritten")
+    args = parser.parse_args()
+
+    path = tempfile.mkdtemp(prefix="sfs-bench-")
+    try:
+        generate(path, depth=args.depth, fanout=args.fanout, filesPerDir=args.files_per_dir, bcryptRounds=4)
+        result = run(path, args.changed)
+    finally:
+        shutil.rmtree(path)
+
+    print(f"{result['files']} files")
+    for mode in ["full", "incremental"]:
+        print(
+            f"{mode:<12}{formatSize(result[mode]['bytes']):>10} shipped"
+            f"{result[mode]['seconds'] * 1000:>10.1f} ms"
+        )
+    print(
+        f"{'verify':<12}{'consistent' if result['verify']['consistent'] else 'differs':>10}"
+        f"{result['verify']['seconds'] * 1000:>18.1f} ms"
+    )
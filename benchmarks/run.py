@@ -0,0 +1,252 @@
+"""Times the hot paths against a synthetic tree and compares with a baseline.
+
+Usage, from the repo root:
+
+    python -m benchmarks.run --out results.json
+    python -m benchmarks.run --compare baseline.json
+
+Timings are in seconds (lower is better), throughputs in MB/s (higher is
+better). Compare mode exits with status 1 if any metric regressed by more
+than the threshold.
+"""
+
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks import memory
+from benchmarks.generate import PASSWORD, REPO_PATH, generate, workspace
+
+
+def measure(func, repeat: int, setup=None) -> dict:
+    "Times func repeat times, running the untimed setup before each run"
+    runs = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+
+        start = time.perf_counter()
+        func()
+        runs.append(time.perf_counter() - start)
+
+    return {
+        "unit": "s",
+        "median": statistics.median(runs),
+        "min": min(runs),
+        "mean": statistics.fmean(runs),
+        "runs": repeat,
+    }
+
+
+def throughput(func, size: int, repeat: int) -> dict:
+    "Times func repeat times, reporting MB/s for size bytes per call"
+    result = measure(func, repeat)
+    mb = size / 1_000_000
+
+    return {
+        "unit": "MB/s",
+        "median": mb / result["median"],
+        "min": mb / max(result["min"], 1e-9),
+        "mean": mb / result["mean"],
+        "runs": repeat,
+    }
+
+
+def startup(path: str, repeat: int) -> dict:
+    "Times a fresh interpreter importing the CLI, which loads all metadata"
+    env = dict(os.environ, PYTHONPATH=REPO_PATH)
+
+    return measure(
+        lambda: subprocess.run(
+            [sys.executable, "-c", "import main"], cwd=path, env=env, check=True
+        ),
+        repeat,
+    )
+
+
+def run(path: str, summary: dict, repeat: int, ioSize: int) -> dict:
+    results = {"startup": startup(path, max(1, repeat // 2))}
+
+    with workspace(path):
+        import bcrypt
+
+        import fileio
+        from audit import AuditLog
+        from encrypt import Encryptor
+        from graph import Graph
+        from prefetch import Prefetcher
+        from session import Sessions
+        from user import Users
+
+        Encryptor().loadKeys()
+
+        graph = Graph("json/encrypted_permissions.json")
+        users = Users("json/encrypted_users.json")
+        user = users.users["user0"]
+        deepest = summary["deepestFile"]
+        home = user.name
+
+        def login():
+            bcrypt.checkpw(PASSWORD.encode(), user.password.encode())
+            graph.checkPathIntegrity(home)
+
+        results["loadGraph"] = measure(lambda: Graph("json/encrypted_permissions.json"), repeat)
+        results["loadUsers"] = measure(lambda: Users("json/encrypted_users.json"), repeat)
+        results["login"] = measure(login, max(1, repeat // 2))
+
+        sessions = Sessions(users)
+        sessions.issue(user)
+        results["resume"] = measure(sessions.resume, repeat)
+        results["findPath"] = measure(lambda: fileio.findPath(deepest), repeat)
+        results["findPathCold"] = measure(
+            lambda: fileio.findPath(deepest), repeat, setup=fileio.clearCaches
+        )
+
+        # the first ls and cat after a cd, with cold caches and after prefetching
+        deepestDir = deepest.rpartition("/")[0]
+        prefetcher = Prefetcher(graph, enabled=True)
+
+        def firstCommands():
+            graph.listDirectory(deepestDir, user)
+            fileio.readFile(deepest)
+
+        def prefetch():
+            fileio.clearCaches()
+            prefetcher.warm(deepestDir, user)
+            prefetcher.idle.wait()
+
+        results["firstCommandsCold"] = measure(firstCommands, repeat, setup=fileio.clearCaches)
+        results["firstCommandsPrefetched"] = measure(firstCommands, repeat, setup=prefetch)
+        prefetcher.stop()
+        results["listDirectory"] = measure(lambda: graph.listDirectory(home, user), repeat)
+        results["isReadable"] = measure(
+            lambda: graph.getNodeFromPath(deepest).isReadable(users.users["user1"]), repeat
+        )
+        results["checkPathIntegrity"] = measure(lambda: graph.checkPathIntegrity(home), repeat)
+        results["graphDump"] = measure(graph.dump, repeat)
+
+        # what a command pays for auditing, a thousand events, the flush is off the command path
+        auditLog = AuditLog("json/audit")
+        results["auditRecord"] = measure(
+            lambda: [auditLog.record("user0", "cat", deepest, "ok", 0.001) for _ in range(1000)],
+            repeat,
+            setup=auditLog.flush,
+        )
+        results["auditQuery"] = measure(lambda: auditLog.query(user="user1"), repeat)
+
+        contents = "x" * ioSize
+        ioPath = f"{home}/benchmark.txt"
+        results["writeFile"] = throughput(lambda: fileio.writeFile(ioPath, contents), ioSize, repeat)
+        results["readFile"] = throughput(lambda: fileio.readFile(ioPath), ioSize, repeat)
+        fileio.removeFile(ioPath)
+
+        nodeBytes = memory.measure(summary["nodes"])["bytesPerNode"]
+        results["bytesPerNode"] = {
+            "unit": "B",
+            "median": nodeBytes,
+            "min": nodeBytes,
+            "mean": nodeBytes,
+            "runs": 1,
+        }
+
+    return results
+
+
+def compare(baseline: dict, current: dict, threshold: float) -> list[str]:
+    "Returns a line per regressed metric"
+    regressions = []
+
+    for name, result in current["results"].items():
+        if (base := baseline["results"].get(name)) is None:
+            continue
+
+        if result["unit"] == "MB/s":
+            change = base["median"] / result["median"] - 1
+        else:
+            change = result["median"] / base["median"] - 1
+
+        if change > threshold:
+            regressions.append(
+                f"{name}: {base['median']:.6g} -> {result['median']:.6g} {result['unit']} "
+                f"({change * 100:.1f}% worse)"
+            )
+
+    return regressions
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(prog="benchmarks.run")
+    parser.add_argument("--workspace", help="new or empty directory to generate in and keep, a temp dir by default")
+    parser.add_argument("--depth", type=int, default=3)
+    parser.add_argument("--fanout", type=int, default=3)
+    parser.add_argument("--files-per-dir", type=int, default=3)
+    parser.add_argument("--file-size", type=int, default=1024)
+    parser.add_argument("--users", type=int, default=4)
+    parser.add_argument("--groups", type=int, default=2)
+    parser.add_argument("--bcrypt-rounds", type=int, default=12)
+    parser.add_argument("--io-size", type=int, default=1_000_000, help="bytes per read/write")
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument("--out", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="baseline JSON to compare against")
+    parser.add_argument("--threshold", type=float, default=0.2, help="allowed slowdown, 0.2 is 20%%")
+    args = parser.parse_args()
+
+    if args.workspace and os.path.exists(args.workspace) and os.listdir(args.workspace):
+        # generate() writes a new key and tree, it would clobber what's there
+        parser.error(f"--workspace {args.workspace} isn't empty")
+
+    path = args.workspace or tempfile.mkdtemp(prefix="sfs-bench-")
+    params = {
+        "depth": args.depth,
+        "fanout": args.fanout,
+        "filesPerDir": args.files_per_dir,
+        "fileSize": args.file_size,
+        "users": args.users,
+        "groups": args.groups,
+        "bcryptRounds": args.bcrypt_rounds,
+    }
+
+    try:
+        summary = generate(path, **params)
+        results = {
+            "meta": {
+                **summary,
+                "ioSize": args.io_size,
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            },
+            "results": run(path, summary, args.repeat, args.io_size),
+        }
+    finally:
+        if not args.workspace:
+            shutil.rmtree(path)
+
+    for name, result in results["results"].items():
+        print(f"{name:<26}{result['median']:>14.6f} {result['unit']}")
+
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.compare:
+        with open(args.compare, "r") as f:
+            baseline = json.load(f)
+
+        if regressions := compare(baseline, results, args.threshold):
+            print("Regressions:", *regressions, sep="\n")
+            sys.exit(1)
+
+        print("No regressions")
+
+
+if __name__ == "__main__":
+    main()
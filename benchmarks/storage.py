@@ -0,0 +1,69 @@
+"""Measures blob throughput of the storage backends.
+
+Writes and reads the same blobs through the memory backend, a local root
+and a striped backend over the given roots. Put the roots on different
+devices to see striping scale:
+
+    python -m benchmarks.storage --roots /mnt/a/sfs /mnt/b/sfs --size 64M
+"""
+
+import os
+import shutil
+import tempfile
+
+from benchmarks.run import throughput
+from storage import LocalBackend, MemoryBackend, StripedBackend
+from util import parseSize
+
+
+def measure(backend, size: int, blobs: int, repeat: int) -> dict:
+    "Write and read MB/s for blobs of size bytes"
+    data = os.urandom(size)
+    paths = [f"blob{i}" for i in range(blobs)]
+
+    def write():
+        for path in paths:
+            backend.write(path, data)
+
+    def read():
+        for path in paths:
+            backend.read(path)
+
+    return {
+        "write": throughput(write, size * blobs, repeat)["median"],
+        "read": throughput(read, size * blobs, repeat)["median"],
+    }
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(prog="benchmarks.storage")
+    parser.add_argument("--roots", nargs="+", help="striped roots, temp dirs by default")
+    parser.add_argument("--stripes", type=int, default=2, help="temp roots if --roots is not given")
+    parser.add_argument("--stripe-size", type=str, default="64K")
+    parser.add_argument("--size", type=str, default="16M", help="bytes per blob")
+    parser.add_argument("--blobs", type=int, default=4)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    tmp = tempfile.mkdtemp(prefix="sfs-storage-")
+    roots = args.roots or [os.path.join(tmp, f"root{i}") for i in range(args.stripes)]
+    os.makedirs(os.path.join(tmp, "local"))
+
+    backends = {
+        "memory": MemoryBackend(),
+        "local": LocalBackend(os.path.join(tmp, "local")),
+        f"striped x{len(roots)}": StripedBackend(roots, parseSize(args.stripe_size)),
+    }
+
+    try:
+        for name, backend in backends.items():
+            result = measure(backend, parseSize(args.size), args.blobs, args.repeat)
+            print(f"{name:<14}write {result['write']:>10.1f} MB/s   read {result['read']:>10.1f} MB/s")
+    finally:
+        shutil.rmtree(tmp)
+        if args.roots:
+            for root in roots:
+                for i in range(args.blobs):
+                    os.remove(os.path.join(root, f"blob{i}"))
@@ -1,8 +1,13 @@
-from cryptography.fernet import Fernet
+from cryptography.fernet import Fernet, InvalidToken, MultiFernet
+from typing import Optional
 import json
+import os
+
+from stats import stats
 
 
 ENCRYPTION_PREFIX = "encrypted_"
+KEY_PATH = "fernet.key"
 
 
 # make a singleton Encryptor class
@@ -12,14 +17,56 @@ class Encryptor:
     def __new__(cls):
         if cls.__instance is None:
             cls.__instance = super(Encryptor, cls).__new__(cls)
-            cls.__instance.fernet = Fernet(cls.__instance.key())
+            cls.__instance.loadKeys()
         return cls.__instance
 
     def key(self):
-        with open("fernet.key", "r") as f:
-            key = f.read()
-            return key
+        "Returns the primary key, the one used for encryption"
+        return self.keys()[0]
+
+    def keys(self) -> list[str]:
+        "Returns every key in the key file, newest (primary) first"
+        with open(KEY_PATH, "r") as f:
+            return [line.strip() for line in f if line.strip()]
+
+    def loadKeys(self):
+        "Loads the key file, old keys are kept around for decryption only"
+        keys = self.keys()
+        self.primary = Fernet(keys[0])
+        self.fernet = MultiFernet([Fernet(key) for key in keys])
+
+    def addKey(self) -> str:
+        "Generates a new primary key, keeping the old ones to decrypt existing data"
+        key = Fernet.generate_key().decode()
+        keys = [key, *self.keys()]
+
+        with open(KEY_PATH, "w") as f:
+            f.write("\n".join(keys) + "\n")
+
+        self.loadKeys()
+        return key
+
+    def retireKeys(self):
+        "Drops every key but the primary, only safe once everything is rotated"
+        key = self.key()
 
+        with open(KEY_PATH, "w") as f:
+            f.write(key + "\n")
+
+        self.loadKeys()
+
+    def rotateToken(self, token: bytes) -> Optional[bytes]:
+        """Re-encrypts a token under the primary key.
+        Returns None if the token is already encrypted with the primary key
+        """
+
+        try:
+            self.primary.decrypt(token)
+            return None
+        except InvalidToken:
+            return self.primary.encrypt(self.fernet.decrypt(token))
+
+    @stats.timed("encrypt.encryptJson")
     def encryptJson(self, data, outFile: str):
         data = json.dumps(data).encode()
 
@@ -30,20 +77,37 @@ class Encryptor:
 
         outFile = "/".join(path) + "/" + ENCRYPTION_PREFIX + fileName
 
-        with open(outFile, "wb") as f:
-            f.write(self.fernet.encrypt(data))
+        # write a new file and swap it in, a crash never leaves a torn dump
+        tmpFile = outFile + ".tmp"
+        with open(tmpFile, "wb") as f:
+            f.write(self.encrypt(data))
+            f.flush()
+            os.fsync(f.fileno())
 
+        os.replace(tmpFile, outFile)
+
+    @stats.timed("encrypt.decryptJson")
     def decryptJson(self, inFile: str) -> dict:
         with open(inFile, "rb") as f:
             data = f.read()
 
-        return json.loads(self.fernet.decrypt(data))
+        return json.loads(self.decrypt(data))
+
+    def encrypt(self, data: bytes) -> bytes:
+        stats.incr("encrypt")
+        stats.incr("encrypt_bytes", len(data))
+        return self.fernet.encrypt(data)
+
+    def decrypt(self, token: bytes) -> bytes:
+        stats.incr("decrypt")
+        stats.incr("decrypt_bytes", len(token))
+        return self.fernet.decrypt(token)
 
     def encryptString(self, data: str) -> str:
-        return self.fernet.encrypt(data.encode()).decode()
+        return self.encrypt(data.encode()).decode()
 
     def decryptString(self, data: str) -> str:
-        return self.fernet.decrypt(data.encode()).decode()
+        return self.decrypt(data.encode()).decode()
 
     def isEncrypted(self, filePath: str) -> bool:
         return filePath.split("/")[-1].startswith(ENCRYPTION_PREFIX)
@@ -1,17 +1,76 @@
+import contextlib
+import functools
 import os
-from typing import Optional
+import struct
+import threading
+from collections import OrderedDict
+from typing import Iterator, Optional
+from cryptography.fernet import InvalidToken
 from encrypt import Encryptor
+from stats import stats
+import storage
+from storage import join
 
 
 
 FILE_PATH = "files/"
 encryptor = Encryptor()
 
+# Everything below goes through the backend with encrypted paths relative
+# to its root, "" being the root itself
+backend: storage.Backend = storage.fromEnv(FILE_PATH)
+
+# Held while a path is resolved and used, background jobs that rename
+# encrypted entries (key rotation) take it so a lookup never sees a half move
+treeLock = threading.RLock()
+
+
+# Files are a magic line followed by one token per chunk, one per line, so
+# they can be decrypted a chunk at a time. Every chunk starts with its index
+# and whether it is the last one, so chunks can't be reordered or dropped.
+# Files written before have no magic line and are a single token.
+CHUNK_SIZE = int(os.environ.get("SFS_CHUNK_SIZE", 1024 * 1024))
+CHUNK_MAGIC = b"sfs-chunked-1\n"
+CHUNK_HEADER = struct.Struct(">I?")
+
+# Called with the encrypted backend path after every content write
+writeListeners: list = []
+# Called with (operation, encrypted path, new path of a rename) after every
+# change to the tree, operations are mkdir, write, remove, rmdir, rename and
+# resync when the whole tree was replaced
+changeListeners: list = []
+
+# Decrypted directory listings, encrypted directory path to
+# {name: (encrypted name, isFolder)}, least recently used first
+NAME_CACHE_DIRS = int(os.environ.get("SFS_NAME_CACHE_DIRS", 1024))
+nameCache: OrderedDict[str, dict[str, tuple[str, bool]]] = OrderedDict()
+
+# Decrypted contents of small files by encrypted path, within a byte budget
+CONTENT_CACHE_BYTES = int(os.environ.get("SFS_CONTENT_CACHE_BYTES", 32 * 1024 * 1024))
+CONTENT_CACHE_FILE_MAX = int(os.environ.get("SFS_CONTENT_CACHE_FILE_MAX", 256 * 1024))
+contentCache: OrderedDict[str, bytes] = OrderedDict()
+contentCacheSize = 0
+# Bumped on every change, a read that raced with one isn't cached
+generation = 0
+
+
+def withTreeLock(func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with treeLock:
+            return func(*args, **kwargs)
+
+    return wrapper
+
 
 class PathReadResult:
-    def __init__(self, maybeEncryptedName, isFolder=False) -> None:
+    def __init__(self, maybeEncryptedName, isFolder=False, name=None) -> None:
         self.encryptedName = maybeEncryptedName
         self.isFolder = isFolder
+        if name is not None:
+            self.name = name
+            return
+
         try:
             self.name = encryptor.decryptString(maybeEncryptedName)
         except:
@@ -21,7 +80,148 @@ class PathReadResult:
         return f"PathReadResult(name={self.name}, encryptedName={self.encryptedName}) isFolder={self.isFolder}"
 
 
-def findPath(path: str, curr: str = FILE_PATH) -> Optional[str]:
+def encryptChunks(data: bytes) -> list[bytes]:
+    "Returns the parts of the chunked file holding data"
+    view = memoryview(data)
+    starts = range(0, max(len(data), 1), CHUNK_SIZE)
+
+    parts = [CHUNK_MAGIC]
+    for index, start in enumerate(starts):
+        header = CHUNK_HEADER.pack(index, start + CHUNK_SIZE >= len(data))
+        parts.append(encryptor.encrypt(header + view[start : start + CHUNK_SIZE]))
+        parts.append(b"\n")
+
+    return parts
+
+
+def decryptChunks(buffer) -> Iterator[memoryview]:
+    """Yields the plaintext chunks of an encrypted file in a bytes-like buffer.
+    Slicing a memory map copies just the one token being decrypted
+    """
+
+    if buffer[: len(CHUNK_MAGIC)] != CHUNK_MAGIC:
+        stats.incr("fileio.legacyReads")
+        yield memoryview(encryptor.decrypt(buffer[:]))
+        return
+
+    start, index, last = len(CHUNK_MAGIC), 0, False
+    while start < len(buffer):
+        if (end := buffer.find(b"\n", start)) == -1:
+            end = len(buffer)
+
+        chunk = encryptor.decrypt(buffer[start:end])
+        chunkIndex, last = CHUNK_HEADER.unpack_from(chunk)
+        if chunkIndex != index or (last and end + 1 < len(buffer)):
+            raise InvalidToken
+
+        storage.dropPages(buffer, start, end)
+        yield memoryview(chunk)[CHUNK_HEADER.size :]
+
+        index += 1
+        start = end + 1
+
+    if not last:
+        raise InvalidToken
+
+
+def rotateChunks(data: bytes) -> Optional[bytes]:
+    """Re-encrypts every token of a file under the primary key.
+    Returns None if they all already are
+    """
+
+    if not data.startswith(CHUNK_MAGIC):
+        return encryptor.rotateToken(data)
+
+    tokens = data[len(CHUNK_MAGIC) :].splitlines()
+    rotated = [encryptor.rotateToken(token) for token in tokens]
+
+    if all(token is None for token in rotated):
+        return None
+
+    return CHUNK_MAGIC + b"".join(
+        (new or old) + b"\n" for old, new in zip(tokens, rotated)
+    )
+
+
+@withTreeLock
+def listNames(curr: str) -> dict[str, tuple[str, bool]]:
+    "Returns the decrypted listing of an encrypted directory, from the cache if warm"
+    if (names := nameCache.get(curr)) is not None:
+        nameCache.move_to_end(curr)
+        stats.incr("fileio.nameCache.hit")
+        return names
+
+    stats.incr("fileio.nameCache.miss")
+    names = {}
+    for encryptedName, isDir in backend.listdir(curr):
+        try:
+            names[encryptor.decryptString(encryptedName)] = (encryptedName, isDir)
+        except:
+            pass
+
+    nameCache[curr] = names
+    if len(nameCache) > NAME_CACHE_DIRS:
+        nameCache.popitem(last=False)
+
+    return names
+
+
+def cacheContent(path: str, data: bytes):
+    global contentCacheSize
+
+    if len(data) > CONTENT_CACHE_FILE_MAX or len(data) > CONTENT_CACHE_BYTES:
+        return
+
+    if (old := contentCache.pop(path, None)) is not None:
+        contentCacheSize -= len(old)
+
+    contentCache[path] = data
+    contentCacheSize += len(data)
+
+    while contentCacheSize > CONTENT_CACHE_BYTES:
+        contentCacheSize -= len(contentCache.popitem(last=False)[1])
+
+
+@withTreeLock
+def invalidate(path: str, names: bool = True):
+    """Drops cached contents of an encrypted path and everything below it,
+    and with names their listings and the listing of its parent.
+    Called on every change to the tree
+    """
+
+    global contentCacheSize, generation
+
+    generation += 1
+    prefix = path + "/"
+    if names:
+        for key in [k for k in nameCache if k == path or k.startswith(prefix)]:
+            del nameCache[key]
+        nameCache.pop(path.rpartition("/")[0], None)
+
+    for key in [k for k in contentCache if k == path or k.startswith(prefix)]:
+        contentCacheSize -= len(contentCache.pop(key))
+
+
+@withTreeLock
+def notifyChange(op: str, path: str, newPath: Optional[str] = None):
+    "Tells the change listeners about a change to the tree, called under the tree lock"
+    for listener in changeListeners:
+        listener(op, path, newPath)
+
+
+@withTreeLock
+def clearCaches():
+    global contentCacheSize, generation
+
+    generation += 1
+    nameCache.clear()
+    contentCache.clear()
+    contentCacheSize = 0
+
+
+@stats.timed("fileio.findPath")
+@withTreeLock
+def findPath(path: str, curr: str = "") -> Optional[str]:
     """Given path and current directory, return the encrypted path.
     Default current directory is the root file directory.
     If no match is found, return None
@@ -31,28 +231,28 @@ def findPath(path: str, curr: str = FILE_PATH) -> Optional[str]:
         return curr
 
     first, *rest = [part for part in path.split("/") if part]
-    for dir in os.listdir(curr):
-        try:
-            if encryptor.decryptString(dir) == first:
-                return findPath("/".join(rest), os.path.join(curr, dir))
-        except:
-            pass
+    if (entry := listNames(curr).get(first)) is None:
+        return None
 
-    return None
+    return findPath("/".join(rest), join(curr, entry[0]))
 
 
+@stats.timed("fileio.isFolder")
+@withTreeLock
 def isFolder(path) -> bool:
     """Given a non-encrypted path, return True if the path is a directory
     If the path does not exist, return False
     """
 
-    if not (path := findPath(path)):
+    if (path := findPath(path)) is None:
         return False
 
-    return os.path.isdir(path)
+    return backend.isdir(path)
 
 
-def makePath(path: str, curr: str = FILE_PATH, isFile: bool = False) -> str:
+@stats.timed("fileio.makePath")
+@withTreeLock
+def makePath(path: str, curr: str = "", isFile: bool = False) -> str:
     """Given a non-encrypted path, create the encrypted path and return it.
     If the parts of the path do not exist, create them"""
 
@@ -62,93 +262,181 @@ def makePath(path: str, curr: str = FILE_PATH, isFile: bool = False) -> str:
     first, *rest = path.split("/")
 
     if not rest and isFile:
-        return os.path.join(curr, encryptor.encryptString(first))
+        return join(curr, encryptor.encryptString(first))
 
-    for dir in os.listdir(curr):
-        try:
-            if encryptor.decryptString(dir) == first:
-                return makePath("/".join(rest), os.path.join(curr, dir), isFile)
-        except:
-            pass
+    if (entry := listNames(curr).get(first)) is not None:
+        return makePath("/".join(rest), join(curr, entry[0]), isFile)
 
-    newDir = os.path.join(curr, encryptor.encryptString(first))
-    os.mkdir(newDir)
+    newDir = join(curr, encryptor.encryptString(first))
+    backend.mkdir(newDir)
+    invalidate(newDir)
+    notifyChange("mkdir", newDir)
 
     return makePath("/".join(rest), newDir, isFile)
 
 
+@stats.timed("fileio.readFile")
+@withTreeLock
 def readFile(path) -> str:
     """Given a non-encrypted path, return the contents of the file"""
 
-    if not (path := findPath(path)):
-        raise FileNotFoundError
-    elif os.path.isdir(path):
-        raise IsADirectoryError
+    return b"".join(readChunks(path)).decode()
 
-    with open(path, "rb") as f:
-        return encryptor.decryptString(f.read().decode())
 
+def readChunks(path) -> Iterator[memoryview]:
+    """Given a non-encrypted path, yield the contents of the file chunk by chunk.
+    Only about one chunk is held in memory at a time
+    """
 
+    with contextlib.ExitStack() as stack:
+        with treeLock:
+            if (path := findPath(path)) is None:
+                raise FileNotFoundError
+
+            if (cached := contentCache.get(path)) is not None:
+                contentCache.move_to_end(path)
+                stats.incr("fileio.contentCache.hit")
+            elif backend.isdir(path):
+                raise IsADirectoryError
+            else:
+                # once mapped, a concurrent rewrite doesn't change what is read
+                buffer = stack.enter_context(backend.map(path))
+                mappedAt = generation
+
+        if cached is not None:
+            yield memoryview(cached)
+            return
+
+        # small files are kept whole for the content cache
+        small = CONTENT_CACHE_BYTES > 0 and len(buffer) <= CONTENT_CACHE_FILE_MAX
+        chunks = []
+
+        for chunk in decryptChunks(buffer):
+            stats.incr("fileio.readBytes", len(chunk))
+            if small:
+                chunks.append(chunk)
+            yield chunk
+
+        if small:
+            with treeLock:
+                if generation == mappedAt:
+                    cacheContent(path, b"".join(chunks))
+
+
+@stats.timed("fileio.readPath")
+@withTreeLock
 def readPath(path) -> list[PathReadResult]:
     """Given a non-encrypted path, return the contents of the directory"""
 
-    if not (path := findPath(path)):
+    if (path := findPath(path)) is None:
         raise FileNotFoundError
-    elif os.path.isfile(path):
+    elif not backend.isdir(path):
         raise NotADirectoryError
 
-    return [PathReadResult(dir.name, dir.is_dir()) for dir in os.scandir(path)]
+    return [
+        PathReadResult(encryptedName, isDir, name)
+        for name, (encryptedName, isDir) in listNames(path).items()
+    ]
 
 
-def writeFile(path: str, contents: str):
+@stats.timed("fileio.writeFile")
+@withTreeLock
+def writeFile(path: str, contents: str) -> int:
     """Given a non-encrypted path, write the contents to the file
     If the file or path does not exist, create it
+    Returns the number of encrypted bytes written
     """
 
-    if not (writePath := findPath(path)):
+    if (writePath := findPath(path)) is None:
         writePath = makePath(path, isFile=True)
+        isNew = True
+    else:
+        isNew = False
+
+    parts = encryptChunks(contents.encode())
+    backend.writeParts(writePath, parts)
+    # overwriting keeps the listing of the directory valid
+    invalidate(writePath, names=isNew)
+
+    for listener in writeListeners:
+        listener(writePath)
+    notifyChange("write", writePath)
+
+    return sum(len(part) for part in parts)
+
+
+@stats.timed("fileio.walkTree")
+@withTreeLock
+def walkTree(curr: str = "", prefix: str = "") -> list[tuple[str, str, bool]]:
+    """Returns (path, encrypted path, isFolder) for every entry below a directory.
+    Entries whose name does not decrypt are skipped
+    """
+
+    out = []
+    for encryptedName, isDir in backend.listdir(curr):
+        try:
+            name = encryptor.decryptString(encryptedName)
+        except:
+            continue
+
+        path, encryptedPath = join(prefix, name), join(curr, encryptedName)
+        out.append((path, encryptedPath, isDir))
+
+        if isDir:
+            out.extend(walkTree(encryptedPath, path))
 
-    with open(writePath, "wb") as f:
-        f.write(encryptor.encryptString(contents).encode())
+    return out
 
 
+@stats.timed("fileio.removeFile")
+@withTreeLock
 def removeFile(path):
     """Given a non-encrypted path, remove the file
     If the file does not exist, raise FileNotFoundError
     """
 
-    if not (path := findPath(path)):
+    if (path := findPath(path)) is None:
         raise FileNotFoundError
-    elif os.path.isdir(path):
+    elif backend.isdir(path):
         raise IsADirectoryError
 
-    os.remove(path)
+    backend.remove(path)
+    invalidate(path)
+    notifyChange("remove", path)
 
 
+@stats.timed("fileio.removePath")
+@withTreeLock
 def removePath(path):
     """Given a non-encrypted path, remove the directory
     If the directory does not exist, raise FileNotFoundError
     The directory must be empty.
     """
 
-    if not (path := findPath(path)):
+    if (path := findPath(path)) is None:
         raise FileNotFoundError
-    elif os.path.isfile(path):
+    elif not backend.isdir(path):
         raise NotADirectoryError
 
-    os.rmdir(path)
+    backend.rmdir(path)
+    invalidate(path)
+    notifyChange("rmdir", path)
 
 
+@stats.timed("fileio.renamePath")
+@withTreeLock
 def renamePath(oldPath, name: str):
     """Given a non-encrypted old path and a non-encrypted new path, rename the directory
     If the directory does not exist, raise FileNotFoundError
     """
 
-    if not (oldPath := findPath(oldPath)):
+    if (oldPath := findPath(oldPath)) is None:
         raise FileNotFoundError
 
     encryptedName = encryptor.encryptString(name)
 
-    newPath = os.path.join(os.path.dirname(oldPath), encryptedName)
+    newPath = join(oldPath.rpartition("/")[0], encryptedName)
 
-    os.rename(oldPath, newPath)
+    backend.rename(oldPath, newPath)
+    invalidate(oldPath)
+    notifyChange("rename", oldPath, newPath)
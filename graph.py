@@ -1,18 +1,111 @@
+import itertools
 import json
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
 from typing import Optional
 from encrypt import Encryptor
 import fileio
-from user import User
+from user import User, Users
+from stats import stats
 
 encryptor = Encryptor()
 
 
+# ACL entries are packed ints, the interned principal id shifted past the
+# read/write bits, so a node holds two small tuples instead of objects
+READ = 1
+WRITE = 2
+FLAG_BITS = 2
+
+principalNames: list[str] = []
+principalIds: dict[str, int] = {}
+
+
+def principalId(name: str) -> int:
+    "Returns the interned id of a user or group name"
+    if (id := principalIds.get(name)) is None:
+        id = principalIds[name] = len(principalNames)
+        principalNames.append(sys.intern(name))
+
+    return id
+
+
+def packEntry(name: str, isRead: bool, isWrite: bool) -> int:
+    return principalId(name) << FLAG_BITS | (READ if isRead else 0) | (WRITE if isWrite else 0)
+
+
+def setEntry(entries: tuple, name: str, isRead: bool, isWrite: bool) -> tuple:
+    "Returns the entries with the principal's flags replaced, or appended"
+    id = principalId(name)
+    entry = packEntry(name, isRead, isWrite)
+
+    for i, existing in enumerate(entries):
+        if existing >> FLAG_BITS == id:
+            return entries[:i] + (entry,) + entries[i + 1 :]
+
+    return entries + (entry,)
+
+
+def removeEntry(entries: tuple, name: str) -> tuple:
+    "Returns the entries without the principal"
+    if (id := principalIds.get(name)) is None:
+        return entries
+
+    return tuple(entry for entry in entries if entry >> FLAG_BITS != id)
+
+
+# Effective ACLs are dicts from principal key (id, low bit set for groups) to
+# flags. They are computed on access from the parent's inheritable ACL and
+# cached with the stamp of the parent's ACL they were built from. A node whose
+# inheritable ACL changes gets a new stamp, so only its own subtree is rebuilt,
+# lazily on the next check.
+aclStamps = itertools.count(1)
+
+
+def userKey(name: str) -> Optional[int]:
+    if (id := principalIds.get(name)) is None:
+        return None
+    return id << 1
+
+
+def groupKey(name: str) -> Optional[int]:
+    if (id := principalIds.get(name)) is None:
+        return None
+    return id << 1 | 1
+
+
+def mergeEntries(acl: dict[int, int], entries: tuple, isGroup: bool):
+    for entry in entries:
+        key = entry >> FLAG_BITS << 1 | isGroup
+        acl[key] = acl.get(key, 0) | entry & (READ | WRITE)
+
+
+def sharedKeys(node: "Node") -> set[int]:
+    "Keys of the groups, and of all, a node is shared with for reading"
+    keys = {entry >> FLAG_BITS << 1 | 1 for entry in node.groups + node.inheritGroups if entry & READ}
+    if (id := principalIds.get("all")) is not None:
+        if any(entry >> FLAG_BITS == id and entry & READ for entry in node.users + node.inheritUsers):
+            keys.add(id << 1)
+    return keys
+
+
 class Permission:
+    __slots__ = ("name", "isRead", "isWrite")
+
     def __init__(self, name, isRead, isWrite) -> None:
         self.name: str = name
         self.isRead: bool = isRead
         self.isWrite: bool = isWrite
 
+    @classmethod
+    def unpack(cls, entry: int) -> "Permission":
+        return cls(
+            principalNames[entry >> FLAG_BITS],
+            isRead=bool(entry & READ),
+            isWrite=bool(entry & WRITE),
+        )
+
     def __repr__(self) -> str:
         return f"Permission(name={self.name}, isRead={self.isRead}, isWrite={self.isWrite})"
 
@@ -25,6 +118,25 @@ class Permission:
 
 
 class Node:
+    __slots__ = (
+        "name",
+        "owner",
+        "users",
+        "groups",
+        "inheritUsers",
+        "inheritGroups",
+        "blocksInheritance",
+        "isFolder",
+        "size",
+        "encryptedSize",
+        "files",
+        "mtime",
+        "parent",
+        "traversers",
+        "_acl",
+        "_stamp",
+        "_parentStamp",
+    )
 
     def __init__(
         self,
@@ -32,15 +144,52 @@ class Node:
         owner: str,
         allowedUsers: list[dict] = [],
         allowedGroups: list[dict] = [],
+        inheritUsers: list[dict] = [],
+        inheritGroups: list[dict] = [],
+        blocksInheritance: bool = False,
+        isFolder: bool = False,
+        usage: Optional[dict] = None,
     ) -> None:
         self.name = name
-        self.owner = owner
-        self.allowedUsers: list[Permission] = [
-            Permission(**user) for user in allowedUsers
-        ]
-        self.allowedGroups: list[Permission] = [
-            Permission(**group) for group in allowedGroups
-        ]
+        self.owner = principalNames[principalId(owner)]
+        self.users: tuple[int, ...] = tuple(
+            packEntry(**user) for user in allowedUsers
+        )
+        self.groups: tuple[int, ...] = tuple(
+            packEntry(**group) for group in allowedGroups
+        )
+        # Entries a directory passes down to everything below it
+        self.inheritUsers: tuple[int, ...] = tuple(
+            packEntry(**user) for user in inheritUsers
+        )
+        self.inheritGroups: tuple[int, ...] = tuple(
+            packEntry(**group) for group in inheritGroups
+        )
+        self.blocksInheritance = blocksInheritance
+        self.isFolder = isFolder
+        # Rollups, a file's own numbers or the totals of a directory's subtree
+        usage = usage or {}
+        self.size: int = usage.get("size", 0)
+        self.encryptedSize: int = usage.get("encryptedSize", 0)
+        self.files: int = usage.get("files", 0)
+        self.mtime: float = usage.get("mtime", 0)
+        self.parent: Optional[Node] = None
+        # Keys shared with somewhere below, who may read the node to get there.
+        # Derived from the entries on load and when sharing, never stored
+        self.traversers: tuple[int, ...] = ()
+        self._acl: Optional[tuple[dict[int, int], dict[int, int]]] = None
+        self._stamp = 0
+        self._parentStamp = -1  # stale, a parent's stamp is never negative
+
+    @property
+    def allowedUsers(self) -> list[Permission]:
+        "Unpacked user permissions, changes go through addUser/removeUser"
+        return [Permission.unpack(entry) for entry in self.users]
+
+    @property
+    def allowedGroups(self) -> list[Permission]:
+        "Unpacked group permissions, changes go through addGroup/removeGroup"
+        return [Permission.unpack(entry) for entry in self.groups]
 
     def __repr__(self) -> str:
         return f"Node(name={self.name}, allowedUsers={[p.name for p in self.allowedUsers]}, allowedGroups={[p.name for p in self.allowedGroups]}"
@@ -48,39 +197,83 @@ class Node:
     def dump(self) -> dict:
         "Dumps node to a dictionary"
 
-        return {
+        out = {
             "name": self.name,
             "owner": self.owner,
             "allowedUsers": [p.dump() for p in self.allowedUsers],
             "allowedGroups": [p.dump() for p in self.allowedGroups],
         }
 
-    def isReadable(self, user: User) -> bool:
-        "Returns if a node is readable for a specific user"
-        if self.isOwner(user) or user.isAdmin:
-            return True
+        if self.inheritUsers:
+            out["inheritUsers"] = [Permission.unpack(e).dump() for e in self.inheritUsers]
+        if self.inheritGroups:
+            out["inheritGroups"] = [Permission.unpack(e).dump() for e in self.inheritGroups]
+        if self.blocksInheritance:
+            out["blocksInheritance"] = True
+        if self.isFolder:
+            out["isFolder"] = True
 
-        for permission in self.allowedUsers:
-            if permission.name in [user.name, "all"] and permission.isRead:
-                return True
+        out["usage"] = self.usage()
 
-        for permission in self.allowedGroups:
-            if permission.name in user.joinedGroups and permission.isRead:
-                return True
+        return out
 
-        return False
+    def usage(self) -> dict:
+        return {
+            "size": self.size,
+            "encryptedSize": self.encryptedSize,
+            "files": self.files,
+            "mtime": self.mtime,
+        }
+
+    def acl(self) -> tuple[dict[int, int], dict[int, int]]:
+        "Returns the effective and the inheritable ACL of the node"
+        inherited, parentStamp = {}, 0
+        if self.parent is not None and not self.blocksInheritance:
+            inherited = self.parent.acl()[1]
+            parentStamp = self.parent._stamp
+
+        if self._acl is not None and self._parentStamp == parentStamp:
+            return self._acl
+
+        effective = dict(inherited)
+        mergeEntries(effective, self.users, False)
+        mergeEntries(effective, self.groups, True)
+        for key in self.traversers:
+            effective[key] = effective.get(key, 0) | READ
+
+        inheritable = inherited
+        if self.inheritUsers or self.inheritGroups:
+            inheritable = dict(inherited)
+            mergeEntries(inheritable, self.inheritUsers, False)
+            mergeEntries(inheritable, self.inheritGroups, True)
+
+        # children only rebuild when what they inherit changed
+        if self._acl is None or self._acl[1] != inheritable:
+            self._stamp = next(aclStamps)
+        self._acl = (effective, inheritable)
+        self._parentStamp = parentStamp
+        return self._acl
+
+    def isReadable(self, user: User) -> bool:
+        "Returns if a node is readable for a specific user"
+        return self.isAllowed(user, READ)
 
     def isWritable(self, user: User) -> bool:
         "Returns if a node is writable for a specific user"
+        return self.isAllowed(user, WRITE)
+
+    def isAllowed(self, user: User, flag: int) -> bool:
         if self.isOwner(user) or user.isAdmin:
             return True
 
-        for permission in self.allowedUsers:
-            if permission.name in [user.name, "all"] and permission.isWrite:
+        effective = self.acl()[0]
+
+        for key in [userKey(user.name), userKey("all")]:
+            if effective.get(key, 0) & flag:
                 return True
 
-        for permission in self.allowedGroups:
-            if permission.name in user.joinedGroups and permission.isWrite:
+        for group in user.joinedGroups:
+            if effective.get(groupKey(group), 0) & flag:
                 return True
 
         return False
@@ -90,47 +283,203 @@ class Node:
         return self.owner == user.name
 
     def addGroup(self, groupName: str, isRead: bool, isWrite: bool):
-        for perm in self.allowedGroups:
-            if perm.name == groupName:
-                perm.isRead = isRead
-                perm.isWrite = isWrite
-                break
-        else:
-            self.allowedGroups.append(
-                Permission(groupName, isRead=isRead, isWrite=isWrite)
-            )
+        self.groups = setEntry(self.groups, groupName, isRead, isWrite)
+        self._parentStamp = -1
 
     def addUser(self, user: str, isRead: bool, isWrite: bool):
-        for perm in self.allowedUsers:
-            if perm.name == user:
-                perm.isRead = isRead
-                perm.isWrite = isWrite
-                break
-        else:
-            self.allowedUsers.append(Permission(user, isRead=isRead, isWrite=isWrite))
+        self.users = setEntry(self.users, user, isRead, isWrite)
+        self._parentStamp = -1
 
     def removeUser(self, user: str = "all"):
-        for i in range(len(self.allowedUsers)):
-            perm = self.allowedUsers[i]
+        self.users = removeEntry(self.users, user)
+        self._parentStamp = -1
+
+    def removeGroup(self, groupName: str) -> bool:
+        "Removes a group, returns if it was present"
+        groups = removeEntry(self.groups, groupName)
+        removed = len(groups) != len(self.groups)
+        self.groups = groups
+        self._parentStamp = -1
+
+        if self.inheritGroups:
+            inheritGroups = removeEntry(self.inheritGroups, groupName)
+            if len(inheritGroups) != len(self.inheritGroups):
+                self.inheritGroups = inheritGroups
+                removed = True
+                self._parentStamp = -1
+
+        return removed
+
+    def clearPermissions(self):
+        self.users = ()
+        self.groups = ()
+        self._parentStamp = -1
+
+    def setInherited(self, users: tuple = (), groups: tuple = (), blocks: bool = False):
+        "Replaces what the node passes down and whether it takes its parent's"
+        self.inheritUsers = users
+        self.inheritGroups = groups
+        self.blocksInheritance = blocks
+        self._parentStamp = -1
+
+    def addInheritedGroup(self, groupName: str, isRead: bool, isWrite: bool):
+        self.inheritGroups = setEntry(self.inheritGroups, groupName, isRead, isWrite)
+        self._parentStamp = -1
 
-            if perm.name == user:
-                self.allowedUsers.pop(i)
-                break
+    def addInheritedUser(self, user: str, isRead: bool, isWrite: bool):
+        self.inheritUsers = setEntry(self.inheritUsers, user, isRead, isWrite)
+        self._parentStamp = -1
+
+    def removeInheritedUser(self, user: str = "all"):
+        self.inheritUsers = removeEntry(self.inheritUsers, user)
+        self._parentStamp = -1
+
+
+def plainSize(encryptedPath: str) -> int:
+    "Plaintext length of an encrypted file, 0 if it doesn't decrypt"
+    try:
+        with fileio.backend.map(encryptedPath) as buffer:
+            return sum(len(chunk) for chunk in fileio.decryptChunks(buffer))
+    except Exception:
+        return 0
+
+
+def parentPath(path: str) -> str:
+    return path.rpartition("/")[0]
 
 
 class Graph:
     def __init__(self, jsonPath: str):
         self.jsonPath = jsonPath
         self.isEncrypted = encryptor.isEncrypted(jsonPath)
+        self.writeback = None  # set by WriteBack, saves are then logged and batched
+        self.changed: set[str] = set()
+        self.accounting: Optional[Users] = None  # set to charge file sizes to owner quotas
+
+        self.load()
 
-        with open(jsonPath, "r") as f:
+    def load(self):
+        "Reads the nodes from jsonPath, replacing the ones in memory"
+        with open(self.jsonPath, "r") as f:
             if self.isEncrypted:
-                graph = encryptor.decryptJson(jsonPath)
+                graph = encryptor.decryptJson(self.jsonPath)
             else:
                 graph = json.load(f)
 
             self.nodes = {node["name"]: Node(**node) for node in graph}
 
+        self.changed.clear()
+        self.linkParents()
+
+        if any("usage" not in node for node in graph):
+            # written before rollups existed, build them once from the tree
+            self.rebuildUsage()
+            self.dump()
+
+    def linkParents(self):
+        "Points every node at its parent directory node"
+        for name, node in self.nodes.items():
+            node.parent = self.nodes.get(parentPath(name)) if name else None
+            node.traversers = ()
+            node._parentStamp = -1
+
+        for node in self.nodes.values():
+            if keys := sharedKeys(node):
+                self.addTraversers(node, keys)
+
+    def save(self):
+        "Persists changes, through the write-back layer if there is one"
+        if self.writeback is not None:
+            self.writeback.saved(self)
+        else:
+            self.dump()
+
+    def markChanged(self, *paths: str):
+        "Records which entries a save() has to persist"
+        self.changed.update(paths)
+
+    def takeChanges(self) -> list[tuple[str, Optional[dict]]]:
+        "Returns the changed entries, None for removed ones, for the redo log"
+        changes = [
+            (path, entry.dump() if (entry := self.nodes.get(path)) else None)
+            for path in self.changed
+        ]
+        self.changed.clear()
+        return changes
+
+    def applyChange(self, path: str, value: Optional[dict]):
+        "Applies a redo log record"
+        if value is None:
+            self.nodes.pop(path, None)
+        else:
+            self.nodes[path] = Node(**value)
+
+    def afterReplay(self):
+        self.linkParents()
+
+    @stats.timed("graph.rebuildUsage")
+    def rebuildUsage(self, workers: int = 1):
+        "Recomputes every rollup from the files on disk, decrypting in parallel"
+        for node in self.nodes.values():
+            node.isFolder = False
+            node.size = node.encryptedSize = node.files = 0
+            node.mtime = 0
+
+        if (root := self.nodes.get("")) is not None:
+            root.isFolder = True
+            root.mtime = fileio.backend.stat("").mtime
+
+        files = []
+        for path, encryptedPath, isDir in fileio.walkTree():
+            if (node := self.nodes.get(path)) is None:
+                continue
+
+            stat = fileio.backend.stat(encryptedPath)
+            node.mtime = max(node.mtime, stat.mtime)
+
+            if isDir:
+                node.isFolder = True
+            else:
+                files.append((node, encryptedPath, stat))
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            sizes = pool.map(plainSize, [path for _, path, _ in files])
+
+            for (node, _, stat), size in zip(files, sizes):
+                self.addUsage(node, size, stat.size, 1, stat.mtime)
+
+        # every node changed, callers dump the graph once rather than log them
+        self.changed.clear()
+
+    def usageByOwner(self) -> dict[str, int]:
+        "Plaintext bytes of the files each user owns"
+        usage = {}
+        for node in self.nodes.values():
+            if not node.isFolder:
+                usage[node.owner] = usage.get(node.owner, 0) + node.size
+
+        return usage
+
+    def addUsage(
+        self,
+        node: Optional[Node],
+        size: int = 0,
+        encryptedSize: int = 0,
+        files: int = 0,
+        mtime: Optional[float] = None,
+    ):
+        "Adds to the rollups of a node and of every directory above it"
+        mtime = mtime or time.time()
+
+        while node is not None:
+            node.size += size
+            node.encryptedSize += encryptedSize
+            node.files += files
+            node.mtime = max(node.mtime, mtime)
+            self.markChanged(node.name)
+            node = node.parent
+
+    @stats.timed("graph.dump")
     def dump(self):
         "Dumps graph to a file, should be called on exit"
 
@@ -142,11 +491,14 @@ class Graph:
             with open(self.jsonPath, "w") as f:
                 json.dump(data, f, indent=2)
 
+        self.changed.clear()
+
     def getNodeFromPath(self, path: str) -> Optional[Node]:
         "Returns node from path"
 
         return self.nodes.get(path, None)
 
+    @stats.timed("graph.listDirectory")
     def listDirectory(self, path: str, user: User) -> list[str]:
         "Lists the directory at a specific path"
 
@@ -175,15 +527,21 @@ class Graph:
 
         return out
 
+    @stats.timed("graph.initUserDirectory")
     def initUserDirectory(self, user: str):
         "Initializes the user directory"
 
-        self.nodes[user] = Node(user, user, [Permission(user, True, True).dump()])
+        node = self.nodes[user] = Node(
+            user, user, [Permission(user, True, True).dump()], isFolder=True
+        )
+        node.parent = self.nodes.get("")
 
         fileio.makePath(user)
+        self.addUsage(node)
 
-        self.dump()
+        self.save()
 
+    @stats.timed("graph.createFile")
     def createFile(self, path: str, user: User) -> bool:
         "Creates a file at a specific path"
 
@@ -195,7 +553,7 @@ class Graph:
         if not parent.isWritable(user):
             return False
 
-        fileio.writeFile(path, "")
+        encryptedSize = fileio.writeFile(path, "")
 
         allowedGroups = []
         allowedUsers = [
@@ -203,12 +561,15 @@ class Graph:
             Permission(parent.owner, True, True).dump(),
         ]
 
-        self.nodes[path] = Node(path, user.name, allowedUsers, allowedGroups)
+        node = self.nodes[path] = Node(path, user.name, allowedUsers, allowedGroups)
+        node.parent = parent
+        self.addUsage(node, 0, encryptedSize, 1)
 
-        self.dump()
+        self.save()
 
         return True
 
+    @stats.timed("graph.createFolder")
     def createFolder(self, path: str, user: User) -> bool:
         "Creates a folder at a specific path"
 
@@ -228,23 +589,28 @@ class Graph:
             Permission(parent.owner, True, True).dump(),
         ]
 
-        self.nodes[path] = Node(path, user.name, allowedUsers, allowedGroups)
+        node = self.nodes[path] = Node(
+            path, user.name, allowedUsers, allowedGroups, isFolder=True
+        )
+        node.parent = parent
+        self.addUsage(node)
 
-        self.dump()
+        self.save()
 
         return True
 
+    @stats.timed("graph.deleteGroup")
     def deleteGroup(self, groupName: str):
         "Deletes a group from all nodes"
 
-        for k, v in self.nodes.items():
-            for permission in v.allowedGroups:
-                if permission.name == groupName:
-                    self.nodes[k].allowedGroups.remove(permission)
-                    print("Deleted group from ", v)
+        for node in self.nodes.values():
+            if node.removeGroup(groupName):
+                self.markChanged(node.name)
+                print("Deleted group from ", node)
 
-        self.dump()
+        self.save()
 
+    @stats.timed("graph.renameNode")
     def renameNode(self, path: str, newName: str) -> bool:
         "Renames a node"
 
@@ -256,47 +622,109 @@ class Graph:
 
         self.nodes[node.name] = node
         del self.nodes[path]
+        self.markChanged(path, node.name)
 
         fileio.renamePath(path, newName)
+        self.addUsage(node)
 
-        self.dump()
+        self.save()
 
         return True
 
+    @stats.timed("graph.writeFile")
+    def writeFile(self, path: str, contents: str) -> bool:
+        """Overwrites a file, keeping the rollups and quota usage up to date.
+        Returns False if the file doesn't exist or the write exceeds a quota
+        """
+
+        if not (node := self.getNodeFromPath(path)):
+            return False
+
+        # checked before anything is encrypted, an over quota write is cheap
+        size = len(contents.encode())
+        if self.accounting is not None and not self.accounting.allows(
+            node.owner, size - node.size
+        ):
+            return False
+
+        encryptedSize = fileio.writeFile(path, contents)
+
+        if self.accounting is not None:
+            self.accounting.charge(node.owner, size - node.size)
+        self.addUsage(node, size - node.size, encryptedSize - node.encryptedSize)
+
+        self.save()
+
+        return True
+
+    @stats.timed("graph.removeNode")
+    def removeNode(self, path: str) -> bool:
+        "Removes a file or an empty directory"
+
+        if not (node := self.getNodeFromPath(path)) or not path:
+            return False
+
+        if node.isFolder:
+            fileio.removePath(path)
+        else:
+            fileio.removeFile(path)
+
+        del self.nodes[path]
+        self.markChanged(path)
+        self.addUsage(node.parent, -node.size, -node.encryptedSize, -node.files)
+
+        if self.accounting is not None and not node.isFolder:
+            self.accounting.charge(node.owner, -node.size)
+
+        self.save()
+
+        return True
+
+    @stats.timed("graph.changePermissions")
     def changePermissions(self, choice: str, path: str, user: User):
         "Changes path permissions, 1 for owner, 2 for groups, 3 for users"
         if (node := self.getNodeFromPath(path)) is None:
             print("Node not found")
             return
 
+        # Directories pass their sharing down through inheritable entries, the
+        # subtree picks it up lazily instead of being rewritten node by node
+        isFolder = fileio.isFolder(path)
+        self.markChanged(path)
+
         if choice == "1":
-            node.allowedGroups.clear()
-            node.allowedUsers.clear()
+            node.clearPermissions()
+            node.setInherited(blocks=True)
         elif choice == "2":
             node.removeUser()
 
             for group in user.joinedGroups:
                 node.addGroup(group, True, True)
 
-            tok = path.split("/")
-            for i in range(1, len(tok)):
-                if not (node := self.getNodeFromPath("/".join(tok[:i]))):
-                    print("Subnode not found")
-                    break
-
+            if isFolder:
+                node.removeInheritedUser()
                 for group in user.joinedGroups:
-                    node.addGroup(group, True, False)
+                    node.addInheritedGroup(group, True, True)
+
+            self.addTraversers(node, sharedKeys(node))
         elif choice == "3":
             node.addUser("all", True, True)
 
-            tok = path.split("/")
-            for i in range(1, len(tok)):
-                if not (node := self.getNodeFromPath("/".join(tok[:i]))):
-                    print("Subnode not found")
-                    break
+            if isFolder:
+                node.addInheritedUser("all", True, True)
+
+            self.addTraversers(node, sharedKeys(node))
 
-                node.addUser("all", True, False)
+    def addTraversers(self, node: Node, keys: set[int]):
+        """Lets principals read the directories above a node so they can reach
+        it. Only the in-memory ACLs of the ancestors change, nothing is saved"""
+        while (node := node.parent) is not None and node.parent is not None:
+            if keys.issubset(node.traversers):
+                break  # its ancestors have them already
+            node.traversers = tuple(set(node.traversers) | keys)
+            node._parentStamp = -1
 
+    @stats.timed("graph.checkPathIntegrity")
     def checkPathIntegrity(self, path: str) -> list[str]:
         "Returns all files under a path are invalid"
 
@@ -1,16 +1,139 @@
 import cmd
 import argparse
+import codecs
+import errno
+import os
 import fileio
-import bcrypt
 import getpass
+import signal
+import sys
+import time
+from typing import Optional
 from graph import Graph
-from user import Users
-from fileio import readFile
-
-from util import tryParse
+from user import Users, hashPassword
+from session import Sessions
+from encrypt import Encryptor
+from rotate import RotationJob
+from stats import stats
+from profiler import Profile, sessionProfile
+from writeback import WriteBack
+from prefetch import Prefetcher
+from audit import AuditLog, formatEvent, parseTime
+from snapshot import Snapshots
+from replicate import Replicator
+import quota
+
+from util import formatSize, parseSize, tryParse
 
 prompt_template = "sfs> {user}@{curr_dir}$ "
 
+# Prometheus text file written on exit, for the node exporter textfile collector
+METRICS_FILE = os.environ.get("SFS_METRICS_FILE")
+
+
+def buildParsers() -> dict[str, argparse.ArgumentParser]:
+    "Builds the argument parser of every command once"
+    parsers = {}
+
+    parser = parsers["login"] = argparse.ArgumentParser(prog="login")
+    parser.add_argument("username", type=str, nargs="?")
+    parser.add_argument("--password", type=str)
+
+    parser = parsers["resume"] = argparse.ArgumentParser(prog="resume")
+    parser.add_argument("--check", action="store_true", help="run the integrity check")
+
+    parser = parsers["register"] = argparse.ArgumentParser(prog="register")
+    parser.add_argument("username", type=str, nargs="?")
+    parser.add_argument("--password", type=str)
+
+    parser = parsers["profile"] = argparse.ArgumentParser(prog="profile")
+    parser.add_argument("--memory", action="store_true", help="also trace allocations")
+    parser.add_argument("--top", type=int, default=15)
+    parser.add_argument("command", nargs=argparse.REMAINDER)
+
+    parser = parsers["stats"] = argparse.ArgumentParser(prog="stats")
+    parser.add_argument("--reset", action="store_true")
+    parser.add_argument("--export", type=str)
+
+    parser = parsers["cd"] = argparse.ArgumentParser(prog="cd")
+    parser.add_argument("path", type=str)
+
+    parser = parsers["create_group"] = argparse.ArgumentParser(prog="create_group")
+    parser.add_argument("group_name", type=str)
+    parser.add_argument("--users", type=str, nargs="*")
+
+    parser = parsers["delete_group"] = argparse.ArgumentParser(prog="delete_group")
+    parser.add_argument("group_name", type=str)
+
+    parser = parsers["cat"] = argparse.ArgumentParser(prog="cat")
+    parser.add_argument("file_path", type=str)
+
+    parser = parsers["mv"] = argparse.ArgumentParser(prog="mv")
+    parser.add_argument("source", type=str)
+    parser.add_argument("name", type=str)
+
+    parser = parsers["mkdir"] = argparse.ArgumentParser(prog="mkdir")
+    parser.add_argument("dir_name", type=str)
+
+    parser = parsers["touch"] = argparse.ArgumentParser(prog="touch")
+    parser.add_argument("file_path", type=str)
+
+    parser = parsers["echo"] = argparse.ArgumentParser(prog="echo")
+    parser.add_argument("file_path", type=str)
+    parser.add_argument("content", nargs="+", type=str)
+
+    parser = parsers["rm"] = argparse.ArgumentParser(prog="rm")
+    parser.add_argument("path", type=str)
+
+    parser = parsers["du"] = argparse.ArgumentParser(prog="du")
+    parser.add_argument("path", type=str, nargs="?", default=".")
+
+    parser = parsers["stat"] = argparse.ArgumentParser(prog="stat")
+    parser.add_argument("path", type=str)
+
+    parser = parsers["quota"] = argparse.ArgumentParser(prog="quota")
+    parser.add_argument("action", nargs="?", choices=["show", "set", "rebuild"], default="show")
+    parser.add_argument("name", type=str, nargs="?", help="user, or group with --group")
+    parser.add_argument("limit", type=str, nargs="?", help="like 500K, 10M or none")
+    parser.add_argument("--group", action="store_true")
+    parser.add_argument("--workers", type=int, default=4)
+
+    parser = parsers["audit"] = argparse.ArgumentParser(prog="audit")
+    parser.add_argument("--user", type=str)
+    parser.add_argument("--path", type=str)
+    parser.add_argument("--op", type=str, help="command, like cat or echo")
+    parser.add_argument("--since", type=str, help="ISO date or 30s, 10m, 2h, 7d ago")
+    parser.add_argument("--until", type=str)
+    parser.add_argument("--limit", type=int, default=50)
+
+    parser = parsers["snapshot"] = argparse.ArgumentParser(prog="snapshot")
+    parser.add_argument("action", choices=["create", "list", "restore", "remove", "ls", "cat"])
+    parser.add_argument("name", type=str, nargs="?")
+    parser.add_argument("path", type=str, nargs="?", help="for ls and cat, relative to the current directory")
+
+    parser = parsers["replica"] = argparse.ArgumentParser(prog="replica")
+    parser.add_argument("action", nargs="?", choices=["status", "sync", "verify"], default="status")
+    parser.add_argument("--deep", action="store_true", help="have the standby re-read its blobs")
+
+    parser = parsers["chp"] = argparse.ArgumentParser(prog="chp")
+    parser.add_argument("file_path", type=str)
+    parser.add_argument("--choice", choices=["1", "2", "3"])
+
+    parser = parsers["update_group"] = argparse.ArgumentParser(prog="update_group")
+    parser.add_argument("group_name", type=str)
+    parser.add_argument("--add", type=str, nargs="+", default=[])
+    parser.add_argument("--remove", type=str, nargs="+", default=[])
+
+    parser = parsers["rotate_key"] = argparse.ArgumentParser(prog="rotate_key")
+    parser.add_argument("action", choices=["start", "resume", "status"])
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--rate", type=float, default=0)
+
+    return parsers
+
+
+PARSERS = buildParsers()
+
 
 class CLI(cmd.Cmd):
     # These are automatically set by cmd.Cmd
@@ -23,6 +146,142 @@ class CLI(cmd.Cmd):
     curr_dir = ""
     # users = Users("json/users.example.json")
     users = Users("json/encrypted_users.json")
+    sessions = Sessions(users)
+    writeback = WriteBack({"graph": graph, "users": users})
+    prefetcher = Prefetcher(graph)
+    audit = AuditLog()
+    snapshots = Snapshots(graph, users, writeback)
+    replicator = Replicator.fromEnv(graph, users, writeback)
+    # (user, path, result) of the running command, for the audit log
+    access = None
+    # line number of the script command runScript is running, stdin is the
+    # script then and can't answer prompts
+    batch = None
+    failed = False
+    rotation = None
+    session_profile = None
+
+    def preloop(self):
+        self.session_profile = sessionProfile()
+
+        if recovered := self.writeback.recover():
+            print(f"Recovered {recovered} metadata changes from the redo log")
+
+        # usage is derived from the rollups, after recovery brought them up to date
+        self.users.setUsage(self.graph.usageByOwner())
+        self.graph.accounting = self.users
+
+        fileio.writeListeners.append(self.writeback.fileWritten)
+        self.writeback.start()
+        self.audit.start()
+
+        if self.replicator is not None:
+            self.replicator.attach()
+            self.replicator.start()
+
+    def onecmd(self, line):
+        "Runs a command, recording its latency"
+        command, _, _ = self.parseline(line)
+
+        if not command or not hasattr(self, f"do_{command}"):
+            return super().onecmd(line)
+
+        self.access = None
+        start = time.perf_counter()
+
+        # the background commit waits for the command to finish
+        with self.writeback.lock, stats.timer(f"cmd.{command}"):
+            stop = super().onecmd(line)
+
+        self.recordAccess(command, time.perf_counter() - start)
+        return stop
+
+    def runScript(self, lines, commitEvery: int = 0) -> int:
+        """Runs commands without a prompt, returns the number of invalid lines,
+        counting commands that lacked an argument they'd have prompted for.
+        Every line is parsed up front and nothing runs if one is invalid.
+        Metadata is committed once at the end, or every commitEvery commands.
+        """
+
+        commands = []
+        failures = 0
+        for number, line in enumerate(lines, 1):
+            if not (line := line.strip()) or line.startswith("#"):
+                continue
+
+            command, arg, _ = self.parseline(line)
+
+            if not command or not hasattr(self, f"do_{command}"):
+                print(f"Line {number}: unknown command {command}")
+                failures += 1
+                continue
+
+            if command in PARSERS and (arg := tryParse(PARSERS[command], arg)) is None:
+                print(f"Line {number}: invalid arguments for {command}")
+                failures += 1
+                continue
+
+            commands.append((number, command, arg))
+
+        if failures:
+            return failures
+
+        writeback = self.writeback
+        settings = writeback.window, writeback.maxOps, writeback.syncLog
+        writeback.window, writeback.maxOps, writeback.syncLog = 0, commitEvery, False
+        try:
+            for number, command, arg in commands:
+                self.access = None
+                self.batch, self.failed = number, False
+                start = time.perf_counter()
+
+                with writeback.lock, stats.timer(f"cmd.{command}"):
+                    stop = getattr(self, f"do_{command}")(arg)
+
+                self.recordAccess(command, time.perf_counter() - start)
+                failures += self.failed
+
+                if stop:
+                    break
+        finally:
+            self.batch = None
+            writeback.window, writeback.maxOps, writeback.syncLog = settings
+            self.commit()
+
+        return failures
+
+    def canPrompt(self, command: str) -> bool:
+        "Returns if missing arguments can be asked for, failing the line in batch mode"
+        if self.batch is None:
+            return True
+
+        print(f"Line {self.batch}: missing arguments, {PARSERS[command].format_usage().strip()}")
+        self.failed = True
+        return False
+
+    def commit(self):
+        "Writes out metadata changes held back by the write-back layer"
+        self.writeback.commit()
+
+    def audited(self, path: str, result: str = "ok", user: Optional[str] = None):
+        "Notes the node and outcome of the running command for the audit log"
+        self.access = (user or self.user.name, path, result)
+
+    def recordAccess(self, command: str, seconds: float):
+        "Hands the access of a finished command to the audit log, if it made one"
+        if self.access is None:
+            return
+
+        user, path, result = self.access
+        self.access = None
+        self.audit.record(user, command, path, result, seconds)
+
+    def parseArgs(self, command: str, line) -> Optional[argparse.Namespace]:
+        "Parses a command line, lines parsed ahead of time by runScript pass through"
+        if isinstance(line, argparse.Namespace):
+            return line
+
+        return tryParse(PARSERS[command], line)
 
     def convertToAbsolutePath(self, path: str) -> str:
         "Converts a relative path to an absolute path"
@@ -45,24 +304,29 @@ class CLI(cmd.Cmd):
 
         return "/".join(out)
 
-    def do_login(self, _):
-        "Login to the system. Usage: login"
+    def do_login(self, line):
+        "Login to the system. Usage: login [username] [--password <password>]"
 
         if self.user:
             print("Please logout first")
             return
 
-        username = input("Enter username: ")
-        password = getpass.getpass("Enter password: ")
+        if (args := self.parseArgs("login", line)) is None:
+            return
+        if not (args.username and args.password) and not self.canPrompt("login"):
+            return
+
+        username = args.username or input("Enter username: ")
+        password = args.password or getpass.getpass("Enter password: ")
 
         if username not in self.users.users:
             print("User not found")
+            self.audited("", "missing", username)
             return
 
-        if not bcrypt.checkpw(
-            password.encode(), self.users.users[username].password.encode()
-        ):
+        if not self.users.checkPassword(username, password):
             print("Invalid password")
+            self.audited("", "denied", username)
             return
 
         self.user = self.users.users[username]
@@ -70,9 +334,43 @@ class CLI(cmd.Cmd):
         self.prompt = prompt_template.format(
             user=self.user.name, curr_dir=self.curr_dir
         )
+        self.sessions.issue(self.user)
 
         print(f"Logged in as {self.user.name}")
+        self.audited(self.curr_dir)
+
+        self.checkIntegrity()
+        self.prefetcher.warm(self.curr_dir, self.user)
+
+    def do_resume(self, line):
+        "Resume the last login without a password. Usage: resume [--check]"
+
+        if self.user:
+            print("Please logout first")
+            return
+
+        if (args := self.parseArgs("resume", line)) is None:
+            return
+
+        if (user := self.sessions.resume()) is None:
+            print("No valid session, please login")
+            return
+
+        self.user = user
+        self.curr_dir = f"{self.user.name}" if not self.user.isAdmin else ""
+        self.prompt = prompt_template.format(
+            user=self.user.name, curr_dir=self.curr_dir
+        )
 
+        print(f"Resumed session of {self.user.name}")
+        self.audited(self.curr_dir)
+
+        if args.check:
+            self.checkIntegrity()
+        self.prefetcher.warm(self.curr_dir, self.user)
+
+    def checkIntegrity(self):
+        "Reports corrupted files under the current directory"
         failures = self.graph.checkPathIntegrity(self.curr_dir)
 
         if failures:
@@ -81,16 +379,24 @@ class CLI(cmd.Cmd):
         else:
             print("No corrupted files found ✅")
 
-    def do_register(self, _):
-        "Register a new user. Usage: register"
+    def do_register(self, line):
+        "Register a new user. Usage: register [username] [--password <password>]"
 
         if self.user:
             print("Please logout first")
             return
 
-        username = input("Enter username: ")
-        password = getpass.getpass("Enter password: ")
-        confirm_password = getpass.getpass("Confirm password: ")
+        if (args := self.parseArgs("register", line)) is None:
+            return
+        if not (args.username and args.password) and not self.canPrompt("register"):
+            return
+
+        username = args.username or input("Enter username: ")
+        if args.password:
+            password = confirm_password = args.password
+        else:
+            password = getpass.getpass("Enter password: ")
+            confirm_password = getpass.getpass("Confirm password: ")
 
         if username in self.users.users:
             print("User already exists")
@@ -100,8 +406,7 @@ class CLI(cmd.Cmd):
             print("Passwords don't match")
             return
 
-        hashedPass = bcrypt.hashpw(password.encode(), bcrypt.gensalt())
-        self.users.createUser(username, hashedPass.decode())
+        self.users.createUser(username, hashPassword(password))
 
         self.user = self.users.users[username]
 
@@ -109,6 +414,7 @@ class CLI(cmd.Cmd):
         self.prompt = prompt_template.format(
             user=self.user.name, curr_dir=self.curr_dir
         )
+        self.sessions.issue(self.user)
 
         self.graph.initUserDirectory(self.user.name)
 
@@ -116,6 +422,9 @@ class CLI(cmd.Cmd):
 
     def do_logout(self, _):
         "Logout of the system"
+        self.prefetcher.cancel()
+        self.sessions.revoke()
+        self.commit()
         self.user = None
         self.curr_dir = "/"
         self.prompt = "sfs> "
@@ -123,14 +432,76 @@ class CLI(cmd.Cmd):
 
     def do_quit(self, _):
         "Quit the CLI"
+        # the stored token would let whoever runs it next resume as this user
+        if self.user is not None:
+            self.sessions.revoke()
+        self.shutdown()
         return True
 
+    def shutdown(self):
+        "Commits pending writes, writes out metrics and the session profile, if enabled"
+        self.prefetcher.stop()
+        self.writeback.stop()
+        self.audit.stop()
+        if self.replicator is not None:
+            self.replicator.stop()
+
+        if METRICS_FILE:
+            stats.export(METRICS_FILE)
+
+        if self.session_profile is not None:
+            self.session_profile.stop()
+            print(f"Session profile written to {self.session_profile.save()}")
+            self.session_profile = None
+
+    def do_profile(self, line):
+        "Run a command under the profiler. Usage: profile [--memory] [--top N] <command ...>"
+        if (args := self.parseArgs("profile", line)) is None:
+            return
+
+        if not args.command:
+            print("Usage: profile [--memory] [--top N] <command ...>")
+            return
+
+        if self.session_profile is not None:
+            print("The whole session is already being profiled")
+            return
+
+        command = " ".join(args.command)
+        with Profile(command, trackMemory=args.memory) as profile:
+            stop = self.onecmd(command)
+
+        print(*profile.report(args.top), sep="\n")
+        print(f"Profile written to {profile.save()}")
+
+        return stop
+
+    def do_sync(self, _):
+        "Commit pending metadata and file writes to disk"
+        self.commit()
+        print("Synced")
+
+    def do_stats(self, line):
+        "Show per-command latency and crypto counters. Usage: stats [--reset] [--export <file>]"
+        if (args := self.parseArgs("stats", line)) is None:
+            return
+
+        if args.export:
+            stats.export(args.export)
+            print(f"Metrics written to {args.export}")
+        else:
+            print(*stats.report(), sep="\n")
+
+        if args.reset:
+            stats.reset()
+
     def do_ls(self, _):
         "List files in the current directory"
         if self.user is None:
             print("Please login first")
             return
 
+        self.audited(self.curr_dir)
         print(
             *self.graph.listDirectory(self.curr_dir, self.user),
             sep="\n",
@@ -142,49 +513,55 @@ class CLI(cmd.Cmd):
             print("Please login first")
             return
 
-        parser = argparse.ArgumentParser(prog="cd")
-        parser.add_argument("path", type=str)
-        if (args := tryParse(parser, line)) is None:
+        if (args := self.parseArgs("cd", line)) is None:
             return
 
         path = self.convertToAbsolutePath(args.path)
 
         if not (node := self.graph.getNodeFromPath(path)):
             print("Invalid path")
+            self.audited(path, "missing")
             return
 
         # now check if the user has access to the new directory
         if not node.isReadable(self.user):
             print("Access denied")
+            self.audited(path, "denied")
             return
 
         # now check if the node is a directory
         if not fileio.isFolder(path):
             print("Not a directory")
+            self.audited(path, "failed")
             return
 
+        self.audited(path)
         self.curr_dir = path
         self.prompt = prompt_template.format(
             user=self.user.name, curr_dir=self.curr_dir
         )
+        self.prefetcher.warm(self.curr_dir, self.user)
 
     def do_create_group(self, line):
-        "Create a new group. Usage: create_group <group_name>"
+        "Create a new group. Usage: create_group <group_name> [--users <user ...>]"
         if self.user is None or not self.user.isAdmin:
             print("You need to be an admin to run this command")
             return
-        parser = argparse.ArgumentParser(prog="create_group")
-        parser.add_argument("group_name", type=str)
-        if (args := tryParse(parser, line)) is None:
+        if (args := self.parseArgs("create_group", line)) is None:
             return
 
         if args.group_name in self.user.joinedGroups:
             print("Group already exists")
             return
 
-        added_users = input(
-            "Enter the names of the users to add to the group. Separate with a space: "
-        ).split()
+        if args.users is not None:
+            added_users = list(args.users)
+        elif not self.canPrompt("create_group"):
+            return
+        else:
+            added_users = input(
+                "Enter the names of the users to add to the group. Separate with a space: "
+            ).split()
         added_users.append(self.user.name)
 
         if self.users.addUsersToGroup(args.group_name, added_users):
@@ -197,9 +574,7 @@ class CLI(cmd.Cmd):
         if self.user is None or not self.user.isAdmin:
             print("You need to be an admin to run this command")
             return
-        parser = argparse.ArgumentParser(prog="create_group")
-        parser.add_argument("group_name", type=str)
-        if (args := tryParse(parser, line)) is None:
+        if (args := self.parseArgs("delete_group", line)) is None:
             return
 
         if args.group_name not in self.user.joinedGroups:
@@ -224,22 +599,29 @@ class CLI(cmd.Cmd):
         if self.user is None:
             print("Please login first")
             return
-        parser = argparse.ArgumentParser(prog="cat")
-        parser.add_argument("file_path", type=str)
-        if (args := tryParse(parser, line)) is None:
+        if (args := self.parseArgs("cat", line)) is None:
             return
 
         path = self.convertToAbsolutePath(args.file_path)
 
         if (node := self.graph.getNodeFromPath(path)) is None:
             print("Invalid path")
+            self.audited(path, "missing")
             return
 
         if not node.isReadable(self.user):
             print("Access denied")
+            self.audited(path, "denied")
             return
 
-        print(readFile(path))
+        self.audited(path)
+
+        # streamed, a large file is never held in memory as a whole
+        decoder = codecs.getincrementaldecoder("utf-8")()
+        for chunk in fileio.readChunks(path):
+            print(decoder.decode(chunk), end="")
+
+        print(decoder.decode(b"", final=True))
 
     def do_mv(self, line):
         "Rename a file or directory. Usage: mv <source> <name>"
@@ -247,23 +629,22 @@ class CLI(cmd.Cmd):
             print("Please login first")
             return
 
-        parser = argparse.ArgumentParser(prog="mv")
-        parser.add_argument("source", type=str)
-        parser.add_argument("name", type=str)
-        if (args := tryParse(parser, line)) is None:
+        if (args := self.parseArgs("mv", line)) is None:
             return
 
         source = self.convertToAbsolutePath(args.source)
 
         if (node := self.graph.getNodeFromPath(source)) is None:
             print("Invalid source path")
+            self.audited(source, "missing")
             return
 
         if not node.isWritable(self.user):
             print("Access denied")
+            self.audited(source, "denied")
             return
 
-        self.graph.renameNode(source, args.name)
+        self.audited(source, "ok" if self.graph.renameNode(source, args.name) else "failed")
 
     def do_mkdir(self, line):
         "Create a new directory. Usage: mkdir <dir_name>"
@@ -271,18 +652,17 @@ class CLI(cmd.Cmd):
             print("Please login first")
             return
 
-        parser = argparse.ArgumentParser(prog="mkdir")
-        parser.add_argument("dir_name", type=str)
-        if (args := tryParse(parser, line)) is None:
+        if (args := self.parseArgs("mkdir", line)) is None:
             return
 
         path = self.convertToAbsolutePath(args.dir_name)
 
         if self.graph.getNodeFromPath(path) is not None:
             print("Directory already exists")
+            self.audited(path, "failed")
             return
 
-        self.graph.createFolder(path, self.user)
+        self.audited(path, "ok" if self.graph.createFolder(path, self.user) else "failed")
 
     def do_touch(self, line):
         "Create a new directory. Usage: touch <file_path>"
@@ -290,19 +670,22 @@ class CLI(cmd.Cmd):
             print("Please login first")
             return
 
-        parser = argparse.ArgumentParser(prog="mkdir")
-        parser.add_argument("file_path", type=str)
-        if (args := tryParse(parser, line)) is None:
+        if (args := self.parseArgs("touch", line)) is None:
             return
 
         path = self.convertToAbsolutePath(args.file_path)
 
         if self.graph.getNodeFromPath(path) is not None:
             print("File already exists")
+            self.audited(path, "failed")
             return
 
         if not self.graph.createFile(path, self.user):
             print("File creation failed")
+            self.audited(path, "failed")
+            return
+
+        self.audited(path)
 
     def do_echo(self, line):
         "Overwrite a file. Usage: echo <file_path> <content>"
@@ -310,10 +693,7 @@ class CLI(cmd.Cmd):
             print("Please login first")
             return
 
-        parser = argparse.ArgumentParser(prog="echo")
-        parser.add_argument("file_path", type=str)
-        parser.add_argument("content", nargs="+", type=str)
-        if (args := tryParse(parser, line)) is None:
+        if (args := self.parseArgs("echo", line)) is None:
             return
 
         content = " ".join(args.content)
@@ -321,62 +701,394 @@ class CLI(cmd.Cmd):
 
         if (node := self.graph.getNodeFromPath(path)) is None:
             print("File does not exist")
+            self.audited(path, "missing")
             return
 
         if not node.isWritable(self.user):
             print("Access denied")
+            self.audited(path, "denied")
             return
 
-        fileio.writeFile(path, content)
+        if not self.graph.writeFile(path, content):
+            self.audited(path, "quota")
+            return
+
+        self.audited(path)
         print(f"Content written to {args.file_path}")
 
+    def do_rm(self, line):
+        "Remove a file or an empty directory. Usage: rm <path>"
+        if self.user is None:
+            print("Please login first")
+            return
+
+        if (args := self.parseArgs("rm", line)) is None:
+            return
+
+        path = self.convertToAbsolutePath(args.path)
+
+        if not path or (node := self.graph.getNodeFromPath(path)) is None:
+            print("Invalid path")
+            self.audited(path, "missing")
+            return
+
+        if not node.isWritable(self.user):
+            print("Access denied")
+            self.audited(path, "denied")
+            return
+
+        try:
+            self.graph.removeNode(path)
+        except OSError as e:
+            if e.errno == errno.ENOTEMPTY:
+                print("Directory not empty")
+            else:
+                print(f"Could not remove {path}: {e.strerror or e}")
+            self.audited(path, "failed")
+            return
+
+        self.audited(path)
+
+    def do_du(self, line):
+        "Show the space used below a path. Usage: du [path]"
+        if self.user is None:
+            print("Please login first")
+            return
+
+        if (args := self.parseArgs("du", line)) is None:
+            return
+
+        path = self.convertToAbsolutePath(args.path)
+
+        if (node := self.graph.getNodeFromPath(path)) is None:
+            print("Invalid path")
+            self.audited(path, "missing")
+            return
+
+        if not node.isReadable(self.user):
+            print("Access denied")
+            self.audited(path, "denied")
+            return
+
+        self.audited(path)
+        print(
+            f"{formatSize(node.size)}\t{formatSize(node.encryptedSize)} encrypted\t"
+            f"{node.files} files\t{path or '/'}"
+        )
+
+    def do_stat(self, line):
+        "Show the metadata of a file or directory. Usage: stat <path>"
+        if self.user is None:
+            print("Please login first")
+            return
+
+        if (args := self.parseArgs("stat", line)) is None:
+            return
+
+        path = self.convertToAbsolutePath(args.path)
+
+        if (node := self.graph.getNodeFromPath(path)) is None:
+            print("Invalid path")
+            self.audited(path, "missing")
+            return
+
+        if not node.isReadable(self.user):
+            print("Access denied")
+            self.audited(path, "denied")
+            return
+
+        self.audited(path)
+        print(f"Path: {path or '/'}")
+        print(f"Type: {'directory' if node.isFolder else 'file'}")
+        print(f"Owner: {node.owner}")
+        print(f"Size: {node.size} bytes ({node.encryptedSize} encrypted)")
+        if node.isFolder:
+            print(f"Files: {node.files}")
+        print(f"Modified: {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(node.mtime))}")
+
+    def do_quota(self, line):
+        "Show or set storage quotas. Usage: quota [show [name]] | set <name> <limit> [--group] | rebuild"
+        if self.user is None:
+            print("Please login first")
+            return
+
+        if (args := self.parseArgs("quota", line)) is None:
+            return
+
+        if args.action != "show" and not self.user.isAdmin:
+            print("You need to be an admin to run this command")
+            return
+
+        if args.action == "rebuild":
+            quota.rebuild(self.graph, self.users, args.workers)
+            self.writeback.dumpStore(self.graph)
+            print(*quota.report(self.users), sep="\n")
+            return
+
+        if args.action == "set":
+            if args.name is None or args.limit is None:
+                print("Usage: quota set <name> <limit> [--group]")
+                return
+
+            try:
+                limit = parseSize(args.limit)
+            except ValueError:
+                print(f"Invalid limit {args.limit}")
+                return
+
+            if args.group:
+                self.users.setGroupQuota(args.name, limit)
+            elif args.name in self.users.users:
+                self.users.setQuota(args.name, limit)
+            else:
+                print(f"User {args.name} not found")
+                return
+
+            print(f"Quota of {args.name} set to {args.limit}")
+            return
+
+        if args.group:
+            if args.name is None:
+                print("Usage: quota show <group> --group")
+                return
+
+            if args.name not in self.user.joinedGroups and not self.user.isAdmin:
+                print("Access denied")
+                return
+
+            limit = self.users.groupQuotas.get(args.name)
+            used = self.users.groupUsage(args.name)
+        else:
+            name = args.name or self.user.name
+            if name != self.user.name and not self.user.isAdmin:
+                print("Access denied")
+                return
+
+            if (user := self.users.users.get(name)) is None:
+                print(f"User {name} not found")
+                return
+
+            limit, used = user.quota, user.used
+
+        print(f"{formatSize(used)} of {'unlimited' if limit is None else formatSize(limit)} used")
+
+    def do_audit(self, line):
+        "Query the access log. Usage: audit [--user U] [--path P] [--op OP] [--since T] [--until T] [--limit N]"
+        if self.user is None or not self.user.isAdmin:
+            print("You need to be an admin to run this command")
+            return
+        if (args := self.parseArgs("audit", line)) is None:
+            return
+
+        try:
+            since = args.since and parseTime(args.since)
+            until = args.until and parseTime(args.until)
+        except ValueError:
+            print("Invalid time, use an ISO date or a duration like 10m, 2h or 7d")
+            return
+
+        path = args.path and self.convertToAbsolutePath(args.path)
+        events = self.audit.query(args.user, path, args.op, since, until, args.limit)
+        # reading the log is an access too
+        self.audited(path or "")
+
+        if not events:
+            print("No matching events")
+            return
+
+        print(*map(formatEvent, events), sep="\n")
+
+    def do_snapshot(self, line):
+        "Take, restore or browse snapshots. Usage: snapshot create [name] | list | restore <name> | remove <name> | ls <name> [path] | cat <name> <path>"
+        if self.user is None:
+            print("Please login first")
+            return
+
+        if (args := self.parseArgs("snapshot", line)) is None:
+            return
+
+        if args.action in ["create", "restore", "remove"] and not self.user.isAdmin:
+            print("You need to be an admin to run this command")
+            return
+
+        if args.action == "list":
+            if not (manifests := self.snapshots.list()):
+                print("No snapshots")
+
+            for manifest in manifests:
+                created = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(manifest["created"]))
+                print(f"{manifest['name']:<32}{created}  {manifest['files']} files  {formatSize(manifest['size'])}")
+            return
+
+        if args.action == "create":
+            try:
+                manifest = self.snapshots.create(args.name)
+            except ValueError as e:
+                print(e)
+                return
+            except FileExistsError:
+                print(f"Snapshot {args.name} already exists")
+                return
+
+            self.audited("")
+            print(f"Snapshot {manifest['name']} created, {manifest['blobs']} files shared with the tree")
+            return
+
+        if args.name is None:
+            print(f"Usage: snapshot {args.action} <name>")
+            return
+
+        try:
+            if args.action == "restore":
+                before = self.snapshots.restore(args.name)
+                self.audited("")
+
+                # the in memory user and directory may be gone or changed
+                self.prefetcher.cancel()
+                self.user = self.users.users.get(self.user.name, self.user)
+                if self.graph.getNodeFromPath(self.curr_dir) is None:
+                    self.curr_dir = f"{self.user.name}" if not self.user.isAdmin else ""
+                    self.prompt = prompt_template.format(user=self.user.name, curr_dir=self.curr_dir)
+
+                print(f"Restored snapshot {args.name}, the previous state is kept as {before}")
+                return
+
+            if args.action == "remove":
+                self.snapshots.remove(args.name)
+                print(f"Snapshot {args.name} removed")
+                return
+
+            view = self.snapshots.open(args.name)
+        except FileNotFoundError:
+            print(f"Snapshot {args.name} not found")
+            return
+
+        path = self.convertToAbsolutePath(args.path or ".")
+
+        if path not in view.nodes:
+            print("Invalid path")
+            self.audited(path, "missing")
+            return
+
+        if not view.isReadable(path, self.user):
+            print("Access denied")
+            self.audited(path, "denied")
+            return
+
+        self.audited(path)
+
+        if args.action == "ls":
+            print(*(view.listDirectory(path, self.user) or []), sep="\n")
+            return
+
+        try:
+            decoder = codecs.getincrementaldecoder("utf-8")()
+            for chunk in view.readChunks(path):
+                print(decoder.decode(chunk), end="")
+
+            print(decoder.decode(b"", final=True))
+        except IsADirectoryError:
+            print("Not a file")
+
+    def do_replica(self, line):
+        "Show or check replication to the standby. Usage: replica [status | sync | verify] [--deep]"
+        if self.user is None or not self.user.isAdmin:
+            print("You need to be an admin to run this command")
+            return
+        if (args := self.parseArgs("replica", line)) is None:
+            return
+
+        if self.replicator is None:
+            print("Replication is off, set SFS_REPLICA_PATH to a standby directory")
+            return
+
+        if args.action == "sync":
+            # compares digests and ships only what differs
+            print(f"{self.replicator.sync(args.deep)} records shipped")
+            return
+
+        if args.action == "verify":
+            if problems := self.replicator.verify(args.deep):
+                print("Standby differs:", *problems, sep="\n")
+            else:
+                print("Standby is consistent")
+            return
+
+        lag = self.replicator.lag()
+        shipped = (
+            "never"
+            if lag["shippedAt"] is None
+            else f"{time.time() - lag['shippedAt']:.1f}s ago"
+        )
+        print(f"Standby: {self.replicator.transport}")
+        print(f"Sequence: {lag['seq']}, standby at {lag['standbySeq']}")
+        print(f"Pending: {lag['pending']} changes, {lag['seconds']:.1f}s behind")
+        print(f"Last shipped: {shipped}")
+        if lag["needsSync"]:
+            print("A full sync is due")
+
     def do_chp(self, line):
-        "Change a file's permissions. Usage: chp <file_path>"
+        "Change a file's permissions. Usage: chp <file_path> [--choice 1|2|3]"
         if self.user is None:
             print("Please login first")
             return
 
-        parser = argparse.ArgumentParser(prog="chp")
-        parser.add_argument("file_path", type=str)
-        if (args := tryParse(parser, line)) is None:
+        if (args := self.parseArgs("chp", line)) is None:
             return
 
         path = self.convertToAbsolutePath(args.file_path)
 
         if (node := self.graph.getNodeFromPath(path)) is None:
             print("File does not exist")
+            self.audited(path, "missing")
             return
 
         if not node.isOwner(self.user):
             print("You are not the owner of this file.")
+            self.audited(path, "denied")
             return
 
-        print("Change file permissions:")
-        print("1. Only the owner can read/write.")
-        print("2. All groups that the owner is a part of can read/write.")
-        print("3. All users can read/write.")
+        if args.choice is None and not self.canPrompt("chp"):
+            return
 
-        while (choice := input("Enter choice: ")) not in ["1", "2", "3"]:
-            print("Invalid choice")
+        if (choice := args.choice) is None:
+            print("Change file permissions:")
+            print("1. Only the owner can read/write.")
+            print("2. All groups that the owner is a part of can read/write.")
+            print("3. All users can read/write.")
+
+            while (choice := input("Enter choice: ")) not in ["1", "2", "3"]:
+                print("Invalid choice")
 
         self.graph.changePermissions(choice, path, self.user)
+        self.audited(path)
 
-        self.graph.dump()
+        self.graph.save()
 
     def do_update_group(self, line):
-        "Update an existing group. Usage update_group <group_name>"
+        "Update an existing group. Usage update_group <group_name> [--add <user ...>] [--remove <user ...>]"
         if self.user is None or not self.user.isAdmin:
             print("You need to be an admin to run this command")
             return
-        parser = argparse.ArgumentParser(prog="create_group")
-        parser.add_argument("group_name", type=str)
-        if (args := tryParse(parser, line)) is None:
+        if (args := self.parseArgs("update_group", line)) is None:
             return
 
         if args.group_name not in self.user.joinedGroups:
             print("Group doesn't exist")
             return
 
+        if args.add or args.remove:
+            if args.add:
+                self.users.addUsersToGroup(args.group_name, args.add)
+            if args.remove:
+                self.users.deleteUsersFromGroup(args.group_name, args.remove)
+
+            print(f"Group {args.group_name} updated")
+            return
+
+        if not self.canPrompt("update_group"):
+            return
+
         # while loop to update
         print(
             "Enter add <usernames> to add a user to the group. Separate usernames by a space"
@@ -404,10 +1116,81 @@ class CLI(cmd.Cmd):
 
         print(f"Group {args.group_name} updated")
 
-    def do_EOF(self, _):
+    def do_rotate_key(self, line):
+        "Rotate the encryption key in the background. Usage: rotate_key start|resume|status"
+        if self.user is None or not self.user.isAdmin:
+            print("You need to be an admin to run this command")
+            return
+        if (args := self.parseArgs("rotate_key", line)) is None:
+            return
+
+        if args.action == "status":
+            if self.rotation is None:
+                print("No key rotation has been started")
+                return
+
+            progress = self.rotation.progress()
+            print(
+                f"Rotation {progress['state']}: {progress['done']}/{progress['total']} "
+                f"({progress['percent']:.1f}%), {progress['rotated']} re-encrypted, "
+                f"{progress['failed']} failed, {progress['rate']:.1f} entries/s"
+            )
+            return
+
+        if self.rotation is not None and self.rotation.state == "running":
+            print("A key rotation is already running")
+            return
+
+        if args.action == "start":
+            Encryptor().addKey()
+            print("New primary key added, old keys kept for decryption")
+
+        self.rotation = RotationJob(
+            self.writeback, workers=args.workers, rate=args.rate, audit=self.audit
+        )
+        self.rotation.start()
+        print("Re-encryption started, use rotate_key status to follow it")
+
+    def do_EOF(self, line):
         "Quit the CLI"
-        return True
+        return self.do_quit(line)
 
 
 if __name__ == "__main__":
-    CLI().cmdloop()
+    parser = argparse.ArgumentParser(prog="main.py")
+    parser.add_argument("--script", type=str, help="run commands from a file, - for stdin")
+    parser.add_argument(
+        "--commit-every",
+        type=int,
+        default=0,
+        help="commit metadata every N commands instead of once at the end",
+    )
+    args = parser.parse_args()
+
+    cli = CLI()
+
+    def onSignal(signum, _):
+        cli.shutdown()
+        sys.exit(128 + signum)
+
+    signal.signal(signal.SIGTERM, onSignal)
+    signal.signal(signal.SIGHUP, onSignal)
+
+    if args.script is None and sys.stdin.isatty():
+        try:
+            cli.cmdloop()
+        except KeyboardInterrupt:
+            cli.shutdown()
+    else:
+        script = sys.stdin if args.script in [None, "-"] else open(args.script)
+
+        cli.preloop()
+        failures = 1  # interrupted
+        try:
+            failures = cli.runScript(script, args.commit_every)
+        except KeyboardInterrupt:
+            print("Interrupted")
+        finally:
+            cli.shutdown()
+
+        sys.exit(1 if failures else 0)
@@ -0,0 +1,157 @@
+import os
+import threading
+from typing import Optional
+
+import fileio
+from graph import Graph
+from stats import stats
+from user import User
+
+PREFETCH = os.environ.get("SFS_PREFETCH", "1") != "0"
+# Directory listings warmed per cd/login
+PREFETCH_ENTRIES = int(os.environ.get("SFS_PREFETCH_ENTRIES", 256))
+# Bytes of small files decrypted ahead into the content cache, 0 to only warm names
+PREFETCH_BYTES = int(os.environ.get("SFS_PREFETCH_BYTES", 4 * 1024 * 1024))
+
+
+class Prefetcher:
+    """Warms the caches of fileio for the directory a user just moved to.
+
+    After cd or login a worker thread resolves the directory, decrypts the
+    names of the directory, its sub directories and its parent (where the next
+    ls or cd likely goes), and reads the small files the user can read into
+    the content cache. Work stops once the budgets are spent or the user moves
+    elsewhere, each step is one short fileio call so commands never wait long
+    for the tree lock.
+    """
+
+    def __init__(
+        self,
+        graph: Graph,
+        maxEntries: int = PREFETCH_ENTRIES,
+        maxBytes: int = PREFETCH_BYTES,
+        enabled: bool = PREFETCH,
+    ) -> None:
+        self.graph = graph
+        self.maxEntries = maxEntries
+        self.maxBytes = maxBytes
+        self.enabled = enabled
+
+        self.target: Optional[tuple[str, User]] = None
+        self.generation = 0
+        self.idle = threading.Event()
+        self.idle.set()
+
+        self._wake = threading.Condition()
+        self._stop = False
+        self._thread: Optional[threading.Thread] = None
+
+    def __repr__(self) -> str:
+        return f"Prefetcher(target={self.target and self.target[0]}, enabled={self.enabled})"
+
+    def warm(self, path: str, user: User):
+        "Cancels any running prefetch and starts one for path"
+        if not self.enabled:
+            return
+
+        with self._wake:
+            self.generation += 1
+            self.target = (path, user)
+            self.idle.clear()
+            self._wake.notify()
+
+        if self._thread is None:
+            self._thread = threading.Thread(target=self.run, daemon=True)
+            self._thread.start()
+
+    def cancel(self):
+        with self._wake:
+            self.generation += 1
+            self.target = None
+
+    def stop(self):
+        with self._wake:
+            self._stop = True
+            self.generation += 1
+            self._wake.notify()
+
+        if self._thread is not None:
+            self._thread.join(timeout=1)
+            self._thread = None
+
+    def run(self):
+        while True:
+            with self._wake:
+                while self.target is None and not self._stop:
+                    self.idle.set()
+                    self._wake.wait()
+
+                if self._stop:
+                    self.idle.set()
+                    return
+
+                (path, user), generation = self.target, self.generation
+                self.target = None
+
+            try:
+                self.prefetch(path, user, generation)
+            except Exception:
+                # best effort, the command itself reports real errors
+                stats.incr("prefetch.errors")
+
+    def cancelled(self, generation: int) -> bool:
+        return generation != self.generation
+
+    def prefetch(self, path: str, user: User, generation: int):
+        entries, spent = 0, 0
+        dirs = [path]
+        if path:
+            dirs.append(path.rpartition("/")[0])
+
+        files = []
+        for i, dir in enumerate(dirs):
+            if self.cancelled(generation):
+                stats.incr("prefetch.cancelled")
+                return
+            if entries >= self.maxEntries:
+                break
+
+            if (node := self.graph.getNodeFromPath(dir)) is None or not node.isReadable(user):
+                continue
+
+            try:
+                listing = fileio.readPath(dir)
+            except (FileNotFoundError, NotADirectoryError):
+                continue
+            entries += 1
+
+            for entry in listing:
+                child = "/".join(p for p in [dir, entry.name] if p)
+                if entry.isFolder:
+                    # one level down from the current directory only
+                    if i == 0:
+                        dirs.append(child)
+                elif i == 0:
+                    files.append(child)
+
+        for child in files:
+            if self.cancelled(generation):
+                stats.incr("prefetch.cancelled")
+                return
+
+            node = self.graph.getNodeFromPath(child)
+            if node is None or not node.isReadable(user):
+                continue
+            if node.size > fileio.CONTENT_CACHE_FILE_MAX or spent + node.size > self.maxBytes:
+                continue
+
+            try:
+                fileio.readFile(child)
+            except Exception:
+                continue
+
+            spent += node.size
+            stats.incr("prefetch.files")
+            stats.incr("prefetch.bytes", node.size)
+
+        stats.incr("prefetch.dirs", entries)
@@ -0,0 +1,106 @@
+import cProfile
+import io
+import os
+import pstats
+import time
+import tracemalloc
+from typing import Optional
+
+from stats import stats
+
+PROFILE_DIR = "profiles"
+
+# SFS_PROFILE=1 profiles the whole session, SFS_PROFILE=memory also traces allocations
+SESSION_ENV = "SFS_PROFILE"
+
+
+class Profile:
+    "Runs a block under cProfile and, optionally, tracemalloc"
+
+    def __init__(self, name: str, trackMemory: bool = False) -> None:
+        self.name = name
+        self.trackMemory = trackMemory
+        self.profiler = cProfile.Profile()
+        self.elapsed = 0.0
+        self.cryptoOps: dict[str, int] = {}
+        self.memoryPeak = 0
+        self.memoryTop: list[tracemalloc.Statistic] = []
+
+    def __repr__(self) -> str:
+        return f"Profile(name={self.name}, elapsed={self.elapsed:.3f})"
+
+    def __enter__(self) -> "Profile":
+        self.start()
+        return self
+
+    def __exit__(self, *_):
+        self.stop()
+
+    def start(self):
+        self._counters = dict(stats.counters)
+
+        if self.trackMemory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._ownsTracing = True
+        else:
+            self._ownsTracing = False
+
+        if self.trackMemory:
+            tracemalloc.reset_peak()
+
+        self._start = time.perf_counter()
+        self.profiler.enable()
+
+    def stop(self):
+        self.profiler.disable()
+        self.elapsed = time.perf_counter() - self._start
+
+        self.cryptoOps = {
+            name: stats.counters.get(name, 0) - self._counters.get(name, 0)
+            for name in ["encrypt", "decrypt", "encrypt_bytes", "decrypt_bytes"]
+        }
+
+        if self.trackMemory:
+            _, self.memoryPeak = tracemalloc.get_traced_memory()
+            self.memoryTop = tracemalloc.take_snapshot().statistics("lineno")[:10]
+
+            if self._ownsTracing:
+                tracemalloc.stop()
+
+    def report(self, top: int = 15) -> list[str]:
+        "Returns the hotspots sorted by cumulative time"
+        out = io.StringIO()
+        pstats.Stats(self.profiler, stream=out).sort_stats("cumulative").print_stats(top)
+
+        lines = [
+            f"{self.name}: {self.elapsed * 1000:.2f} ms, "
+            f"{self.cryptoOps['encrypt']} Fernet encryptions ({self.cryptoOps['encrypt_bytes']} bytes), "
+            f"{self.cryptoOps['decrypt']} Fernet decryptions ({self.cryptoOps['decrypt_bytes']} bytes)"
+        ]
+
+        if self.trackMemory:
+            lines.append(f"Peak traced memory: {self.memoryPeak / 1024:.1f} KiB")
+            lines.extend(str(stat) for stat in self.memoryTop)
+
+        lines.extend(line for line in out.getvalue().splitlines() if line.strip())
+        return lines
+
+    def save(self, directory: str = PROFILE_DIR) -> str:
+        "Writes the pstats file and returns its path"
+        os.makedirs(directory, exist_ok=True)
+
+        name = "".join(c if c.isalnum() else "_" for c in self.name)
+        path = os.path.join(directory, f"{name}-{time.strftime('%Y%m%d-%H%M%S')}.pstats")
+
+        self.profiler.dump_stats(path)
+        return path
+
+
+def sessionProfile() -> Optional[Profile]:
+    "Starts a whole session profile if requested through the environment"
+    if not (mode := os.environ.get(SESSION_ENV)):
+        return None
+
+    profile = Profile("session", trackMemory=mode == "memory")
+    profile.start()
+    return profile
@@ -0,0 +1,58 @@
+import json
+
+from graph import Graph
+from user import Users
+from util import formatSize
+
+
+def rebuild(graph: Graph, users: Users, workers: int = 4) -> dict[str, int]:
+    """Recomputes the usage rollups and per user usage from the files on disk.
+    Only needed if the metadata went out of sync with files/, normal writes
+    keep both up to date. The graph has to be dumped afterwards. Returns the
+    bytes owned per user
+    """
+
+    graph.rebuildUsage(workers)
+    usage = graph.usageByOwner()
+    users.setUsage(usage)
+
+    return usage
+
+
+def report(users: Users) -> list[str]:
+    "A line per user and per group quota"
+    lines = []
+    for name, user in users.users.items():
+        limit = "unlimited" if user.quota is None else formatSize(user.quota)
+        lines.append(f"{name}: {formatSize(user.used)} of {limit}")
+
+    for group, quota in users.groupQuotas.items():
+        lines.append(
+            f"group {group}: {formatSize(users.groupUsage(group))} of {formatSize(quota)}"
+        )
+
+    return lines
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(prog="quota")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--json", action="store_true", help="print the usage as JSON")
+    args = parser.parse_args()
+
+    from writeback import WriteBack
+
+    graph = Graph("json/encrypted_permissions.json")
+    users = Users("json/encrypted_users.json")
+    # changes still in the redo log would be lost to the dump below
+    WriteBack({"graph": graph, "users": users}).recover()
+
+    usage = rebuild(graph, users, args.workers)
+    graph.dump()
+
+    if args.json:
+        print(json.dumps(usage, indent=2))
+    else:
+        print(*report(users), sep="\n")
@@ -0,0 +1,765 @@
+import hashlib
+import itertools
+import json
+import os
+import threading
+import time
+from abc import ABC, abstractmethod
+from typing import Optional
+
+import fileio
+import storage
+from encrypt import Encryptor
+from graph import Graph
+from stats import stats
+from user import GROUP_QUOTA_KEY, Users
+
+encryptor = Encryptor()
+
+# Standby directory of the local transport, replication is off without it
+REPLICA_PATH = os.environ.get("SFS_REPLICA_PATH")
+# Seconds changes wait before they're shipped
+REPLICA_INTERVAL = float(os.environ.get("SFS_REPLICA_INTERVAL", 1.0))
+# Queued records before the queue is dropped for a full sync
+REPLICA_JOURNAL = int(os.environ.get("SFS_REPLICA_JOURNAL", 100_000))
+# Contents per batch of a full sync
+REPLICA_BATCH_BYTES = int(os.environ.get("SFS_REPLICA_BATCH_BYTES", 16 * 1024 * 1024))
+
+STATE_PATH = "json/replica.state"
+STANDBY_STATE = "replica.json"
+
+
+def digest(data) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def treeDigest(digests: dict[str, Optional[str]]) -> str:
+    "One digest over every (path, digest) pair, equal trees give equal digests"
+    h = hashlib.sha256()
+    for path in sorted(digests):
+        h.update(f"{path} {digests[path]}\n".encode())
+
+    return h.hexdigest()
+
+
+def metadataDigest(store) -> str:
+    """Digest of the plaintext records of a Graph, Users or StandbyStore, their
+    ciphertext differs on every dump"""
+    if isinstance(store, Graph):
+        records = [node.dump() for node in store.nodes.values()]
+    elif isinstance(store, Users):
+        records = [user.dump() for user in store.users.values()] + [store.groupQuotas]
+    else:
+        records = list(store.records.values())
+        if store.groupQuotas is not None:
+            records.append(store.groupQuotas)
+
+    return digest("\n".join(sorted(json.dumps(record, sort_keys=True) for record in records)).encode())
+
+
+def movePaths(table: dict, path: str, newPath: str):
+    "Renames the entries of a path and everything below it"
+    for key in [k for k in table if k == path or k.startswith(path + "/")]:
+        table[newPath + key[len(path) :]] = table.pop(key)
+
+
+def walk(backend: storage.Backend) -> tuple[list[str], list[str]]:
+    "Returns every directory, parents first, and every blob of a backend"
+    dirs, blobs, pending = [], [], [""]
+
+    while pending:
+        parent = pending.pop(0)
+        for name, isDir in backend.listdir(parent):
+            path = storage.join(parent, name)
+            if isDir:
+                dirs.append(path)
+                pending.append(path)
+            else:
+                blobs.append(path)
+
+    return dirs, blobs
+
+
+class StandbyStore:
+    """A metadata file of the standby, kept as the plain records by name.
+
+    Loading it into a Graph or Users would intern the standby's principals
+    into the live tables and make every live ACL cache stale.
+    """
+
+    def __init__(self, jsonPath: str, isUsers: bool) -> None:
+        self.jsonPath = jsonPath
+        self.isEncrypted = encryptor.isEncrypted(jsonPath)
+
+        if self.isEncrypted:
+            data = encryptor.decryptJson(jsonPath)
+        else:
+            with open(jsonPath, "r") as f:
+                data = json.load(f)
+
+        # only the users file has group quotas, a plain list unless one is set
+        self.groupQuotas: Optional[dict[str, int]] = None
+        if isUsers:
+            self.groupQuotas = data.get("groupQuotas", {}) if isinstance(data, dict) else {}
+            data = data["users"] if isinstance(data, dict) else data
+
+        self.records: dict[str, dict] = {record["name"]: record for record in data}
+
+    def __repr__(self) -> str:
+        return f"StandbyStore(path={self.jsonPath}, records={len(self.records)})"
+
+    def applyChange(self, key: str, value: Optional[dict]):
+        "Applies a redo log record, like Graph.applyChange and Users.applyChange"
+        if self.groupQuotas is not None and key.startswith(GROUP_QUOTA_KEY):
+            if value["quota"] is None:
+                self.groupQuotas.pop(key[len(GROUP_QUOTA_KEY) :], None)
+            else:
+                self.groupQuotas[key[len(GROUP_QUOTA_KEY) :]] = value["quota"]
+        elif value is None:
+            self.records.pop(key, None)
+        else:
+            self.records[key] = value
+
+    def dump(self):
+        data = list(self.records.values())
+        if self.groupQuotas:
+            data = {"users": data, "groupQuotas": self.groupQuotas}
+
+        if self.isEncrypted:
+            encryptor.encryptJson(data, self.jsonPath)
+        else:
+            with open(self.jsonPath, "w") as f:
+                json.dump(data, f, indent=2)
+
+
+class Standby:
+    """The receiving end, a copy of files/ and the metadata in a directory.
+
+    Records carry increasing sequence numbers and the last applied one is
+    saved after every batch. Records at or below it are skipped, and every
+    operation tolerates having been applied already, so a batch sent twice
+    or resent after a crash halfway through changes nothing.
+    """
+
+    def __init__(self, path: str, metadataFiles: Optional[dict[str, str]] = None) -> None:
+        self.path = path
+        self.backend = storage.LocalBackend(os.path.join(path, "files"))
+        self.metadataPaths = {
+            name: os.path.join(path, "json", fileName)
+            for name, fileName in (
+                metadataFiles
+                or {"graph": "encrypted_permissions.json", "users": "encrypted_users.json"}
+            ).items()
+        }
+        self.stores: dict = {}
+
+        os.makedirs(self.backend.root, exist_ok=True)
+        os.makedirs(os.path.join(path, "json"), exist_ok=True)
+
+        try:
+            with open(os.path.join(path, STANDBY_STATE), "r") as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            state = {"seq": 0, "digests": {}, "needsSync": True}
+
+        self.seq: int = state["seq"]
+        self.digests: dict[str, str] = state["digests"]
+        self.needsSync: bool = state["needsSync"]
+        self.appliedAt: Optional[float] = state.get("appliedAt")
+
+    def __repr__(self) -> str:
+        return f"Standby(path={self.path}, seq={self.seq})"
+
+    def store(self, name: str):
+        "Loads a metadata store of the standby, None until the first full copy arrived"
+        if name not in self.stores:
+            if not os.path.exists(path := self.metadataPaths[name]):
+                return None
+
+            self.stores[name] = StandbyStore(path, isUsers=name == "users")
+
+        return self.stores[name]
+
+    def saveState(self):
+        path = os.path.join(self.path, STANDBY_STATE)
+        state = {
+            "seq": self.seq,
+            "digests": self.digests,
+            "needsSync": self.needsSync,
+            "appliedAt": self.appliedAt,
+        }
+
+        with open(path + ".tmp", "w") as f:
+            json.dump(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+
+        os.replace(path + ".tmp", path)
+
+    @stats.timed("replica.apply")
+    def apply(self, batch: list[dict]) -> int:
+        "Applies a batch in order, returns the last applied sequence number"
+        dirty = set()
+
+        for record in batch:
+            if record["seq"] <= self.seq:
+                continue
+
+            op, path = record["op"], record.get("path")
+            try:
+                if op == "mkdir":
+                    self.backend.mkdir(path)
+                elif op == "put":
+                    self.backend.write(path, record["data"])
+                    self.digests[path] = record["digest"]
+                elif op == "remove":
+                    self.digests.pop(path, None)
+                    self.backend.remove(path)
+                elif op == "rmdir":
+                    self.backend.rmdir(path)
+                elif op == "rename":
+                    self.backend.rename(path, record["newPath"])
+                    movePaths(self.digests, path, record["newPath"])
+                elif op == "meta":
+                    if (store := self.store(record["store"])) is None:
+                        self.needsSync = True
+                    else:
+                        for key, value in json.loads(encryptor.decrypt(record["data"])):
+                            store.applyChange(key, value)
+                        dirty.add(record["store"])
+                elif op == "metaFull":
+                    path = self.metadataPaths[record["store"]]
+                    with open(path + ".tmp", "wb") as f:
+                        f.write(record["data"])
+                    os.replace(path + ".tmp", path)
+
+                    self.stores.pop(record["store"], None)
+                    dirty.discard(record["store"])
+            except FileExistsError:
+                # applied before
+                pass
+            except FileNotFoundError:
+                # gone already, unless the parent of a new entry is missing
+                if op in ["mkdir", "put"]:
+                    self.needsSync = True
+            except OSError:
+                self.needsSync = True
+
+            self.seq = record["seq"]
+
+        for name in dirty:
+            self.stores[name].dump()
+
+        if batch and batch[-1].get("sync"):
+            self.needsSync = False
+
+        self.appliedAt = time.time()
+        self.saveState()
+        return self.seq
+
+    def state(self, full: bool = False, deep: bool = False) -> dict:
+        """Describes the standby. full adds every directory and blob digest,
+        deep recomputes the digests from the blobs instead of trusting the
+        recorded ones"""
+
+        state = {
+            "seq": self.seq,
+            "needsSync": self.needsSync,
+            "appliedAt": self.appliedAt,
+            "tree": treeDigest(self.digests),
+            "meta": {
+                name: metadataDigest(store)
+                for name in self.metadataPaths
+                if (store := self.store(name)) is not None
+            },
+        }
+
+        if full or deep:
+            dirs, blobs = walk(self.backend)
+            # forget blobs that vanished behind the standby's back
+            self.digests = {path: self.digests[path] for path in blobs if path in self.digests}
+            state["dirs"] = dirs
+            state["digests"] = {
+                path: digest(self.backend.read(path)) if deep else self.digests.get(path)
+                for path in blobs
+            }
+
+        return state
+
+
+class Transport(ABC):
+    """Carries batches to a standby and its state back.
+
+    Batch records are dicts of str, int and bytes (contents and encrypted
+    metadata), a transport over the network has to encode the bytes.
+    """
+
+    @abstractmethod
+    def send(self, batch: list[dict]) -> dict:
+        """Applies a batch on the standby, returns its last applied sequence
+        number as seq and needsSync if it found itself out of step"""
+
+    @abstractmethod
+    def state(self, full: bool = False, deep: bool = False) -> dict:
+        "Returns Standby.state() of the standby"
+
+
+class LocalTransport(Transport):
+    "A standby in a directory of this machine, another disk or a mount"
+
+    def __init__(self, path: str) -> None:
+        self.standby = Standby(path)
+
+    def __repr__(self) -> str:
+        return f"LocalTransport(path={self.standby.path})"
+
+    def send(self, batch: list[dict]) -> dict:
+        return {"seq": self.standby.apply(batch), "needsSync": self.standby.needsSync}
+
+    def state(self, full: bool = False, deep: bool = False) -> dict:
+        return self.standby.state(full, deep)
+
+
+class Replicator:
+    """Ships the changes of the tree and the metadata to a standby.
+
+    fileio reports every change to the tree and the write-back layer the
+    records of every metadata save. They're numbered and queued, a
+    background thread ships the queue every interval. Contents are read when
+    shipped rather than when written, so a file written ten times between
+    two ships is sent once and a file removed before then isn't sent at all.
+
+    A full sync compares digests with the standby and ships what differs.
+    Only blobs whose size or mtime changed since they were last shipped are
+    read for it. It runs on start, catching up on whatever a crash lost, and
+    whenever the queue overflowed or the standby asks for it.
+
+    Locks are always taken in the order writeback.lock, shipLock, treeLock,
+    commands already hold the first when they get here.
+    """
+
+    def __init__(
+        self,
+        graph: Graph,
+        users: Users,
+        writeback,
+        transport: Transport,
+        interval: float = REPLICA_INTERVAL,
+        maxJournal: int = REPLICA_JOURNAL,
+        statePath: str = STATE_PATH,
+    ) -> None:
+        self.stores = {"graph": graph, "users": users}
+        self.writeback = writeback
+        self.transport = transport
+        self.interval = interval
+        self.maxJournal = maxJournal
+        self.statePath = statePath
+
+        self.journal: list[dict] = []
+        self.needsSync = True
+        self.standbySeq = 0
+        self.shippedAt: Optional[float] = None
+
+        try:
+            with open(statePath, "r") as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            state = {"seq": 0, "files": {}}
+
+        self.seq: int = state["seq"]
+        # blob path to [size, mtimeNs, digest] as last shipped
+        self.files: dict[str, list] = state["files"]
+
+        self.lock = threading.Lock()  # the journal
+        self.shipLock = threading.RLock()  # one ship or sync at a time
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def __repr__(self) -> str:
+        return f"Replicator(transport={self.transport}, pending={len(self.journal)}, seq={self.seq})"
+
+    @staticmethod
+    def fromEnv(graph: Graph, users: Users, writeback) -> Optional["Replicator"]:
+        "Builds the replicator configured by SFS_REPLICA_PATH, None if replication is off"
+        if not REPLICA_PATH:
+            return None
+
+        return Replicator(graph, users, writeback, LocalTransport(REPLICA_PATH))
+
+    def attach(self):
+        "Starts listening to fileio and the write-back layer"
+        fileio.changeListeners.append(self.changed)
+        self.writeback.listeners.append(self.metadataSaved)
+
+    def append(self, record: dict):
+        with self.lock:
+            if self.needsSync:
+                # the next sync covers it
+                return
+
+            if len(self.journal) >= self.maxJournal:
+                # the sync drops the queue, only shipping ever shortens it
+                stats.incr("replica.overflows")
+                self.needsSync = True
+                return
+
+            self.seq += 1
+            self.journal.append(dict(record, seq=self.seq, time=time.time()))
+
+    def changed(self, op: str, path: str, newPath: Optional[str] = None):
+        "fileio change listener"
+        if op == "resync":
+            with self.lock:
+                self.needsSync = True
+            return
+
+        self.append({"op": "put" if op == "write" else op, "path": path, "newPath": newPath})
+
+    def metadataSaved(self, name: str, records: Optional[list]):
+        "Write-back listener"
+        if records is None:
+            self.append({"op": "metaFull", "store": name})
+        else:
+            self.append({"op": "meta", "store": name, "records": records})
+
+    def currentPath(self, index: int, path: str) -> Optional[str]:
+        """Follows the blob of a queued put through the changes queued after it.
+        Returns where it is now, None if it's removed or written again later,
+        then a later record ships it
+        """
+
+        for record in itertools.islice(self.journal, index + 1, None):
+            op = record["op"]
+            if op == "rename" and (path == record["path"] or path.startswith(record["path"] + "/")):
+                path = record["newPath"] + path[len(record["path"]) :]
+            elif op in ["put", "remove"] and path == record["path"]:
+                return None
+
+        return path
+
+    def saveState(self):
+        with open(self.statePath + ".tmp", "w") as f:
+            json.dump({"seq": self.seq, "files": self.files}, f)
+            f.flush()
+            os.fsync(f.fileno())
+
+        os.replace(self.statePath + ".tmp", self.statePath)
+
+    def shipped(self, batch: list[dict], files: dict[str, list]):
+        "Mirrors a batch the standby applied in the digests of what it holds"
+        for record in batch:
+            if record["op"] == "put":
+                files[record["path"]] = record["stat"]
+            elif record["op"] == "remove":
+                files.pop(record["path"], None)
+            elif record["op"] == "rename":
+                movePaths(files, record["path"], record["newPath"])
+
+    def send(self, batch: list[dict]) -> dict:
+        # the primary's own bookkeeping stays behind
+        wire = [
+            {k: v for k, v in record.items() if k not in ["stat", "time", "records"]}
+            for record in batch
+        ]
+        reply = self.transport.send(wire)
+        self.standbySeq = reply["seq"]
+        self.shippedAt = time.time()
+
+        stats.incr("replica.records", len(batch))
+        stats.incr("replica.bytes", sum(len(record.get("data", b"")) for record in batch))
+        return reply
+
+    @stats.timed("replica.ship")
+    def ship(self) -> int:
+        "Sends the queued changes, a full sync if one is due. Returns the records sent"
+        if self.needsSync:
+            return self.sync()
+
+        with self.shipLock:
+
+            with self.lock:
+                count = len(self.journal)
+            if not count:
+                return 0
+
+            batch = []
+            for index in range(count):
+                record = self.journal[index]
+
+                if record["op"] == "put":
+                    # reading and following renames with the tree lock, the
+                    # journal can't grow behind the record meanwhile
+                    with fileio.treeLock:
+                        if (current := self.currentPath(index, record["path"])) is None:
+                            continue
+
+                        try:
+                            data = fileio.backend.read(current)
+                            stat = fileio.backend.stat(current)
+                        except (FileNotFoundError, IsADirectoryError):
+                            continue
+
+                    record = dict(record, data=data, digest=digest(data), stat=[stat.size, stat.mtimeNs, digest(data)])
+                elif record["op"] == "meta":
+                    record = dict(record, data=encryptor.encrypt(json.dumps(record["records"]).encode()))
+                elif record["op"] == "metaFull":
+                    with open(self.stores[record["store"]].jsonPath, "rb") as f:
+                        record = dict(record, data=f.read())
+
+                batch.append(record)
+
+            try:
+                reply = self.send(batch)
+            except OSError:
+                stats.incr("replica.errors")
+                return 0
+
+            with self.lock:
+                del self.journal[:count]
+                if reply["needsSync"]:
+                    stats.incr("replica.standbyOutOfStep")
+                    self.needsSync = True
+
+            self.shipped(batch, self.files)
+            self.saveState()
+
+            return len(batch)
+
+    def plan(self, remote: dict) -> tuple[list[dict], dict[str, list]]:
+        """Compares the tree with the full state of the standby, called with the
+        tree lock. Returns the records that make them equal, without contents,
+        and the [size, mtimeNs, digest] of every blob of the tree
+        """
+
+        dirs, blobs = walk(fileio.backend)
+        remoteDigests = remote["digests"]
+        files, records = {}, []
+
+        for path in blobs:
+            stat = fileio.backend.stat(path)
+            cached = self.files.get(path)
+
+            if cached is not None and cached[:2] == [stat.size, stat.mtimeNs]:
+                files[path] = cached
+            else:
+                stats.incr("replica.hashed")
+                files[path] = [stat.size, stat.mtimeNs, digest(fileio.backend.read(path))]
+
+            if remoteDigests.get(path) != files[path][2]:
+                records.append({"op": "put", "path": path, "digest": files[path][2], "stat": files[path]})
+
+        localDirs, localBlobs, remoteDirs = set(dirs), set(blobs), set(remote["dirs"])
+        removes = [{"op": "remove", "path": path} for path in remoteDigests if path not in localBlobs]
+        # deepest first, their contents are removed before
+        rmdirs = [{"op": "rmdir", "path": path} for path in reversed(remote["dirs"]) if path not in localDirs]
+        mkdirs = [{"op": "mkdir", "path": path} for path in dirs if path not in remoteDirs]
+
+        return removes + rmdirs + mkdirs + records, files
+
+    @stats.timed("replica.sync")
+    def sync(self, deep: bool = False) -> int:
+        """Makes the standby equal to the tree and the metadata, returns the
+        records sent. deep also repairs blobs changed behind the standby's back.
+
+        Commands only wait while the tree is compared with the standby. The
+        contents are sent afterwards, changes made meanwhile are queued and
+        shipped after the sync, whose records are numbered before them.
+        """
+
+        # may be stale by the time it's used, every record of a sync is harmless to repeat
+        remote = self.transport.state(full=True, deep=deep)
+
+        self.writeback.lock.acquire()
+        try:
+            self.shipLock.acquire()
+            with fileio.treeLock:
+                self.writeback.commit()
+                records, files = self.plan(remote)
+
+                for name, store in self.stores.items():
+                    if remote["meta"].get(name) != metadataDigest(store):
+                        with open(store.jsonPath, "rb") as f:
+                            records.append({"op": "metaFull", "store": name, "data": f.read()})
+
+                records.append({"op": "done", "sync": True})
+
+                with self.lock:
+                    # changes from here on are queued, after the numbers of the sync
+                    self.journal.clear()
+                    self.needsSync = False
+                    # the standby skips what it has seen, a lost state file mustn't restart at 0
+                    first = max(self.seq, remote["seq"]) + 1
+                    self.seq = first + len(records) - 1
+        finally:
+            self.writeback.lock.release()
+
+        try:
+            return self.sendSync(records, files, first)
+        except Exception:
+            # retried on the next round
+            with self.lock:
+                self.needsSync = True
+            self.saveState()
+            raise
+        finally:
+            self.shipLock.release()
+
+    def sendSync(self, records: list[dict], files: dict[str, list], first: int) -> int:
+        "Reads and sends the records planned by sync(), called with the ship lock"
+        sent, size, batch, missing = 0, 0, [], False
+
+        for seq, record in enumerate(records, first):
+            if record["op"] == "put":
+                with fileio.treeLock:
+                    try:
+                        data = fileio.backend.read(record["path"])
+                        stat = fileio.backend.stat(record["path"])
+                    except (FileNotFoundError, IsADirectoryError):
+                        data = None
+
+                if data is None:
+                    # moved or removed since the plan, the next sync finds where
+                    missing = True
+                    files.pop(record["path"], None)
+                    record = {"op": "skip"}
+                else:
+                    stat = [stat.size, stat.mtimeNs, digest(data)]
+                    files[record["path"]] = stat
+                    record = dict(record, data=data, digest=stat[2], stat=stat)
+                    size += len(data)
+
+            batch.append(dict(record, seq=seq))
+
+            if size >= REPLICA_BATCH_BYTES or record["op"] == "done":
+                try:
+                    self.send(batch)
+                except OSError:
+                    stats.incr("replica.errors")
+                    with self.lock:
+                        self.needsSync = True
+                    self.saveState()
+                    return sent
+
+                self.shipped(batch, self.files)
+                sent, size, batch = sent + len(batch), 0, []
+
+        if missing:
+            with self.lock:
+                self.needsSync = True
+
+        # what the standby holds is the tree now, unchanged blobs included
+        self.files = files
+        self.saveState()
+        return sent
+
+    def lag(self) -> dict:
+        "Returns how far the standby is behind"
+        with self.lock:
+            pending = len(self.journal)
+            oldest = self.journal[0]["time"] if self.journal else None
+
+        return {
+            "pending": pending,
+            "seconds": time.time() - oldest if oldest is not None else 0.0,
+            "seq": self.seq,
+            "standbySeq": self.standbySeq,
+            "shippedAt": self.shippedAt,
+            "needsSync": self.needsSync,
+        }
+
+    def verify(self, deep: bool = False) -> list[str]:
+        """Ships what's queued and compares digests with the standby, returns
+        what differs. Only the tree digests are exchanged while they match,
+        deep has the standby re-read its blobs instead of trusting its digests
+        """
+
+        self.ship()
+
+        with self.writeback.lock, self.shipLock, fileio.treeLock:
+            remote = self.transport.state(deep=deep)
+            problems = [
+                f"metadata {name}"
+                for name, store in self.stores.items()
+                if remote["meta"].get(name) != metadataDigest(store)
+            ]
+
+            local = {path: entry[2] for path, entry in self.files.items()}
+            if not deep and remote["tree"] == treeDigest(local):
+                # the tree matches what was shipped, check nothing changed since
+                dirs, blobs = walk(fileio.backend)
+                changed = [
+                    path
+                    for path in blobs
+                    if (entry := self.files.get(path)) is None
+                    or entry[:2] != list(fileio.backend.stat(path)[:2])
+                ]
+                return problems + sorted(set(changed) | (set(self.files) - set(blobs)))
+
+            if deep:
+                records, _ = self.plan(remote)
+            else:
+                records, _ = self.plan(self.transport.state(full=True))
+
+        return problems + [f"{record['op']} {record['path']}" for record in records]
+
+    def start(self):
+        "Ships in the background every interval, starting with a full sync"
+        if self._thread is None:
+            self._thread = threading.Thread(target=self.run, daemon=True)
+            self._thread.start()
+
+    def run(self):
+        while True:
+            try:
+                self.ship()
+            except Exception:
+                # retried on the next round, the standby state stays as it was
+                stats.incr("replica.errors")
+
+            if self._stop.wait(self.interval):
+                return
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+            self._thread = None
+
+        try:
+            self.ship()
+        except OSError:
+            stats.incr("replica.errors")
+
+
+if __name__ == "__main__":
+    import argparse
+    import sys
+
+    from writeback import WriteBack
+
+    parser = argparse.ArgumentParser(prog="replicate")
+    parser.add_argument("action", choices=["sync", "verify", "status"])
+    parser.add_argument("--to", type=str, default=REPLICA_PATH, help="standby directory")
+    parser.add_argument("--deep", action="store_true", help="have the standby re-read its blobs")
+    args = parser.parse_args()
+
+    if not args.to:
+        parser.error("give the standby with --to or SFS_REPLICA_PATH")
+
+    graph = Graph("json/encrypted_permissions.json")
+    users = Users("json/encrypted_users.json")
+    writeback = WriteBack({"graph": graph, "users": users})
+    writeback.recover()
+    replicator = Replicator(graph, users, writeback, LocalTransport(args.to))
+
+    if args.action == "sync":
+        print(f"{replicator.sync(args.deep)} records shipped")
+    elif args.action == "verify":
+        replicator.needsSync = False
+        if problems := replicator.verify(args.deep):
+            print(*problems, sep="\n")
+            sys.exit(1)
+
+        print("Standby is consistent")
+    else:
+        print(json.dumps(replicator.transport.state(), indent=2))
@@ -0,0 +1,283 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+import fileio
+import storage
+from audit import AuditLog
+from encrypt import Encryptor
+
+encryptor = Encryptor()
+
+CHECKPOINT_PATH = "json/rotation.checkpoint"
+
+
+class RotationJob:
+    """Re-encrypts every file name, file, metadata file and audit segment under the primary key.
+
+    The tree is walked deepest level first so renaming a directory never
+    invalidates the paths of entries that are still queued. Each level is
+    processed in parallel and checkpointed, a restarted job skips the levels
+    that are already done. Entries already on the primary key are skipped, so
+    running the job twice is harmless.
+    """
+
+    def __init__(
+        self,
+        writeback,
+        backend: Optional[storage.Backend] = None,
+        checkpointPath: str = CHECKPOINT_PATH,
+        workers: int = 4,
+        rate: float = 0,
+        audit: Optional[AuditLog] = None,
+    ) -> None:
+        self.writeback = writeback  # its stores are the metadata to rotate
+        self.backend = backend or fileio.backend
+        self.checkpointPath = checkpointPath
+        self.workers = workers
+        self.rate = rate  # max entries per second, 0 for unlimited
+        self.audit = audit or AuditLog()
+
+        self.total = 0
+        self.done = 0
+        self.rotated = 0
+        self.skipped = 0
+        self.failed: list[str] = []
+        self.state = "idle"
+        self.startedAt: Optional[float] = None
+
+        self._lock = threading.Lock()
+        self._nextSlot = 0.0
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def __repr__(self) -> str:
+        return f"RotationJob(state={self.state}, done={self.done}/{self.total})"
+
+    def keyId(self) -> str:
+        "Fingerprint of the primary key, ties a checkpoint to a rotation"
+        return hashlib.sha256(encryptor.key().encode()).hexdigest()[:16]
+
+    def loadCheckpoint(self) -> Optional[int]:
+        "Returns the last completed depth, if the checkpoint is for this key"
+        try:
+            with open(self.checkpointPath, "r") as f:
+                checkpoint = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+        if checkpoint.get("key") != self.keyId():
+            return None
+
+        return checkpoint["depth"]
+
+    def saveCheckpoint(self, depth: int):
+        tmpPath = self.checkpointPath + ".tmp"
+
+        with open(tmpPath, "w") as f:
+            json.dump({"key": self.keyId(), "depth": depth, "done": self.done}, f)
+
+        os.replace(tmpPath, self.checkpointPath)
+
+    def progress(self) -> dict:
+        "Returns a snapshot of the job progress"
+        elapsed = time.time() - self.startedAt if self.startedAt else 0.0
+
+        return {
+            "state": self.state,
+            "total": self.total,
+            "done": self.done,
+            "rotated": self.rotated,
+            "skipped": self.skipped,
+            "failed": len(self.failed),
+            "percent": 100.0 * self.done / self.total if self.total else 100.0,
+            "rate": self.done / elapsed if elapsed else 0.0,
+        }
+
+    def start(self) -> threading.Thread:
+        "Runs the job on a background thread"
+        self._thread = threading.Thread(target=self.run, daemon=True)
+        self._thread.start()
+        return self._thread
+
+    def stop(self):
+        "Stops the job after the current entries, progress stays checkpointed"
+        self._stop.set()
+
+        if self._thread:
+            self._thread.join()
+
+    def run(self):
+        self.state = "running"
+        self.startedAt = time.time()
+
+        levels = self.collect()
+        lastDepth = self.loadCheckpoint()
+
+        self.total = sum(len(level) for level in levels.values())
+
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            for depth in sorted(levels, reverse=True):
+                if lastDepth is not None and depth >= lastDepth:
+                    self.done += len(levels[depth])
+                    self.skipped += len(levels[depth])
+                    continue
+
+                for _ in pool.map(self.rotateEntry, levels[depth]):
+                    pass
+
+                if self._stop.is_set():
+                    self.state = "stopped"
+                    return
+
+                self.saveCheckpoint(depth)
+
+        try:
+            self.rotateMetadata()
+        except Exception:
+            self.failed.extend(store.jsonPath for store in self.writeback.stores.values())
+
+        try:
+            self.audit.rotateKeys()
+        except Exception:
+            self.failed.append(self.audit.path)
+
+        if os.path.exists(self.checkpointPath):
+            os.remove(self.checkpointPath)
+
+        self.state = "failed" if self.failed else "done"
+
+    def collect(self) -> dict[int, list[tuple[str, str, bool]]]:
+        "Groups every entry under the root by depth"
+        levels: dict[int, list[tuple[str, str, bool]]] = {}
+        pending = [("", 1)]
+
+        while pending:
+            parent, depth = pending.pop()
+            level = levels.setdefault(depth, [])
+
+            for name, isDir in self.backend.listdir(parent):
+                level.append((parent, name, isDir))
+
+                if isDir:
+                    pending.append((storage.join(parent, name), depth + 1))
+
+        return levels
+
+    def rotateEntry(self, entry: tuple[str, str, bool]):
+        if self._stop.is_set():
+            return
+
+        parent, name, isDir = entry
+        path = storage.join(parent, name)
+        self.throttle()
+
+        try:
+            # the service changes nothing between reading an entry and replacing it
+            with fileio.treeLock:
+                changed = False
+                if not isDir:
+                    changed = self.rotateBlob(path)
+
+                if (newName := encryptor.rotateToken(name.encode())) is not None:
+                    newPath = storage.join(parent, newName.decode())
+                    self.backend.rename(path, newPath)
+                    fileio.invalidate(path)
+                    fileio.notifyChange("rename", path, newPath)
+                    changed = True
+        except FileNotFoundError:
+            # removed or renamed by the running service, new entries are
+            # already written under the primary key
+            changed = False
+        except Exception:
+            with self._lock:
+                self.failed.append(path)
+            changed = False
+
+        with self._lock:
+            self.done += 1
+            if changed:
+                self.rotated += 1
+            else:
+                self.skipped += 1
+
+    def rotateBlob(self, path: str) -> bool:
+        "Re-encrypts a single file of the tree, called with the tree lock. Returns if it changed"
+        data = self.backend.read(path)
+
+        if not data or (rotated := fileio.rotateChunks(data)) is None:
+            return False
+
+        self.backend.write(path, rotated)
+        fileio.notifyChange("write", path)
+        return True
+
+    def rotateMetadata(self):
+        """Rewrites the metadata files and empties the redo log under the primary
+        key, by dumping the loaded stores rather than replacing the files behind them
+        """
+
+        with self.writeback.lock:
+            self.writeback.commit()
+
+            for name, store in self.writeback.stores.items():
+                store.dump()
+                self.writeback.notify(name, None)
+
+    def throttle(self):
+        "Rate limits the job so the running service keeps most of the disk"
+        if not self.rate:
+            return
+
+        with self._lock:
+            now = time.monotonic()
+            slot = max(self._nextSlot, now)
+            self._nextSlot = slot + 1 / self.rate
+
+        if slot > now:
+            time.sleep(slot - now)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(prog="rotate")
+    parser.add_argument("--new-key", action="store_true", help="add a new primary key first")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--rate", type=float, default=0, help="entries per second")
+    parser.add_argument("--retire", action="store_true", help="drop old keys when done")
+    args = parser.parse_args()
+
+    if args.new_key:
+        encryptor.addKey()
+
+    from graph import Graph
+    from user import Users
+    from writeback import WriteBack
+
+    writeback = WriteBack(
+        {"graph": Graph("json/encrypted_permissions.json"), "users": Users("json/encrypted_users.json")}
+    )
+    writeback.recover()
+
+    job = RotationJob(writeback, workers=args.workers, rate=args.rate)
+    job.start()
+
+    while job.state in ["idle", "running"]:
+        time.sleep(1)
+        print(job.progress())
+
+    print(job.progress())
+
+    if args.retire and job.state == "done":
+        from snapshot import listSnapshots
+
+        if snapshots := listSnapshots():
+            # snapshots share blobs with the tree as it was, still under the old keys
+            print(f"Old keys kept, {len(snapshots)} snapshots still need them")
+        else:
+            encryptor.retireKeys()
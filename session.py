@@ -0,0 +1,79 @@
+import json
+import os
+import time
+import uuid
+from typing import Optional
+
+from cryptography.fernet import InvalidToken
+
+from encrypt import Encryptor
+from user import User, Users
+
+encryptor = Encryptor()
+
+SESSION_PATH = os.environ.get("SFS_SESSION_FILE", ".sfs_session")
+SESSION_TTL = int(os.environ.get("SFS_SESSION_TTL", 8 * 60 * 60))
+
+
+class Sessions:
+    """Encrypted, expiring login tokens kept in a local file.
+
+    A token lets the next CLI run resume a login without running bcrypt
+    again. Logging out revokes the token on the user, so a copied token
+    file stops working too.
+    """
+
+    def __init__(self, users: Users, path: str = SESSION_PATH, ttl: int = SESSION_TTL) -> None:
+        self.users = users
+        self.path = path
+        self.ttl = ttl
+
+    def issue(self, user: User):
+        "Writes a new token for the user"
+        session = {
+            "id": uuid.uuid4().hex,
+            "user": user.name,
+            "expires": time.time() + self.ttl,
+        }
+
+        fd = os.open(self.path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "wb") as f:
+            f.write(encryptor.encrypt(json.dumps(session).encode()))
+
+    def read(self) -> Optional[dict]:
+        "Returns the stored session if it is readable and not expired"
+        try:
+            with open(self.path, "rb") as f:
+                session = json.loads(encryptor.fernet.decrypt(f.read(), ttl=self.ttl))
+        except (FileNotFoundError, InvalidToken, ValueError):
+            return None
+
+        if session["expires"] < time.time():
+            return None
+
+        return session
+
+    def resume(self) -> Optional[User]:
+        "Returns the user of a valid stored token"
+        if (session := self.read()) is None:
+            return None
+
+        if (user := self.users.users.get(session["user"])) is None:
+            return None
+
+        if user.isRevoked(session["id"]):
+            return None
+
+        return user
+
+    def revoke(self):
+        "Revokes and removes the stored token"
+        if (session := self.read()) is not None and (
+            user := self.users.users.get(session["user"])
+        ):
+            user.revokeSession(session["id"], session["expires"])
+            self.users.markChanged(user.name)
+            self.users.save()
+
+        if os.path.exists(self.path):
+            os.remove(self.path)
@@ -0,0 +1,338 @@
+import json
+import os
+import re
+import shutil
+import time
+from typing import Iterator, Optional
+
+import fileio
+import storage
+from encrypt import Encryptor
+from graph import READ, WRITE, Graph, parentPath
+from stats import stats
+from user import User
+
+encryptor = Encryptor()
+
+# Manifests and metadata copies, the blobs are kept by the storage backend
+SNAPSHOT_PATH = os.environ.get("SFS_SNAPSHOT_PATH", "snapshots")
+MANIFEST = "manifest.json"
+NAME_PATTERN = re.compile(r"[A-Za-z0-9][A-Za-z0-9._-]*")
+
+
+def listSnapshots(path: str = SNAPSHOT_PATH) -> list[dict]:
+    "Returns the manifests of every complete snapshot, oldest first"
+    try:
+        names = os.listdir(path)
+    except FileNotFoundError:
+        return []
+
+    manifests = []
+    for name in names:
+        try:
+            with open(os.path.join(path, name, MANIFEST), "r") as f:
+                manifests.append(json.load(f))
+        except (FileNotFoundError, NotADirectoryError, ValueError):
+            # interrupted while being created or removed
+            pass
+
+    return sorted(manifests, key=lambda manifest: manifest["created"])
+
+
+def mergeEntries(acl: dict[tuple[str, bool], int], entries: list[dict], isGroup: bool):
+    for entry in entries:
+        key = (entry["name"], isGroup)
+        acl[key] = acl.get(key, 0) | (READ if entry["isRead"] else 0) | (WRITE if entry["isWrite"] else 0)
+
+
+class SnapshotView:
+    """Read-only access to a snapshot, with the permissions it was taken with.
+
+    The permissions are kept as the dumped node records and checked by name.
+    Loading them into a Graph would intern the snapshot's principals into the
+    live tables and make every live ACL cache stale.
+    """
+
+    def __init__(self, manifest: dict, path: str, backend: storage.Backend) -> None:
+        self.manifest = manifest
+        self.backend = backend
+        self.names: dict[str, dict[str, tuple[str, bool]]] = {}
+        # path to the effective and the inheritable ACL, built on access
+        self.acls: dict[str, tuple[dict, dict]] = {}
+
+        graphPath = os.path.join(path, manifest["graph"])
+        if encryptor.isEncrypted(graphPath):
+            nodes = encryptor.decryptJson(graphPath)
+        else:
+            with open(graphPath, "r") as f:
+                nodes = json.load(f)
+
+        self.nodes: dict[str, dict] = {node["name"]: node for node in nodes}
+
+        # what the directories above a shared node let through, like Graph.addTraversers
+        self.traversers: dict[str, set[tuple[str, bool]]] = {}
+        for name, node in self.nodes.items():
+            keys = {
+                (entry["name"], True)
+                for entry in node["allowedGroups"] + node.get("inheritGroups", [])
+                if entry["isRead"]
+            }
+            if any(
+                entry["name"] == "all" and entry["isRead"]
+                for entry in node["allowedUsers"] + node.get("inheritUsers", [])
+            ):
+                keys.add(("all", False))
+
+            # up to, not including, the root, like the parent links of a Graph
+            while keys and (name := parentPath(name)) in self.nodes and name:
+                if parentPath(name) not in self.nodes or keys <= self.traversers.get(name, set()):
+                    break
+                self.traversers.setdefault(name, set()).update(keys)
+
+    def __repr__(self) -> str:
+        return f"SnapshotView(name={self.manifest['name']}, backend={self.backend})"
+
+    def acl(self, path: str) -> tuple[dict, dict]:
+        "Returns the effective and the inheritable ACL of a node, like Node.acl"
+        if (acl := self.acls.get(path)) is not None:
+            return acl
+
+        node = self.nodes[path]
+        inherited = {}
+        if path and parentPath(path) in self.nodes and not node.get("blocksInheritance"):
+            inherited = self.acl(parentPath(path))[1]
+
+        effective = dict(inherited)
+        mergeEntries(effective, node["allowedUsers"], False)
+        mergeEntries(effective, node["allowedGroups"], True)
+        for key in self.traversers.get(path, ()):
+            effective[key] = effective.get(key, 0) | READ
+
+        inheritable = inherited
+        if node.get("inheritUsers") or node.get("inheritGroups"):
+            inheritable = dict(inherited)
+            mergeEntries(inheritable, node.get("inheritUsers", []), False)
+            mergeEntries(inheritable, node.get("inheritGroups", []), True)
+
+        acl = self.acls[path] = (effective, inheritable)
+        return acl
+
+    def isReadable(self, path: str, user: User) -> bool:
+        "Returns if a node of the snapshot exists and is readable for a user"
+        if (node := self.nodes.get(path)) is None:
+            return False
+        if node["owner"] == user.name or user.isAdmin:
+            return True
+
+        effective = self.acl(path)[0]
+        keys = [(user.name, False), ("all", False)] + [(group, True) for group in user.joinedGroups]
+        return any(effective.get(key, 0) & READ for key in keys)
+
+    def listNames(self, curr: str) -> dict[str, tuple[str, bool]]:
+        "Returns the decrypted listing of an encrypted directory of the snapshot"
+        if (names := self.names.get(curr)) is None:
+            names = self.names[curr] = {}
+            for encryptedName, isDir in self.backend.listdir(curr):
+                try:
+                    names[encryptor.decryptString(encryptedName)] = (encryptedName, isDir)
+                except Exception:
+                    pass
+
+        return names
+
+    def findPath(self, path: str) -> Optional[str]:
+        "Returns the encrypted path of a non-encrypted one, None if it doesn't exist"
+        curr = ""
+        for part in [p for p in path.split("/") if p]:
+            if (entry := self.listNames(curr).get(part)) is None:
+                return None
+            curr = storage.join(curr, entry[0])
+
+        return curr
+
+    def listDirectory(self, path: str, user: User) -> Optional[list[str]]:
+        "Lists a directory like Graph.listDirectory, None if the user can't read it"
+        if not self.isReadable(path, user):
+            return None
+
+        if (encryptedPath := self.findPath(path)) is None:
+            return None
+
+        out = []
+        for name, (encryptedName, isDir) in self.listNames(encryptedPath).items():
+            if (childPath := "/".join(p for p in [path, name] if p)) not in self.nodes:
+                continue
+
+            name = name if self.isReadable(childPath, user) else encryptedName
+            out.append(name + "/" if isDir else name)
+
+        return out
+
+    def readChunks(self, path: str) -> Iterator[memoryview]:
+        "Yields the contents of a file of the snapshot chunk by chunk"
+        if (encryptedPath := self.findPath(path)) is None:
+            raise FileNotFoundError(path)
+        if self.backend.isdir(encryptedPath):
+            raise IsADirectoryError(path)
+
+        with self.backend.map(encryptedPath) as buffer:
+            yield from fileio.decryptChunks(buffer)
+
+
+class Snapshots:
+    """Point in time copies of the tree, the permissions and the users.
+
+    create() commits what the write-back layer holds, copies the encrypted
+    metadata files and has the backend share every blob with the snapshot,
+    hard links on disk and references in memory. Nothing is copied but
+    metadata, and as blobs are only ever replaced rather than changed in
+    place, a later write leaves the shared copy alone. Only files changed
+    after the snapshot take space twice.
+    """
+
+    def __init__(self, graph: Graph, users, writeback, path: str = SNAPSHOT_PATH) -> None:
+        self.graph = graph
+        self.users = users
+        self.writeback = writeback
+        self.path = path
+
+    def __repr__(self) -> str:
+        return f"Snapshots(path={self.path})"
+
+    def snapshotPath(self, name: str) -> str:
+        return os.path.join(self.path, name)
+
+    def manifest(self, name: str) -> dict:
+        "Returns the manifest of a snapshot, raising FileNotFoundError if there is none"
+        with open(os.path.join(self.snapshotPath(name), MANIFEST), "r") as f:
+            return json.load(f)
+
+    def list(self) -> list[dict]:
+        return listSnapshots(self.path)
+
+    @stats.timed("snapshot.create")
+    def create(self, name: Optional[str] = None) -> dict:
+        "Takes a snapshot, named after the time by default. Returns its manifest"
+        name = name or time.strftime("%Y%m%d-%H%M%S")
+        if not NAME_PATTERN.fullmatch(name):
+            raise ValueError(f"Invalid snapshot name {name}")
+
+        path = self.snapshotPath(name)
+        if os.path.exists(path):
+            raise FileExistsError(name)
+
+        # nothing changes the tree or the metadata until both are captured
+        with self.writeback.lock, fileio.treeLock:
+            self.writeback.commit()
+
+            os.makedirs(path)
+            try:
+                for store in [self.graph, self.users]:
+                    shutil.copyfile(store.jsonPath, os.path.join(path, os.path.basename(store.jsonPath)))
+
+                blobs = fileio.backend.createSnapshot(name)
+            except BaseException:
+                shutil.rmtree(path)
+                raise
+
+        root = self.graph.nodes[""]
+        manifest = {
+            "name": name,
+            "created": time.time(),
+            "graph": os.path.basename(self.graph.jsonPath),
+            "users": os.path.basename(self.users.jsonPath),
+            "blobs": blobs,
+            "files": root.files,
+            "size": root.size,
+            "encryptedSize": root.encryptedSize,
+        }
+
+        # written last, a snapshot without a manifest is incomplete
+        with open(os.path.join(path, MANIFEST + ".tmp"), "w") as f:
+            json.dump(manifest, f)
+            f.flush()
+            os.fsync(f.fileno())
+
+        os.replace(os.path.join(path, MANIFEST + ".tmp"), os.path.join(path, MANIFEST))
+        return manifest
+
+    def open(self, name: str) -> SnapshotView:
+        "Opens a snapshot for browsing"
+        return SnapshotView(self.manifest(name), self.snapshotPath(name), fileio.backend.openSnapshot(name))
+
+    @stats.timed("snapshot.restore")
+    def restore(self, name: str) -> str:
+        """Rolls the tree and the metadata back to a snapshot. The current state
+        is snapshotted first, returns the name of that snapshot
+        """
+
+        manifest = self.manifest(name)
+        path = self.snapshotPath(name)
+
+        with self.writeback.lock, fileio.treeLock:
+            before = self.create(f"before-{name}-{time.strftime('%Y%m%d-%H%M%S')}")["name"]
+            # sessions revoked since the snapshot must stay revoked
+            revoked = {user.name: user.revokedSessions for user in self.users.users.values()}
+
+            fileio.backend.restoreSnapshot(name)
+            for store, fileName in [(self.graph, manifest["graph"]), (self.users, manifest["users"])]:
+                shutil.copyfile(os.path.join(path, fileName), store.jsonPath + ".tmp")
+                os.replace(store.jsonPath + ".tmp", store.jsonPath)
+                store.load()
+
+            for user in self.users.users.values():
+                if sessions := set(revoked.get(user.name, ())) - set(user.revokedSessions):
+                    user.revokedSessions += tuple(sessions)
+                    self.users.markChanged(user.name)
+
+            fileio.clearCaches()
+            fileio.notifyChange("resync", "")
+            self.users.save()
+            self.users.setUsage(self.graph.usageByOwner())
+
+        return before
+
+    def remove(self, name: str):
+        "Deletes a snapshot, blobs still used by the tree or other snapshots stay"
+        self.manifest(name)
+
+        # the manifest goes first so a half removed snapshot isn't listed
+        os.remove(os.path.join(self.snapshotPath(name), MANIFEST))
+        try:
+            fileio.backend.removeSnapshot(name)
+        except FileNotFoundError:
+            pass
+
+        shutil.rmtree(self.snapshotPath(name))
+
+
+if __name__ == "__main__":
+    from user import Users
+    from writeback import WriteBack
+
+    import argparse
+
+    parser = argparse.ArgumentParser(prog="snapshot")
+    parser.add_argument("action", choices=["create", "list", "restore", "remove"])
+    parser.add_argument("name", nargs="?")
+    args = parser.parse_args()
+
+    graph = Graph("json/encrypted_permissions.json")
+    users = Users("json/encrypted_users.json")
+    writeback = WriteBack({"graph": graph, "users": users})
+    writeback.recover()
+    snapshots = Snapshots(graph, users, writeback)
+
+    if args.action == "list":
+        for manifest in snapshots.list():
+            created = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(manifest["created"]))
+            print(f"{manifest['name']:<32}{created}  {manifest['files']} files")
+    elif args.action == "create":
+        print(f"Snapshot {snapshots.create(args.name)['name']} created")
+    elif args.name is None:
+        parser.error(f"{args.action} needs a snapshot name")
+    elif args.action == "restore":
+        print(f"Restored {args.name}, the previous state is snapshot {snapshots.restore(args.name)}")
+    else:
+        snapshots.remove(args.name)
+        print(f"Snapshot {args.name} removed")
@@ -0,0 +1,157 @@
+import bisect
+import functools
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+# Latency histogram bucket upper bounds, in seconds
+BUCKETS = [0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+# Characters Prometheus doesn't allow in metric names
+INVALID_METRIC_CHARS = re.compile(r"[^a-zA-Z0-9_:]")
+
+
+class Histogram:
+    def __init__(self) -> None:
+        self.buckets = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def __repr__(self) -> str:
+        return f"Histogram(count={self.count}, sum={self.sum:.6f})"
+
+    def observe(self, seconds: float):
+        self.buckets[bisect.bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+
+    def quantile(self, q: float) -> float:
+        "Returns the upper bound of the bucket holding the q-th quantile"
+        if not self.count:
+            return 0.0
+
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(BUCKETS + [float("inf")], self.buckets):
+            seen += count
+            if seen >= rank:
+                return bound
+
+        return float("inf")
+
+
+class Stats:
+    """Process wide call counters, crypto counters and latency histograms.
+
+    Timing the same name re-entrantly (e.g. the recursive findPath) only
+    records the outermost call.
+    """
+
+    def __init__(self) -> None:
+        self.counters: dict[str, int] = {}
+        self.histograms: dict[str, Histogram] = {}
+        self._lock = threading.Lock()
+        self._active = threading.local()
+
+    def incr(self, name: str, amount: int = 1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def observe(self, name: str, seconds: float):
+        with self._lock:
+            if (histogram := self.histograms.get(name)) is None:
+                histogram = self.histograms[name] = Histogram()
+
+            histogram.observe(seconds)
+
+    @contextmanager
+    def timer(self, name: str):
+        active = self._active.__dict__
+
+        if active.get(name):
+            yield
+            return
+
+        active[name] = True
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+            active[name] = False
+
+    def timed(self, name: str):
+        "Decorator recording the latency of every call"
+
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.timer(name):
+                    return func(*args, **kwargs)
+
+            return wrapper
+
+        return decorator
+
+    def reset(self):
+        with self._lock:
+            self.counters.clear()
+            self.histograms.clear()
+
+    def report(self) -> list[str]:
+        "Returns a human readable table of every metric"
+        with self._lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted(self.histograms.items())
+
+        lines = [f"{'name':<32}{'calls':>8}{'total ms':>12}{'avg ms':>10}{'p50 ms':>10}{'p99 ms':>10}"]
+        for name, h in histograms:
+            lines.append(
+                f"{name:<32}{h.count:>8}{h.sum * 1000:>12.2f}{h.sum * 1000 / h.count:>10.3f}"
+                f"{h.quantile(0.5) * 1000:>10.1f}{h.quantile(0.99) * 1000:>10.1f}"
+            )
+
+        if counters:
+            lines.append("")
+            lines.extend(f"{name:<32}{value:>8}" for name, value in counters)
+
+        return lines
+
+    def prometheus(self) -> str:
+        "Returns every metric in the Prometheus text exposition format"
+        with self._lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted(self.histograms.items())
+
+        lines = []
+        for name, value in counters:
+            # fileio.readBytes becomes sfs_fileio_readBytes_total
+            metric = f"sfs_{INVALID_METRIC_CHARS.sub('_', name)}_total"
+            lines.append(f"# TYPE {metric} counter")
+            lines.append(f"{metric} {value}")
+
+        lines.append("# TYPE sfs_latency_seconds histogram")
+        for name, h in histograms:
+            seen = 0
+            for bound, count in zip(BUCKETS, h.buckets):
+                seen += count
+                lines.append(f'sfs_latency_seconds_bucket{{name="{name}",le="{bound}"}} {seen}')
+
+            lines.append(f'sfs_latency_seconds_bucket{{name="{name}",le="+Inf"}} {h.count}')
+            lines.append(f'sfs_latency_seconds_sum{{name="{name}"}} {h.sum}')
+            lines.append(f'sfs_latency_seconds_count{{name="{name}"}} {h.count}')
+
+        return "\n".join(lines) + "\n"
+
+    def export(self, path: str):
+        "Atomically writes the Prometheus text file, for the node exporter textfile collector"
+        tmpPath = path + ".tmp"
+
+        with open(tmpPath, "w") as f:
+            f.write(self.prometheus())
+
+        os.replace(tmpPath, path)
+
+
+stats = Stats()
@@ -0,0 +1,503 @@
+import contextlib
+import errno
+import mmap
+import os
+import shutil
+import threading
+import time
+import zlib
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from typing import NamedTuple
+
+# Where the blobs live, local (default), memory or striped
+STORAGE = os.environ.get("SFS_STORAGE", "local")
+# Root directories of the striped backend, separated like PATH
+STORAGE_ROOTS = os.environ.get("SFS_STORAGE_ROOTS", "")
+STRIPE_SIZE = int(os.environ.get("SFS_STRIPE_SIZE", 64 * 1024))
+
+# Suffix of half written blobs, never part of an encrypted (base64) name
+TMP_SUFFIX = ".tmp"
+# Snapshots of a local root live next to it, on the same file system
+SNAPSHOT_SUFFIX = ".snapshots"
+
+
+def join(parent: str, name: str) -> str:
+    "Joins backend paths, the root is the empty path"
+    return f"{parent}/{name}" if parent else name
+
+
+def dropPages(buffer, start: int, end: int):
+    "Lets the kernel reclaim the consumed pages of a memory map"
+    if isinstance(buffer, mmap.mmap) and hasattr(mmap, "MADV_DONTNEED"):
+        start -= start % mmap.PAGESIZE
+        buffer.madvise(mmap.MADV_DONTNEED, start, end - start)
+
+
+def linkTree(source: str, target: str) -> int:
+    "Hard links every blob below source into a new tree at target, returns their number"
+    count = 0
+    os.makedirs(target)
+
+    for dirPath, dirNames, fileNames in os.walk(source):
+        relPath = os.path.relpath(dirPath, source)
+        for name in dirNames:
+            os.mkdir(os.path.join(target, relPath, name))
+
+        for name in fileNames:
+            if not name.endswith(TMP_SUFFIX):
+                os.link(os.path.join(dirPath, name), os.path.join(target, relPath, name))
+                count += 1
+
+    return count
+
+
+class Stat(NamedTuple):
+    size: int
+    mtimeNs: int
+    isFolder: bool
+
+    @property
+    def mtime(self) -> float:
+        return self.mtimeNs / 1e9
+
+
+class Backend(ABC):
+    """Stores the encrypted tree, directories and blobs by relative path.
+
+    fileio only talks to the tree through these methods. Paths are the
+    encrypted names joined by "/", the root is "". Errors are the ones the
+    os module raises for the same mistake (FileNotFoundError, OSError for a
+    non empty directory, ...).
+    """
+
+    @abstractmethod
+    def listdir(self, path: str) -> list[tuple[str, bool]]:
+        "Returns the (name, isFolder) entries of a directory"
+
+    @abstractmethod
+    def isdir(self, path: str) -> bool:
+        "Returns if path is a directory, False if it doesn't exist"
+
+    @abstractmethod
+    def mkdir(self, path: str):
+        "Creates a directory, its parent must exist"
+
+    @abstractmethod
+    def rmdir(self, path: str):
+        "Removes an empty directory"
+
+    @abstractmethod
+    def read(self, path: str) -> bytes:
+        "Returns a whole blob"
+
+    def map(self, path: str):
+        """Context manager giving the blob as a buffer that supports find()
+        and slicing, without reading it into memory where the backend can"""
+        return contextlib.nullcontext(self.read(path))
+
+    @abstractmethod
+    def write(self, path: str, data: bytes):
+        "Replaces a blob, readers see the old or the new contents unless the backend says otherwise"
+
+    def writeParts(self, path: str, parts: list):
+        "Writes the concatenation of parts"
+        self.write(path, b"".join(parts))
+
+    @abstractmethod
+    def remove(self, path: str):
+        "Removes a blob"
+
+    @abstractmethod
+    def rename(self, path: str, newPath: str):
+        "Moves a blob, or a directory with everything below it"
+
+    @abstractmethod
+    def stat(self, path: str) -> Stat:
+        "Returns the size and modification time of a blob or directory"
+
+    def sync(self, paths: list[str]):
+        "Makes written blobs durable, missing ones are skipped"
+
+    @abstractmethod
+    def createSnapshot(self, name: str) -> int:
+        """Freezes the tree as name, sharing the blobs with it rather than
+        copying them. Returns the number of blobs"""
+
+    @abstractmethod
+    def openSnapshot(self, name: str) -> "Backend":
+        "Returns a backend over the tree of a snapshot, only to be read"
+
+    @abstractmethod
+    def restoreSnapshot(self, name: str):
+        "Replaces the tree with the one of a snapshot, which is kept"
+
+    @abstractmethod
+    def removeSnapshot(self, name: str):
+        "Deletes a snapshot, blobs the tree still uses stay"
+
+
+class LocalBackend(Backend):
+    "A directory tree on the local disk, the original layout of files/"
+
+    def __init__(self, root: str = "files/") -> None:
+        self.root = root
+
+    def __repr__(self) -> str:
+        return f"LocalBackend(root={self.root})"
+
+    def fullPath(self, path: str) -> str:
+        return os.path.join(self.root, path) if path else self.root
+
+    def listdir(self, path: str) -> list[tuple[str, bool]]:
+        return [
+            (entry.name, entry.is_dir())
+            for entry in os.scandir(self.fullPath(path))
+            if not entry.name.endswith(TMP_SUFFIX)
+        ]
+
+    def isdir(self, path: str) -> bool:
+        return os.path.isdir(self.fullPath(path))
+
+    def mkdir(self, path: str):
+        os.mkdir(self.fullPath(path))
+
+    def rmdir(self, path: str):
+        os.rmdir(self.fullPath(path))
+
+    def read(self, path: str) -> bytes:
+        with open(self.fullPath(path), "rb") as f:
+            return f.read()
+
+    @contextlib.contextmanager
+    def map(self, path: str):
+        with open(self.fullPath(path), "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                # empty files can't be mapped
+                yield b""
+                return
+
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+                yield buffer
+
+    def write(self, path: str, data: bytes):
+        self.writeParts(path, [data])
+
+    def writeParts(self, path: str, parts: list):
+        "Writes the concatenation of parts without joining them first"
+        # a new file swapped in, a crash never leaves a torn blob
+        fullPath = self.fullPath(path)
+        with open(fullPath + TMP_SUFFIX, "wb") as f:
+            for part in parts:
+                f.write(part)
+
+        os.replace(fullPath + TMP_SUFFIX, fullPath)
+
+    def remove(self, path: str):
+        os.remove(self.fullPath(path))
+
+    def rename(self, path: str, newPath: str):
+        os.rename(self.fullPath(path), self.fullPath(newPath))
+
+    def stat(self, path: str) -> Stat:
+        stat = os.stat(self.fullPath(path))
+        return Stat(stat.st_size, stat.st_mtime_ns, os.path.isdir(self.fullPath(path)))
+
+    def sync(self, paths: list[str]):
+        for path in paths:
+            try:
+                fd = os.open(self.fullPath(path), os.O_RDONLY)
+            except FileNotFoundError:
+                continue
+
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+    def snapshotRoot(self, name: str) -> str:
+        return os.path.join(self.root.rstrip("/") + SNAPSHOT_SUFFIX, name)
+
+    def createSnapshot(self, name: str) -> int:
+        # blobs are only ever replaced, never changed in place, so a later
+        # write leaves the linked copy alone
+        return linkTree(self.root, self.snapshotRoot(name))
+
+    def openSnapshot(self, name: str) -> "LocalBackend":
+        if not os.path.isdir(root := self.snapshotRoot(name)):
+            raise FileNotFoundError(root)
+
+        return LocalBackend(root)
+
+    def restoreSnapshot(self, name: str):
+        root = self.root.rstrip("/")
+        if not os.path.exists(root) and os.path.exists(root + ".old"):
+            # interrupted between the renames, back to the tree before it
+            os.rename(root + ".old", root)
+        elif os.path.exists(root + ".old"):
+            # interrupted after the renames, the restored tree is in place
+            shutil.rmtree(root + ".old")
+        if os.path.exists(root + ".restoring"):
+            shutil.rmtree(root + ".restoring")
+
+        linkTree(self.snapshotRoot(name), root + ".restoring")
+        os.rename(root, root + ".old")
+        os.rename(root + ".restoring", root)
+        shutil.rmtree(root + ".old")
+
+    def removeSnapshot(self, name: str):
+        shutil.rmtree(self.snapshotRoot(name))
+
+
+class MemoryBackend(Backend):
+    "Keeps the tree in dicts, for tests and benchmarks without disk I/O"
+
+    def __init__(self) -> None:
+        self.dirs: dict[str, set[str]] = {"": set()}
+        self.blobs: dict[str, bytes] = {}
+        self.mtimes: dict[str, int] = {"": time.time_ns()}
+        self.snapshots: dict[str, MemoryBackend] = {}
+        self.lock = threading.Lock()
+
+    def __repr__(self) -> str:
+        return f"MemoryBackend(dirs={len(self.dirs)}, blobs={len(self.blobs)})"
+
+    def parentOf(self, path: str) -> set[str]:
+        "Returns the children of the parent directory, which has to exist"
+        parent, _, _ = path.rpartition("/")
+        if (children := self.dirs.get(parent)) is None:
+            raise FileNotFoundError(path)
+
+        return children
+
+    def listdir(self, path: str) -> list[tuple[str, bool]]:
+        with self.lock:
+            if (children := self.dirs.get(path)) is None:
+                raise FileNotFoundError(path)
+
+            return [(name, join(path, name) in self.dirs) for name in children]
+
+    def isdir(self, path: str) -> bool:
+        return path in self.dirs
+
+    def mkdir(self, path: str):
+        with self.lock:
+            if path in self.dirs or path in self.blobs:
+                raise FileExistsError(path)
+
+            self.parentOf(path).add(path.rpartition("/")[2])
+            self.dirs[path] = set()
+            self.mtimes[path] = time.time_ns()
+
+    def rmdir(self, path: str):
+        with self.lock:
+            if (children := self.dirs.get(path)) is None:
+                raise FileNotFoundError(path)
+            if children:
+                raise OSError(errno.ENOTEMPTY, os.strerror(errno.ENOTEMPTY), path)
+
+            self.parentOf(path).discard(path.rpartition("/")[2])
+            del self.dirs[path]
+            del self.mtimes[path]
+
+    def read(self, path: str) -> bytes:
+        if (data := self.blobs.get(path)) is None:
+            if path in self.dirs:
+                raise IsADirectoryError(path)
+            raise FileNotFoundError(path)
+
+        return data
+
+    def write(self, path: str, data: bytes):
+        with self.lock:
+            if path in self.dirs:
+                raise IsADirectoryError(path)
+
+            self.parentOf(path).add(path.rpartition("/")[2])
+            self.blobs[path] = bytes(data)
+            self.mtimes[path] = time.time_ns()
+
+    def remove(self, path: str):
+        with self.lock:
+            if path not in self.blobs:
+                raise FileNotFoundError(path)
+
+            self.parentOf(path).discard(path.rpartition("/")[2])
+            del self.blobs[path]
+            del self.mtimes[path]
+
+    def rename(self, path: str, newPath: str):
+        with self.lock:
+            if path not in self.blobs and path not in self.dirs:
+                raise FileNotFoundError(path)
+
+            self.parentOf(path).discard(path.rpartition("/")[2])
+            self.parentOf(newPath).add(newPath.rpartition("/")[2])
+
+            # move the entry and everything below it
+            for table in [self.dirs, self.blobs, self.mtimes]:
+                for key in [k for k in table if k == path or k.startswith(path + "/")]:
+                    table[newPath + key[len(path) :]] = table.pop(key)
+
+    def stat(self, path: str) -> Stat:
+        if (mtime := self.mtimes.get(path)) is None:
+            raise FileNotFoundError(path)
+
+        return Stat(len(self.blobs.get(path, b"")), mtime, path in self.dirs)
+
+    def copy(self) -> "MemoryBackend":
+        "Copies the tree, the blobs themselves are shared"
+        backend = MemoryBackend()
+        backend.dirs = {path: set(children) for path, children in self.dirs.items()}
+        backend.blobs = dict(self.blobs)
+        backend.mtimes = dict(self.mtimes)
+        return backend
+
+    def createSnapshot(self, name: str) -> int:
+        with self.lock:
+            if name in self.snapshots:
+                raise FileExistsError(name)
+
+            self.snapshots[name] = self.copy()
+            return len(self.blobs)
+
+    def openSnapshot(self, name: str) -> "MemoryBackend":
+        with self.lock:
+            if (snapshot := self.snapshots.get(name)) is None:
+                raise FileNotFoundError(name)
+
+            # a copy, a write through the view can't reach the snapshot
+            return snapshot.copy()
+
+    def restoreSnapshot(self, name: str):
+        snapshot = self.openSnapshot(name)
+        with self.lock:
+            self.dirs, self.blobs, self.mtimes = snapshot.dirs, snapshot.blobs, snapshot.mtimes
+
+    def removeSnapshot(self, name: str):
+        with self.lock:
+            if self.snapshots.pop(name, None) is None:
+                raise FileNotFoundError(name)
+
+
+class StripedBackend(Backend):
+    """Spreads every blob over several root directories, like RAID 0.
+
+    Directories are mirrored on every root. A blob is cut into stripeSize
+    chunks, chunk i goes to root (first + i) % len(roots), so each root holds
+    a file with every len(roots)-th chunk at the same relative path. first
+    comes from a hash of the path, so blobs smaller than a stripe are spread
+    over the roots too, and is kept in a one byte header of every stripe, a
+    rename doesn't move them. A single root has no header and is laid out
+    like a LocalBackend. Reads, writes and metadata changes hit all
+    roots in parallel, with the roots on separate devices throughput scales
+    with their number.
+
+    Each root replaces its stripe atomically, but the roots don't change
+    together. A reader racing a write, or a crash halfway through one, can
+    combine old and new stripes, so readers have to be serialised with
+    writes (fileio does it with treeLock) and a blob torn by a crash is lost.
+    A restore interrupted on some roots leaves the others as they were until
+    it's run again.
+    """
+
+    def __init__(self, roots: list[str], stripeSize: int = STRIPE_SIZE) -> None:
+        if not roots or len(roots) > 256:
+            raise ValueError("The striped backend needs between 1 and 256 roots")
+
+        self.roots = [LocalBackend(root) for root in roots]
+        self.stripeSize = stripeSize
+        self.pool = ThreadPoolExecutor(
+            max_workers=len(roots), thread_name_prefix="stripe"
+        )
+
+        for root in roots:
+            os.makedirs(root, exist_ok=True)
+
+    def __repr__(self) -> str:
+        return f"StripedBackend(roots={[root.root for root in self.roots]}, stripeSize={self.stripeSize})"
+
+    def onEveryRoot(self, func, *args) -> list:
+        "Calls func(root, *args) on every root in parallel, raising the first error"
+        return list(self.pool.map(lambda root: func(root, *args), self.roots))
+
+    def listdir(self, path: str) -> list[tuple[str, bool]]:
+        return self.roots[0].listdir(path)
+
+    def isdir(self, path: str) -> bool:
+        return self.roots[0].isdir(path)
+
+    def mkdir(self, path: str):
+        self.onEveryRoot(LocalBackend.mkdir, path)
+
+    def rmdir(self, path: str):
+        self.onEveryRoot(LocalBackend.rmdir, path)
+
+    def read(self, path: str) -> bytes:
+        stripes = [memoryview(s) for s in self.onEveryRoot(LocalBackend.read, path)]
+        count, size = len(stripes), self.stripeSize
+        first = 0
+        if count > 1:
+            first = stripes[0][0]
+            stripes = [stripe[1:] for stripe in stripes]
+        total = sum(len(stripe) for stripe in stripes)
+
+        # chunk i is the (i // count)-th chunk of stripe (first + i) % count
+        return b"".join(
+            stripes[(first + i) % count][i // count * size : (i // count + 1) * size]
+            for i in range(-(-total // size))
+        )
+
+    def write(self, path: str, data: bytes):
+        count, size = len(self.roots), self.stripeSize
+        view = memoryview(data)
+        first = zlib.crc32(path.encode()) % count
+
+        stripes = [[bytes([first])] if count > 1 else [] for _ in range(count)]
+        for i in range(0, len(data), size):
+            stripes[(first + i // size) % count].append(view[i : i + size])
+        list(self.pool.map(lambda root, parts: root.writeParts(path, parts), self.roots, stripes))
+
+    def remove(self, path: str):
+        self.onEveryRoot(LocalBackend.remove, path)
+
+    def rename(self, path: str, newPath: str):
+        self.onEveryRoot(LocalBackend.rename, path, newPath)
+
+    def stat(self, path: str) -> Stat:
+        stats = self.onEveryRoot(LocalBackend.stat, path)
+        if stats[0].isFolder:
+            return stats[0]
+        # without the header of each stripe
+        header = 1 if len(stats) > 1 else 0
+        return Stat(sum(stat.size - header for stat in stats), stats[0].mtimeNs, False)
+
+    def sync(self, paths: list[str]):
+        self.onEveryRoot(LocalBackend.sync, paths)
+
+    def createSnapshot(self, name: str) -> int:
+        return self.onEveryRoot(LocalBackend.createSnapshot, name)[0]
+
+    def openSnapshot(self, name: str) -> "StripedBackend":
+        return StripedBackend(
+            [root.openSnapshot(name).root for root in self.roots], self.stripeSize
+        )
+
+    def restoreSnapshot(self, name: str):
+        # root by root, an interrupted restore is finished by running it again
+        self.onEveryRoot(LocalBackend.restoreSnapshot, name)
+
+    def removeSnapshot(self, name: str):
+        self.onEveryRoot(LocalBackend.removeSnapshot, name)
+
+
+def fromEnv(root: str = "files/") -> Backend:
+    "Builds the backend selected by SFS_STORAGE"
+    if STORAGE == "memory":
+        return MemoryBackend()
+
+    if STORAGE == "striped":
+        roots: list[str] = [r for r in STORAGE_ROOTS.split(os.pathsep) if r]
+        return StripedBackend(roots or [root])
+
+    return LocalBackend(root)
@@ -0,0 +1,59 @@
+import os
+import shutil
+import sys
+import tempfile
+
+import pytest
+
+REPO_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_PATH)
+
+from benchmarks.generate import generate  # noqa: E402
+
+# Built once, every test gets a copy. The copies share the key, the
+# Encryptor singleton reads it once per process.
+base = tempfile.mkdtemp(prefix="sfs-test-")
+
+
+def pytest_configure(config):
+    generate(base, depth=2, fanout=2, filesPerDir=2, fileSize=64, users=2, groups=1, bcryptRounds=4)
+    os.chdir(base)
+
+
+def pytest_unconfigure(config):
+    os.chdir(REPO_PATH)
+    shutil.rmtree(base, ignore_errors=True)
+
+
+@pytest.fixture
+def workspace(tmp_path, monkeypatch):
+    "A fresh copy of the generated workspace as the working directory"
+    path = tmp_path / "workspace"
+    shutil.copytree(base, path)
+    monkeypatch.chdir(path)
+
+    import fileio
+
+    fileio.clearCaches()
+    monkeypatch.setattr(fileio, "changeListeners", [])
+
+    yield path
+
+    fileio.clearCaches()
+
+
+@pytest.fixture
+def stores(workspace):
+    "The (graph, users, writeback) of the workspace"
+    from graph import Graph
+    from user import Users
+    from writeback import WriteBack
+
+    graph = Graph("json/encrypted_permissions.json")
+    users = Users("json/encrypted_users.json")
+    writeback = WriteBack({"graph": graph, "users": users})
+
+    yield graph, users, writeback
+
+    if writeback._log is not None:
+        writeback._log.close()
@@ -0,0 +1,67 @@
+import os
+import time
+
+from audit import INDEX_SUFFIX, AuditLog
+from stats import stats
+
+
+def fill(log: AuditLog):
+    "Three flushes, one segment each with a tiny segment size"
+    log.record("alice", "cat", "docs/a.txt", "ok", 0.001)
+    log.flush()
+    log.record("bob", "write", "docs/b.txt", "denied", 0.002)
+    log.flush()
+    log.record("alice", "ls", "photos", "ok", 0.001)
+    log.record("alice", "cd", "photos/2024", "ok", 0.001)
+    log.flush()
+
+
+def test_events_go_to_new_segments_as_they_fill(tmp_path):
+    log = AuditLog(path=str(tmp_path / "audit"), segmentBytes=1)
+    fill(log)
+
+    assert log.segments() == [1, 2, 3]
+    events = log.query()
+    assert [event["op"] for event in events] == ["cat", "write", "ls", "cd"]
+    assert events[1]["user"] == "bob" and events[1]["result"] == "denied"
+    assert [event["op"] for event in log.query(limit=1)] == ["cd"]
+
+
+def test_queries_only_read_segments_their_index_matches(tmp_path):
+    log = AuditLog(path=str(tmp_path / "audit"), segmentBytes=1)
+    fill(log)
+    read = stats.counters.get("audit.segmentsRead", 0)
+
+    assert [event["path"] for event in log.query(user="bob")] == ["docs/b.txt"]
+    assert stats.counters.get("audit.segmentsRead", 0) - read == 1
+
+    assert [event["op"] for event in log.query(path="photos")] == ["ls", "cd"]
+    assert log.query(path="doc") == []
+    assert log.query(since=time.time() + 60) == []
+
+
+def test_a_missing_index_is_rebuilt_from_its_segment(tmp_path):
+    log = AuditLog(path=str(tmp_path / "audit"), segmentBytes=1)
+    fill(log)
+    os.remove(log.segmentPath(1, INDEX_SUFFIX))
+    rebuilt = stats.counters.get("audit.indexRebuilt", 0)
+
+    log = AuditLog(path=str(tmp_path / "audit"), segmentBytes=1)
+    assert [event["op"] for event in log.query(user="alice")] == ["cat", "ls", "cd"]
+    assert stats.counters.get("audit.indexRebuilt", 0) - rebuilt == 1
+    assert os.path.exists(log.segmentPath(1, INDEX_SUFFIX))
+
+
+def test_a_torn_segment_is_never_appended_to(tmp_path):
+    log = AuditLog(path=str(tmp_path / "audit"))
+    log.record("alice", "cat", "docs/a.txt", "ok", 0.001)
+    log.flush()
+    with open(log.segmentPath(1), "ab") as f:
+        f.write(b"half a line")
+
+    log = AuditLog(path=str(tmp_path / "audit"))
+    log.record("bob", "cat", "docs/a.txt", "ok", 0.001)
+    log.flush()
+
+    assert log.segments() == [1, 2]
+    assert [event["user"] for event in log.query()] == ["alice", "bob"]
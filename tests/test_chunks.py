@@ -0,0 +1,56 @@
+import pytest
+from cryptography.fernet import InvalidToken
+
+import fileio
+from encrypt import Encryptor
+
+encryptor = Encryptor()
+
+
+@pytest.fixture
+def smallChunks(monkeypatch):
+    monkeypatch.setattr(fileio, "CHUNK_SIZE", 8)
+
+
+def decrypt(data: bytes) -> bytes:
+    return b"".join(fileio.decryptChunks(data))
+
+
+@pytest.mark.parametrize("size", [0, 1, 7, 8, 9, 16, 100])
+def test_chunked_files_round_trip(smallChunks, size):
+    data = bytes(range(size))
+    encrypted = b"".join(fileio.encryptChunks(data))
+
+    assert encrypted.startswith(fileio.CHUNK_MAGIC)
+    assert encrypted.count(b"\n") == 1 + max(1, -(-size // 8))
+    assert decrypt(encrypted) == data
+
+
+def test_legacy_single_token_files_are_read(smallChunks):
+    assert decrypt(encryptor.encrypt(b"written before chunking")) == b"written before chunking"
+
+
+def test_reordered_or_dropped_chunks_are_rejected(smallChunks):
+    magic, *tokens = b"".join(fileio.encryptChunks(bytes(range(24)))).splitlines(keepends=True)
+    assert len(tokens) == 3
+
+    for broken in [
+        [tokens[1], tokens[0], tokens[2]],
+        tokens[:2],
+        tokens[1:],
+        tokens + [tokens[2]],
+    ]:
+        with pytest.raises(InvalidToken):
+            decrypt(magic + b"".join(broken))
+
+
+def test_legacy_files_in_the_tree_are_read_and_rewritten_chunked(workspace, smallChunks):
+    name, encryptedPath = next((p, e) for p, e, isDir in fileio.walkTree() if not isDir)
+    fileio.backend.write(encryptedPath, encryptor.encrypt(b"legacy contents"))
+    fileio.clearCaches()
+
+    assert fileio.readFile(name) == "legacy contents"
+
+    fileio.writeFile(name, "new contents")
+    assert fileio.backend.read(encryptedPath).startswith(fileio.CHUNK_MAGIC)
+    assert fileio.readFile(name) == "new contents"
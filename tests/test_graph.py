@@ -0,0 +1,121 @@
+from graph import FLAG_BITS, Graph, Node, principalId, principalIds
+from user import User
+
+
+def test_sharing_lets_everyone_reach_a_node_without_saving_its_ancestors(stores):
+    graph, users, writeback = stores
+    guest = User("guest", "", ["nobody"])
+    path = "user0/dir1/file1.txt"
+    assert not graph.nodes["user0/dir1"].isReadable(guest)
+
+    graph.changePermissions("3", path, users.users["user0"])
+
+    assert graph.changed == {path}
+    assert graph.nodes[path].isReadable(guest)
+    assert graph.nodes["user0/dir1"].isReadable(guest)
+    assert graph.nodes["user0"].isReadable(guest)
+    assert not graph.nodes["user0/dir1"].isWritable(guest)
+    assert not graph.nodes["user0/dir0"].isReadable(guest)
+
+    # derived again from the shared node when the graph is loaded
+    graph.save()
+    writeback.commit()
+    graph = Graph("json/encrypted_permissions.json")
+    assert graph.nodes["user0/dir1"].isReadable(guest)
+
+
+def test_changing_inheritance_only_rebuilds_that_subtree(stores):
+    graph, users, writeback = stores
+    acls = {name: node.acl() for name, node in graph.nodes.items()}
+
+    graph.changePermissions("3", "user0/dir0", users.users["user0"])
+    guest = User("guest", "")
+    assert graph.nodes["user0/dir0/file1.txt"].isReadable(guest)
+
+    for name, node in graph.nodes.items():
+        if name.startswith("user0/dir0/"):
+            assert node.acl() is not acls[name]
+        elif name != "user0/dir0" and name.count("/") == 2:
+            assert node.acl() is acls[name]
+
+
+def test_packed_entries_round_trip_through_dump():
+    record = {
+        "name": "docs/a.txt",
+        "owner": "user0",
+        "allowedUsers": [
+            {"name": "user0", "isRead": True, "isWrite": True},
+            {"name": "all", "isRead": True, "isWrite": False},
+        ],
+        "allowedGroups": [{"name": "group0", "isRead": False, "isWrite": True}],
+        "usage": {"size": 3, "encryptedSize": 120, "files": 1, "mtime": 0},
+    }
+    node = Node(**record)
+
+    assert all(isinstance(entry, int) for entry in node.users + node.groups)
+    assert node.dump() == record
+    assert [(p.name, p.isRead, p.isWrite) for p in node.allowedGroups] == [("group0", False, True)]
+
+
+def test_entries_are_replaced_not_duplicated():
+    node = Node("a.txt", "user0", [{"name": "user1", "isRead": True, "isWrite": False}])
+
+    node.addUser("user1", True, True)
+    node.addUser("user2", True, False)
+    node.removeUser("nobody-interned")
+
+    assert [(p.name, p.isRead, p.isWrite) for p in node.allowedUsers] == [
+        ("user1", True, True),
+        ("user2", True, False),
+    ]
+    assert "nobody-interned" not in principalIds
+    assert node.isWritable(User("user1", ""))
+    assert not node.isWritable(User("user2", ""))
+
+    node.removeUser("user1")
+    assert not node.isReadable(User("user1", ""))
+
+
+def test_principals_are_interned_once():
+    first = Node("a", "user0", [{"name": "user1", "isRead": True, "isWrite": True}])
+    second = Node("b", "user0", [{"name": "user1", "isRead": True, "isWrite": False}])
+
+    assert first.users[0] >> FLAG_BITS == second.users[0] >> FLAG_BITS == principalId("user1")
+    assert first.owner is second.owner
+
+
+def test_sharing_a_directory_is_inherited_below_it(stores):
+    graph, users, writeback = stores
+    owner, member = users.users["user0"], users.users["user1"]
+    path = "user0/dir1/file1.txt"
+    assert not graph.nodes[path].isReadable(member)
+
+    graph.changePermissions("2", "user0/dir1", owner)
+
+    assert graph.changed == {"user0/dir1"}
+    assert graph.nodes[path].isReadable(member)
+    assert graph.nodes[path].isWritable(member)
+    assert not graph.nodes["user0/dir0/file1.txt"].isReadable(member)
+
+    # a new file picks it up too
+    graph.createFile("user0/dir1/new.txt", owner)
+    assert graph.nodes["user0/dir1/new.txt"].isReadable(member)
+
+
+def test_owner_only_blocks_inheritance(stores):
+    graph, users, writeback = stores
+    owner, member = users.users["user0"], users.users["user1"]
+    path = "user0/dir1/file1.txt"
+    graph.changePermissions("2", "user0/dir1", owner)
+
+    graph.changePermissions("1", path, owner)
+
+    assert not graph.nodes[path].isReadable(member)
+    assert graph.nodes[path].isReadable(owner)
+    assert graph.nodes["user0/dir1/file0.txt"].isReadable(member)
+
+    graph.save()
+    writeback.commit()
+    graph = Graph("json/encrypted_permissions.json")
+    assert not graph.nodes[path].isReadable(member)
+    assert graph.nodes["user0/dir1/file0.txt"].isWritable(member)
@@ -0,0 +1,62 @@
+import fileio
+from prefetch import Prefetcher
+
+
+def encrypted(*paths: str) -> list[str]:
+    "Encrypted paths, looked up before the caches are cleared"
+    out = [fileio.findPath(path) for path in paths]
+    fileio.clearCaches()
+    return out
+
+
+def test_prefetch_warms_what_the_user_can_read(stores):
+    graph, users, writeback = stores
+    user = users.users["user1"]
+    parent, current, shared, private = encrypted(
+        "user0", "user0/dir0", "user0/dir0/file0.txt", "user0/dir0/file1.txt"
+    )
+
+    prefetcher = Prefetcher(graph, enabled=True)
+    prefetcher.prefetch("user0/dir0", user, prefetcher.generation)
+
+    assert current in fileio.nameCache
+    assert parent in fileio.nameCache
+    assert shared in fileio.contentCache
+    assert private not in fileio.contentCache
+
+
+def test_prefetch_stays_within_its_budgets(stores):
+    graph, users, writeback = stores
+    user = users.users["user0"]
+    current, sub = encrypted("user0", "user0/dir0")
+
+    prefetcher = Prefetcher(graph, maxEntries=1, maxBytes=0, enabled=True)
+    prefetcher.prefetch("user0", user, prefetcher.generation)
+
+    assert current in fileio.nameCache
+    assert sub not in fileio.nameCache
+    assert not fileio.contentCache
+
+
+def test_moving_elsewhere_cancels_the_prefetch(stores):
+    graph, users, writeback = stores
+    prefetcher = Prefetcher(graph, enabled=True)
+    generation = prefetcher.generation
+    prefetcher.cancel()
+
+    prefetcher.prefetch("user0/dir0", users.users["user0"], generation)
+
+    assert not fileio.nameCache
+    assert not fileio.contentCache
+
+
+def test_warm_runs_in_the_background(stores):
+    graph, users, writeback = stores
+    (current,) = encrypted("user0/dir1")
+
+    prefetcher = Prefetcher(graph, enabled=True)
+    prefetcher.warm("user0/dir1", users.users["user0"])
+    assert prefetcher.idle.wait(timeout=5)
+    prefetcher.stop()
+
+    assert current in fileio.nameCache
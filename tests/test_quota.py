@@ -0,0 +1,55 @@
+import fileio
+import quota
+
+
+def account(graph, users):
+    "Charges writes to the owners like the CLI does"
+    users.setUsage(graph.usageByOwner())
+    graph.accounting = users
+
+
+def test_write_over_a_user_quota_is_rejected_before_encrypting(stores):
+    graph, users, writeback = stores
+    account(graph, users)
+    path = "user0/dir0/file0.txt"
+    before = fileio.readFile(path)
+    users.setQuota("user0", users.users["user0"].used + 100)
+
+    assert not graph.writeFile(path, "x" * 1000)
+    assert fileio.readFile(path) == before
+
+    assert graph.writeFile(path, "x" * 90)
+    assert users.users["user0"].used == graph.usageByOwner()["user0"]
+
+    # shrinking is always allowed, and frees room
+    users.setQuota("user0", 0)
+    assert graph.writeFile(path, "")
+    assert not graph.writeFile(path, "x")
+
+
+def test_group_quota_counts_every_member(stores):
+    graph, users, writeback = stores
+    account(graph, users)
+    used = users.groupUsage("group0")
+    users.setGroupQuota("group0", used + 50)
+
+    def grow(path: str, delta: int) -> bool:
+        return graph.writeFile(path, "x" * (graph.nodes[path].size + delta))
+
+    assert grow("user0/dir0/file1.txt", 40)
+    assert not grow("user1/dir0/file1.txt", 40)
+    assert grow("user1/dir0/file1.txt", 10)
+
+    users.setGroupQuota("group0", None)
+    assert grow("user1/dir0/file1.txt", 40)
+
+
+def test_rebuild_matches_the_usage_kept_by_writes(stores):
+    graph, users, writeback = stores
+    account(graph, users)
+    graph.writeFile("user0/dir0/file0.txt", "x" * 500)
+    graph.removeNode("user1/file1.txt")
+    kept = {name: user.used for name, user in users.users.items()}
+
+    assert quota.rebuild(graph, users, workers=2) == {k: v for k, v in kept.items() if v}
+    assert {name: user.used for name, user in users.users.items()} == kept
@@ -0,0 +1,137 @@
+import copy
+import threading
+
+import pytest
+
+import replicate
+
+
+@pytest.fixture
+def replicator(stores, tmp_path):
+    graph, users, writeback = stores
+    replicator = replicate.Replicator(
+        graph,
+        users,
+        writeback,
+        replicate.LocalTransport(str(tmp_path / "standby")),
+        statePath="json/replica.state",
+    )
+    replicator.attach()
+    replicator.ship()
+    assert not replicator.needsSync
+
+    return replicator
+
+
+def files(graph) -> list[str]:
+    return [name for name, node in graph.nodes.items() if name and not node.isFolder]
+
+
+def test_standby_skips_a_batch_it_applied(tmp_path):
+    standby = replicate.Standby(str(tmp_path / "standby"))
+    batch = [
+        {"seq": 1, "op": "mkdir", "path": "a"},
+        {"seq": 2, "op": "put", "path": "a/x", "data": b"one", "digest": replicate.digest(b"one")},
+        {"seq": 3, "op": "rename", "path": "a/x", "newPath": "a/y"},
+        {"seq": 4, "op": "put", "path": "a/x", "data": b"two", "digest": replicate.digest(b"two")},
+        {"seq": 5, "op": "remove", "path": "a/y"},
+    ]
+
+    # crashed after the first records, the whole batch is sent again
+    assert standby.apply(copy.deepcopy(batch[:3])) == 3
+    assert standby.apply(copy.deepcopy(batch)) == 5
+    state = dict(standby.state(full=True), appliedAt=None)
+
+    assert standby.apply(copy.deepcopy(batch)) == 5
+    assert dict(standby.state(full=True), appliedAt=None) == state
+    assert state["digests"] == {"a/x": replicate.digest(b"two")}
+    assert standby.backend.read("a/x") == b"two"
+
+
+def test_resent_batch_leaves_the_standby_consistent(stores, replicator):
+    graph, users, writeback = stores
+    sent = []
+    send = replicator.transport.send
+    replicator.transport.send = lambda batch: sent.append(batch) or send(batch)
+
+    first, second = files(graph)[:2]
+    graph.writeFile(first, "changed")
+    graph.writeFile(second, "written twice")
+    graph.writeFile(second, "written twice, shipped once")
+    graph.removeNode(files(graph)[2])
+    users.setQuota("user0", 1000)
+    users.setGroupQuota("group0", 5000)
+
+    replicator.ship()
+    assert replicator.verify() == []
+    assert [record["op"] for record in sent[-1]].count("put") == 2
+
+    replicator.transport.send(sent[-1])
+    assert replicator.verify() == []
+    assert replicator.transport.standby.store("users").groupQuotas == {"group0": 5000}
+
+
+def test_failed_sync_is_retried(stores, replicator):
+    graph, users, writeback = stores
+    send = replicator.transport.send
+
+    def fail(batch):
+        raise ValueError("standby rejected the batch")
+
+    replicator.needsSync = True
+    graph.writeFile(files(graph)[0], "changed during the outage")
+    replicator.transport.send = fail
+    with pytest.raises(ValueError):
+        replicator.ship()
+    assert replicator.needsSync
+
+    replicator.transport.send = send
+    replicator.ship()
+    assert not replicator.needsSync
+    assert replicator.verify() == []
+
+
+def test_commands_run_while_a_sync_sends(stores, replicator):
+    graph, users, writeback = stores
+    send = replicator.transport.send
+    path = files(graph)[0]
+    written = []
+
+    def sendWhileWriting(batch):
+        # a command from another thread, it must not wait for the sync
+        thread = threading.Thread(
+            target=lambda: written.append(graph.writeFile(path, "written during the sync"))
+        )
+        thread.start()
+        thread.join(timeout=5)
+        assert not thread.is_alive()
+        return send(batch)
+
+    replicator.needsSync = True
+    replicator.transport.send = sendWhileWriting
+    replicator.ship()
+    replicator.transport.send = send
+
+    assert written == [True]
+    assert replicator.journal
+    replicator.ship()
+    assert replicator.verify() == []
+
+
+def test_standby_metadata_leaves_live_acls_alone(stores, replicator):
+    import graph as graphModule
+
+    graph, users, writeback = stores
+    users.setQuota("user0", 1000)
+    graph.changePermissions("3", files(graph)[0], users.users["user0"])
+    graph.save()
+    replicator.ship()
+
+    acls = {name: node.acl() for name, node in graph.nodes.items()}
+    principals = len(graphModule.principalNames)
+    replicator.transport.standby.stores.clear()
+    assert replicator.verify() == []
+
+    assert all(node.acl() is acls[name] for name, node in graph.nodes.items())
+    assert len(graphModule.principalNames) == principals
+    assert replicator.transport.standby.store("users").records["user0"]["quota"] == 1000
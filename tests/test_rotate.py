@@ -0,0 +1,93 @@
+import os
+
+import pytest
+from cryptography.fernet import Fernet
+
+import fileio
+import storage
+from encrypt import Encryptor
+from graph import Graph
+from rotate import RotationJob
+
+encryptor = Encryptor()
+
+
+@pytest.fixture
+def newKey(workspace):
+    "A new primary key, the workspace's key file is put back afterwards"
+    with open("fernet.key", "r") as f:
+        keys = f.read()
+
+    yield encryptor.addKey()
+
+    with open("fernet.key", "w") as f:
+        f.write(keys)
+    encryptor.loadKeys()
+
+
+def entries(backend: storage.Backend, parent: str = ""):
+    for name, isDir in backend.listdir(parent):
+        yield name, storage.join(parent, name), isDir
+        if isDir:
+            yield from entries(backend, storage.join(parent, name))
+
+
+def onKey(key: str, backend: storage.Backend) -> bool:
+    "Returns if every name and file of the tree is encrypted with the key"
+    fernet = Fernet(key)
+    for name, path, isDir in entries(backend):
+        fernet.decrypt(name.encode())
+        if not isDir and (data := backend.read(path)):
+            if fileio.rotateChunks(data) is not None:
+                return False
+    return True
+
+
+def test_rotation_moves_everything_to_the_new_key(stores, newKey):
+    graph, users, writeback = stores
+    path = next(name for name, node in graph.nodes.items() if name and not node.isFolder)
+    before = fileio.readFile(path)
+
+    job = RotationJob(writeback)
+    job.run()
+
+    assert job.state == "done"
+    assert job.progress()["rotated"] == job.total
+    assert onKey(newKey, fileio.backend)
+    assert not os.path.exists(job.checkpointPath)
+
+    # nothing needs the old key anymore
+    encryptor.retireKeys()
+    fileio.clearCaches()
+    assert fileio.readFile(path) == before
+    assert Graph("json/encrypted_permissions.json").nodes.keys() == graph.nodes.keys()
+
+
+def test_rotation_resumes_from_its_checkpoint(stores, newKey):
+    graph, users, writeback = stores
+
+    # a job stopped after the deepest level
+    interrupted = RotationJob(writeback)
+    levels = interrupted.collect()
+    deepest = max(levels)
+    for entry in levels[deepest]:
+        interrupted.rotateEntry(entry)
+    interrupted.saveCheckpoint(deepest)
+
+    job = RotationJob(writeback)
+    job.run()
+
+    assert job.state == "done"
+    assert job.skipped == len(levels[deepest])
+    assert job.done == job.total
+    assert onKey(newKey, fileio.backend)
+
+
+def test_checkpoint_of_another_key_is_ignored(stores, newKey):
+    graph, users, writeback = stores
+    job = RotationJob(writeback)
+    job.saveCheckpoint(3)
+    assert job.loadCheckpoint() == 3
+
+    encryptor.addKey()
+    assert job.loadCheckpoint() is None
@@ -0,0 +1,91 @@
+import os
+import time
+
+import fileio
+import graph as graphModule
+import storage
+from snapshot import Snapshots
+
+
+def tree(backend: storage.Backend, path: str = "") -> dict:
+    "Every blob of a backend with its contents"
+    out = {}
+    for name, isDir in backend.listdir(path):
+        child = storage.join(path, name)
+        out.update(tree(backend, child) if isDir else {child: backend.read(child)})
+
+    return out
+
+
+def test_interrupted_restore_is_rolled_back_and_finished(workspace):
+    backend = storage.LocalBackend("files/")
+    backend.mkdir("dir")
+    backend.write("dir/blob", b"snapshotted")
+    backend.createSnapshot("s1")
+    snapshotted = tree(backend)
+
+    backend.write("dir/blob", b"changed")
+    backend.write("dir/new", b"new")
+
+    # crashed between moving the tree away and moving the restored one in
+    storage.linkTree(backend.snapshotRoot("s1"), "files.restoring")
+    os.rename("files", "files.old")
+
+    backend.restoreSnapshot("s1")
+
+    assert tree(backend) == snapshotted
+    assert not os.path.exists("files.old")
+    assert not os.path.exists("files.restoring")
+
+
+def test_restore_keeps_later_revocations(stores):
+    graph, users, writeback = stores
+    path = next(name for name, node in graph.nodes.items() if name and not node.isFolder)
+    before = fileio.readFile(path)
+
+    snapshots = Snapshots(graph, users, writeback, path="snapshots")
+    snapshots.create("s1")
+
+    graph.writeFile(path, "after the snapshot")
+    users.users["user0"].revokeSession("token", time.time() + 3600)
+    users.markChanged("user0")
+    users.save()
+
+    snapshots.restore("s1")
+
+    assert fileio.readFile(path) == before
+    assert users.users["user0"].isRevoked("token")
+    assert [m["name"] for m in snapshots.list()][0] == "s1"
+
+
+def test_browsing_leaves_live_acls_alone(stores):
+    graph, users, writeback = stores
+    snapshots = Snapshots(graph, users, writeback, path="snapshots")
+    snapshots.create("s1")
+    acls = {name: node.acl() for name, node in graph.nodes.items()}
+    principals = len(graphModule.principalNames)
+
+    view = snapshots.open("s1")
+    for user in users.users.values():
+        for name, node in graph.nodes.items():
+            assert view.isReadable(name, user) == node.isReadable(user)
+
+    assert all(node.acl() is acls[name] for name, node in graph.nodes.items())
+    assert len(graphModule.principalNames) == principals
+
+
+def test_restore_after_one_interrupted_before_cleanup(workspace):
+    backend = storage.LocalBackend("files/")
+    backend.write("blob", b"snapshotted")
+    backend.createSnapshot("s1")
+    snapshotted = tree(backend)
+
+    # crashed after both renames, before the old tree was removed
+    os.rename("files", "files.old")
+    storage.linkTree(backend.snapshotRoot("s1"), "files")
+    backend.write("blob", b"changed")
+
+    backend.restoreSnapshot("s1")
+
+    assert tree(backend) == snapshotted
+    assert not os.path.exists("files.old")
@@ -0,0 +1,33 @@
+import re
+
+from stats import Stats
+
+SAMPLE = re.compile(r'([a-zA-Z_:][a-zA-Z0-9_:]*)(\{[a-zA-Z_][a-zA-Z0-9_]*="[^"]*"(,[a-zA-Z_][a-zA-Z0-9_]*="[^"]*")*\})? \S+')
+TYPE = re.compile(r"# TYPE ([a-zA-Z_:][a-zA-Z0-9_:]*) (counter|histogram)")
+
+
+def test_prometheus_output_parses():
+    stats = Stats()
+    stats.incr("fileio.nameCache.hit", 3)
+    stats.incr("replica.bytes", 10)
+    stats.incr("writes")
+    stats.observe("cmd.ls", 0.002)
+
+    lines = stats.prometheus().strip().split("\n")
+
+    for line in lines:
+        assert (TYPE if line.startswith("#") else SAMPLE).fullmatch(line), line
+
+    assert "sfs_fileio_nameCache_hit_total 3" in lines
+    assert "sfs_writes_total 1" in lines
+    assert 'sfs_latency_seconds_count{name="cmd.ls"} 1' in lines
+
+
+def test_timer_counts_and_report():
+    stats = Stats()
+    with stats.timer("op"):
+        pass
+    stats.incr("op.calls")
+
+    assert stats.histograms["op"].count == 1
+    assert any(line.startswith("op.calls") for line in stats.report())
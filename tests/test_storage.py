@@ -0,0 +1,105 @@
+import os
+
+import pytest
+
+from storage import LocalBackend, MemoryBackend, StripedBackend
+
+
+@pytest.fixture(params=["local", "memory", "striped"])
+def backend(request, tmp_path):
+    if request.param == "local":
+        os.mkdir(tmp_path / "files")
+        return LocalBackend(str(tmp_path / "files"))
+    if request.param == "memory":
+        return MemoryBackend()
+    return StripedBackend([str(tmp_path / f"root{i}") for i in range(3)], stripeSize=16)
+
+
+def test_blobs_and_directories(backend):
+    backend.mkdir("dir")
+    backend.write("dir/blob", b"contents")
+    backend.write("top", b"")
+
+    assert sorted(backend.listdir("")) == [("dir", True), ("top", False)]
+    assert backend.listdir("dir") == [("blob", False)]
+    assert backend.isdir("dir") and not backend.isdir("dir/blob")
+    assert backend.read("dir/blob") == b"contents"
+    assert backend.read("top") == b""
+    assert backend.stat("dir/blob").size == len(b"contents")
+    with backend.map("dir/blob") as buffer:
+        assert bytes(buffer[:4]) == b"cont"
+
+    backend.write("dir/blob", b"replaced")
+    assert backend.read("dir/blob") == b"replaced"
+
+    with pytest.raises(OSError):
+        backend.rmdir("dir")
+
+    backend.remove("dir/blob")
+    backend.rmdir("dir")
+    assert backend.listdir("") == [("top", False)]
+    with pytest.raises(FileNotFoundError):
+        backend.read("dir/blob")
+
+
+def test_rename_moves_everything_below(backend):
+    backend.mkdir("a")
+    backend.mkdir("a/b")
+    data = bytes(range(256)) * 3
+    backend.write("a/b/blob", data)
+
+    backend.rename("a", "c")
+
+    assert backend.read("c/b/blob") == data
+    assert not backend.isdir("a")
+    with pytest.raises(FileNotFoundError):
+        backend.read("a/b/blob")
+
+
+def test_snapshot_keeps_the_contents_it_was_taken_with(backend):
+    backend.write("blob", b"before")
+    backend.createSnapshot("s1")
+    backend.write("blob", b"after")
+    backend.write("new", b"new")
+
+    snapshot = backend.openSnapshot("s1")
+    assert snapshot.read("blob") == b"before"
+    assert [name for name, _ in snapshot.listdir("")] == ["blob"]
+
+    backend.restoreSnapshot("s1")
+    assert backend.read("blob") == b"before"
+    assert [name for name, _ in backend.listdir("")] == ["blob"]
+
+    backend.removeSnapshot("s1")
+    with pytest.raises(FileNotFoundError):
+        backend.openSnapshot("s1")
+
+
+def test_striped_blobs_of_every_size_are_reassembled(tmp_path):
+    backend = StripedBackend([str(tmp_path / f"root{i}") for i in range(3)], stripeSize=4)
+
+    for size in range(30):
+        data = bytes(range(size))
+        backend.write(f"blob{size}", data)
+        assert backend.read(f"blob{size}") == data
+        assert backend.stat(f"blob{size}").size == size
+
+
+def test_small_striped_blobs_are_spread_over_the_roots(tmp_path):
+    roots = [str(tmp_path / f"root{i}") for i in range(4)]
+    backend = StripedBackend(roots, stripeSize=1024)
+
+    for i in range(40):
+        backend.write(f"blob{i}", b"small")
+
+    used = [
+        sum(os.path.getsize(os.path.join(root, name)) > 1 for name in os.listdir(root))
+        for root in roots
+    ]
+    assert sum(used) == 40
+    assert all(used)
+
+
+def test_single_striped_root_is_a_local_tree(tmp_path):
+    StripedBackend([str(tmp_path / "root")], stripeSize=4).write("blob", b"contents")
+    assert LocalBackend(str(tmp_path / "root")).read("blob") == b"contents"
@@ -0,0 +1,45 @@
+from encrypt import Encryptor
+from graph import Graph
+
+encryptor = Encryptor()
+
+
+def rollups(graph: Graph) -> dict[str, tuple[int, int, int]]:
+    return {name: (node.size, node.encryptedSize, node.files) for name, node in graph.nodes.items()}
+
+
+def test_rollups_follow_writes_creates_and_removes(stores):
+    graph, users, writeback = stores
+    owner = users.users["user0"]
+    before = graph.nodes[""].size
+
+    graph.writeFile("user0/dir0/file0.txt", "x" * 1000)
+    graph.createFolder("user0/dir0/sub", owner)
+    graph.createFile("user0/dir0/sub/new.txt", owner)
+    graph.writeFile("user0/dir0/sub/new.txt", "hello")
+    graph.removeNode("user0/dir1/file1.txt")
+
+    for name in ["user0/dir0/sub", "user0/dir0", "user0", ""]:
+        assert graph.nodes[name].size >= 5
+    assert graph.nodes["user0/dir0/sub"].files == 1
+    assert graph.nodes[""].files == sum(not node.isFolder for node in graph.nodes.values())
+    assert graph.nodes[""].size == sum(n.size for n in graph.nodes.values() if not n.isFolder)
+    assert graph.nodes[""].size != before
+
+    # what was kept up to date matches a rescan of the disk
+    kept = rollups(graph)
+    graph.rebuildUsage()
+    assert rollups(graph) == kept
+
+
+def test_rollups_are_built_for_permissions_without_them(workspace):
+    graph = Graph("json/encrypted_permissions.json")
+    expected = rollups(graph)
+
+    records = encryptor.decryptJson("json/encrypted_permissions.json")
+    for record in records:
+        del record["usage"]
+    encryptor.encryptJson(records, "json/encrypted_permissions.json")
+
+    assert rollups(Graph("json/encrypted_permissions.json")) == expected
+    assert all("usage" in r for r in encryptor.decryptJson("json/encrypted_permissions.json"))
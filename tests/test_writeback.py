@@ -0,0 +1,68 @@
+import os
+
+from graph import Graph
+from user import Users
+from writeback import WriteBack
+
+
+def anyFile(graph: Graph) -> str:
+    return next(name for name, node in graph.nodes.items() if name and not node.isFolder)
+
+
+def reopen() -> tuple[Graph, Users, WriteBack]:
+    "Loads the stores from disk the way a restarted process does"
+    graph = Graph("json/encrypted_permissions.json")
+    users = Users("json/encrypted_users.json")
+    return graph, users, WriteBack({"graph": graph, "users": users})
+
+
+def test_recover_replays_uncommitted_changes(stores):
+    graph, users, writeback = stores
+    path = anyFile(graph)
+    graph.writeFile(path, "written before the crash")
+    users.setQuota("user0", 1000)
+    users.setGroupQuota("group0", 5000)
+
+    # nothing was committed, the dumps on disk are stale
+    graph, users, writeback = reopen()
+    assert graph.nodes[path].size != len("written before the crash")
+    assert users.users["user0"].quota is None
+
+    assert writeback.recover() > 0
+    assert graph.nodes[path].size == len("written before the crash")
+    assert users.users["user0"].quota == 1000
+    assert users.groupQuotas == {"group0": 5000}
+    assert not os.path.exists(writeback.logPath)
+
+    # recovery committed, a second restart has nothing to replay
+    graph, users, writeback = reopen()
+    assert users.users["user0"].quota == 1000
+    assert writeback.recover() == 0
+
+
+def test_recover_stops_at_a_torn_record(stores):
+    graph, users, writeback = stores
+    users.setQuota("user0", 1000)
+    users.setQuota("user1", 2000)
+    writeback._log.close()
+    writeback._log = None
+
+    with open(writeback.logPath, "rb+") as f:
+        f.truncate(os.path.getsize(writeback.logPath) - 10)
+
+    graph, users, writeback = reopen()
+    assert writeback.recover() == 1
+    assert users.users["user0"].quota == 1000
+    assert users.users["user1"].quota is None
+
+
+def test_empty_save_logs_and_dumps_nothing(stores):
+    graph, users, writeback = stores
+    mtime = os.stat(graph.jsonPath).st_mtime_ns
+
+    graph.save()
+    users.save()
+
+    assert not os.path.exists(writeback.logPath)
+    assert not writeback.dirty
+    assert os.stat(graph.jsonPath).st_mtime_ns == mtime
@@ -1,15 +1,62 @@
 import json
+import os
+import sys
+import time
+from typing import Optional
+
+import bcrypt
 
 from encrypt import Encryptor
+from stats import stats
 
 encryptor = Encryptor()
 
+# bcrypt cost for new hashes, older hashes are upgraded on the next login
+BCRYPT_ROUNDS = int(os.environ.get("SFS_BCRYPT_ROUNDS", 12))
+# Redo log key prefix of group quota records, no home directory has such a name
+GROUP_QUOTA_KEY = "/groups/"
+
+
+def hashPassword(password: str) -> str:
+    with stats.timer("bcrypt.hashpw"):
+        return bcrypt.hashpw(password.encode(), bcrypt.gensalt(BCRYPT_ROUNDS)).decode()
+
+
+def hashRounds(hashedPass: str) -> int:
+    "Returns the cost factor of a $2b$<rounds>$... hash"
+    return int(hashedPass.split("$")[2])
+
+
 class User:
-    def __init__(self, name: str, password: str, joinedGroups=[]) -> None:
-        self.name: str = name
+    __slots__ = (
+        "name",
+        "password",
+        "joinedGroups",
+        "isAdmin",
+        "revokedSessions",
+        "quota",
+        "used",
+    )
+
+    def __init__(
+        self,
+        name: str,
+        password: str,
+        joinedGroups=(),
+        revokedSessions=(),
+        quota: Optional[int] = None,
+    ) -> None:
+        self.name: str = sys.intern(name)
         self.password: str = password
-        self.joinedGroups: list[str] = joinedGroups
+        self.joinedGroups: tuple[str, ...] = tuple(sys.intern(g) for g in joinedGroups)
         self.isAdmin: bool = name == "admin"
+        # (session id, expiry) of revoked tokens that haven't expired yet
+        self.revokedSessions: tuple[tuple[str, float], ...] = tuple(
+            (id, expires) for id, expires in revokedSessions
+        )
+        self.quota = quota  # bytes, None for no limit
+        # bytes of the files the user owns, derived from the graph rollups
+        self.used = 0
 
     def __repr__(self) -> str:
         return f"User(name={self.name}, password={self.password}, joinedGroups={self.joinedGroups})"
@@ -17,30 +64,110 @@ class User:
     def dump(self) -> dict:
         "Dumps user to a file, should be called on exit"
 
-        return {
+        out = {
             "name": self.name,
             "password": self.password,
-            "joinedGroups": self.joinedGroups,
+            "joinedGroups": list(self.joinedGroups),
         }
 
+        if self.revokedSessions:
+            out["revokedSessions"] = [list(session) for session in self.revokedSessions]
+        if self.quota is not None:
+            out["quota"] = self.quota
+
+        return out
+
+    def joinGroup(self, groupName: str):
+        if groupName not in self.joinedGroups:
+            self.joinedGroups += (sys.intern(groupName),)
+
+    def leaveGroup(self, groupName: str):
+        self.joinedGroups = tuple(g for g in self.joinedGroups if g != groupName)
+
+    def revokeSession(self, id: str, expires: float):
+        "Revokes a session token, expired revocations are dropped on the way"
+        now = time.time()
+        self.revokedSessions = tuple(
+            session for session in self.revokedSessions if session[1] > now
+        ) + ((id, expires),)
+
+    def isRevoked(self, id: str) -> bool:
+        return any(session[0] == id for session in self.revokedSessions)
+
 
 class Users:
     def __init__(self, jsonPath: str) -> None:
         self.jsonPath = jsonPath
         self.isEncrypted = encryptor.isEncrypted(jsonPath)
+        self.writeback = None  # set by WriteBack, saves are then logged and batched
+        self.changed: set[str] = set()
+        self.groupsChanged: set[str] = set()
+
+        self.load()
 
-        with open(jsonPath, "r") as f:
+    def load(self):
+        "Reads the users from jsonPath, replacing the ones in memory"
+        with open(self.jsonPath, "r") as f:
             if self.isEncrypted:
-                users = encryptor.decryptJson(jsonPath)
+                data = encryptor.decryptJson(self.jsonPath)
             else:
-                users = json.load(f)
+                data = json.load(f)
+
+        # a plain list of users unless group quotas were set
+        if isinstance(data, dict):
+            users = data["users"]
+            self.groupQuotas: dict[str, int] = data.get("groupQuotas", {})
+        else:
+            users = data
+            self.groupQuotas = {}
+
+        self.users = {user["name"]: User(**user) for user in users}
+        self.changed.clear()
+        self.groupsChanged.clear()
 
-            self.users = {user["name"]: User(**user) for user in users}
+    def save(self):
+        "Persists changes, through the write-back layer if there is one"
+        if self.writeback is not None:
+            self.writeback.saved(self)
+        else:
+            self.dump()
+
+    def markChanged(self, *names: str):
+        "Records which entries a save() has to persist"
+        self.changed.update(names)
+
+    def takeChanges(self) -> list[tuple[str, Optional[dict]]]:
+        "Returns the changed entries, None for removed ones, for the redo log"
+        changes = [
+            (name, entry.dump() if (entry := self.users.get(name)) else None)
+            for name in self.changed
+        ] + [
+            (GROUP_QUOTA_KEY + group, {"quota": self.groupQuotas.get(group)})
+            for group in self.groupsChanged
+        ]
+        self.changed.clear()
+        self.groupsChanged.clear()
+        return changes
+
+    def applyChange(self, name: str, value: Optional[dict]):
+        "Applies a redo log record"
+        if name.startswith(GROUP_QUOTA_KEY):
+            self.setGroupQuotaValue(name[len(GROUP_QUOTA_KEY) :], value["quota"])
+        elif value is None:
+            self.users.pop(name, None)
+        else:
+            self.users[name] = User(**value)
 
+    def afterReplay(self):
+        pass
+
+    @stats.timed("users.dump")
     def dump(self):
         "Dumps users to a file, should be called on exit"
 
         data = [user.dump() for user in self.users.values()]
+        if self.groupQuotas:
+            data = {"users": data, "groupQuotas": self.groupQuotas}
 
         if self.isEncrypted:
             encryptor.encryptJson(data, self.jsonPath)
@@ -48,6 +175,79 @@ class Users:
             with open(self.jsonPath, "w") as f:
                 json.dump(data, f, indent=2)
 
+        self.changed.clear()
+        self.groupsChanged.clear()
+
+    def setUsage(self, usage: dict[str, int]):
+        "Sets every user's usage from the bytes owned per user"
+        for name, user in self.users.items():
+            user.used = usage.get(name, 0)
+
+    def groupUsage(self, groupName: str) -> int:
+        "Bytes owned by the members of a group"
+        return sum(
+            user.used for user in self.users.values() if groupName in user.joinedGroups
+        )
+
+    def allows(self, name: str, delta: int) -> bool:
+        """Returns if a user may grow the bytes they own by delta, without
+        exceeding their quota or the quota of one of their groups
+        """
+
+        if delta <= 0 or (user := self.users.get(name)) is None:
+            return True
+
+        if user.quota is not None and user.used + delta > user.quota:
+            print(f"Quota exceeded for {name}")
+            return False
+
+        for group in user.joinedGroups:
+            quota = self.groupQuotas.get(group)
+            if quota is not None and self.groupUsage(group) + delta > quota:
+                print(f"Quota exceeded for group {group}")
+                return False
+
+        return True
+
+    def charge(self, name: str, delta: int):
+        "Accounts a change in the bytes a user owns"
+        if (user := self.users.get(name)) is not None:
+            user.used += delta
+
+    def setQuota(self, name: str, quota: Optional[int]):
+        self.users[name].quota = quota
+        self.markChanged(name)
+        self.save()
+
+    def setGroupQuotaValue(self, groupName: str, quota: Optional[int]):
+        if quota is None:
+            self.groupQuotas.pop(groupName, None)
+        else:
+            self.groupQuotas[groupName] = quota
+
+    def setGroupQuota(self, groupName: str, quota: Optional[int]):
+        self.setGroupQuotaValue(groupName, quota)
+        self.groupsChanged.add(groupName)
+        self.save()
+
+    def checkPassword(self, name: str, password: str) -> bool:
+        """Verifies a password, rehashing it if its bcrypt cost is below the
+        configured one, never lowering it. The user must exist
+        """
+
+        user = self.users[name]
+
+        with stats.timer("bcrypt.checkpw"):
+            if not bcrypt.checkpw(password.encode(), user.password.encode()):
+                return False
+
+        if hashRounds(user.password) < BCRYPT_ROUNDS:
+            user.password = hashPassword(password)
+            self.markChanged(name)
+            self.save()
+
+        return True
+
     def getUsersInGroup(self, groupName: str):
         return [
             name for name, user in self.users.items() if groupName in user.joinedGroups
@@ -64,12 +264,13 @@ class Users:
                 print("No valid users provided, group creation failed")
                 return False
             else:
-                self.users[user].joinedGroups.append(groupName)
+                self.users[user].joinGroup(groupName)
+                self.markChanged(user)
                 users_added = True
 
             print(f"Added {user} to {groupName}")
 
-        self.dump()
+        self.save()
 
         return True
 
@@ -87,17 +288,19 @@ class Users:
                 print(f"User {user} is an admin and cannot be removed from {groupName}")
                 continue
 
-            self.users[user].joinedGroups.remove(groupName)
+            self.users[user].leaveGroup(groupName)
+            self.markChanged(user)
             print(f"Removed {user} from {groupName}")
 
-        self.dump()
+        self.save()
 
     def createUser(self, name: str, password: str):
         self.users[name] = User(name, password)
+        self.markChanged(name)
 
         print(f"User {name} created")
 
-        self.dump()
+        self.save()
 
 
 if __name__ == "__main__":
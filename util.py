@@ -9,3 +9,30 @@ def tryParse(
         return parser.parse_args(line.split())
     except SystemExit:
         return None
+
+
+UNITS = {"": 1, "K": 1024, "M": 1024**2, "G": 1024**3}
+
+
+def parseSize(text: str) -> Optional[int]:
+    """Parses a byte count like 512, 10K, 5M or 1G, none for no limit.
+    Raises ValueError if it can't be parsed
+    """
+
+    if text.lower() == "none":
+        return None
+
+    text = text.upper().removesuffix("B")
+    unit = text[-1] if text and text[-1] in UNITS else ""
+
+    return int(float(text[: len(text) - len(unit)]) * UNITS[unit])
+
+
+def formatSize(size: int) -> str:
+    "Human readable byte count"
+    for unit in ["B", "KB", "MB", "GB"]:
+        if abs(size) < 1024 or unit == "GB":
+            break
+        size /= 1024
+
+    return f"{size:.1f} {unit}" if unit != "B" else f"{size} B"
@@ -0,0 +1,194 @@
+import json
+import os
+import threading
+import time
+from typing import Optional
+
+from cryptography.fernet import InvalidToken
+
+from encrypt import Encryptor
+import fileio
+from stats import stats
+
+encryptor = Encryptor()
+
+REDO_PATH = "json/redo.log"
+COMMIT_WINDOW = float(os.environ.get("SFS_COMMIT_WINDOW", 1.0))
+COMMIT_OPS = int(os.environ.get("SFS_COMMIT_OPS", 32))
+
+
+class WriteBack:
+    """Coalesces metadata dumps and file fsyncs into group commits.
+
+    Stores (Graph, Users) report their changed records on save(). Those are
+    appended to an encrypted redo log, which is all a command waits for.
+    The full encrypted dumps happen once the window expires or maxOps saves
+    piled up, on sync() and on exit. A crash before that is recovered by
+    replaying the redo log on the next start.
+
+    Commands hold `lock` while they run, so the background commit only ever
+    sees metadata between commands.
+    """
+
+    def __init__(
+        self,
+        stores: dict,
+        logPath: str = REDO_PATH,
+        window: float = COMMIT_WINDOW,
+        maxOps: int = COMMIT_OPS,
+    ) -> None:
+        self.stores = stores
+        self.logPath = logPath
+        self.window = window  # seconds, 0 disables the timed commit
+        self.maxOps = maxOps  # saves per commit, 0 for no limit
+        self.syncLog = True  # fsync the redo log on every save
+
+        # called with (store name, records) after every save that changed
+        # something, records is None when the store was dumped as a whole
+        self.listeners: list = []
+
+        self.lock = threading.RLock()
+        self.dirty: set[str] = set()
+        self.pendingFiles: set[str] = set()
+        self.ops = 0
+        self.dirtySince: Optional[float] = None
+
+        self._log = None
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+        for store in stores.values():
+            store.writeback = self
+
+    def __repr__(self) -> str:
+        return f"WriteBack(dirty={sorted(self.dirty)}, ops={self.ops})"
+
+    def storeName(self, store) -> str:
+        return next(name for name, s in self.stores.items() if s is store)
+
+    def saved(self, store):
+        "Logs a store's changes, committing if the batch is full"
+        with self.lock:
+            name = self.storeName(store)
+            if (records := store.takeChanges()) == []:
+                # nothing changed, nothing to log or dump
+                return
+
+            if records is None:
+                # the store can't describe its change, write it out now
+                store.dump()
+                self.notify(name, records)
+                return
+
+            if self._log is None:
+                self._log = open(self.logPath, "ab")
+
+            for key, value in records:
+                record = {"store": name, "key": key, "value": value}
+                self._log.write(encryptor.encrypt(json.dumps(record).encode()) + b"\n")
+
+            self._log.flush()
+            if self.syncLog:
+                os.fsync(self._log.fileno())
+
+            self.notify(name, records)
+
+            self.dirty.add(name)
+            self.ops += 1
+            self.dirtySince = self.dirtySince or time.monotonic()
+
+            if self.maxOps and self.ops >= self.maxOps:
+                self.commit()
+
+    def dumpStore(self, store):
+        "Writes a store out whole, for changes too broad for the redo log"
+        with self.lock:
+            self.commit()
+            store.dump()
+            self.notify(self.storeName(store), None)
+
+    def notify(self, name: str, records: Optional[list]):
+        for listener in self.listeners:
+            listener(name, records)
+
+    def fileWritten(self, path: str):
+        "Defers the fsync of a written content file to the next commit"
+        with self.lock:
+            self.pendingFiles.add(path)
+            self.dirtySince = self.dirtySince or time.monotonic()
+
+    @stats.timed("writeback.commit")
+    def commit(self):
+        "Writes out every dirty store and fsyncs pending files"
+        with self.lock:
+            fileio.backend.sync(list(self.pendingFiles))
+
+            for name in sorted(self.dirty):
+                self.stores[name].dump()
+
+            if self._log is not None:
+                self._log.close()
+                self._log = None
+
+            if self.dirty and os.path.exists(self.logPath):
+                with open(self.logPath, "wb") as f:
+                    os.fsync(f.fileno())
+
+            self.dirty.clear()
+            self.pendingFiles.clear()
+            self.ops = 0
+            self.dirtySince = None
+
+    def recover(self) -> int:
+        "Replays the redo log of a previous run, returns the number of records"
+        with self.lock:
+            try:
+                with open(self.logPath, "rb") as f:
+                    lines = f.read().splitlines()
+            except FileNotFoundError:
+                return 0
+
+            applied = 0
+            for line in lines:
+                try:
+                    record = json.loads(encryptor.decrypt(line))
+                except (InvalidToken, ValueError):
+                    # torn write of the last record before a crash
+                    break
+
+                self.stores[record["store"]].applyChange(record["key"], record["value"])
+                self.dirty.add(record["store"])
+                applied += 1
+
+            for store in self.stores.values():
+                store.afterReplay()
+
+            self.commit()
+            if os.path.exists(self.logPath):
+                os.remove(self.logPath)
+
+            return applied
+
+    def start(self):
+        "Commits in the background once the window expires"
+        if self._thread is None:
+            self._thread = threading.Thread(target=self.run, daemon=True)
+            self._thread.start()
+
+    def run(self):
+        while not self._stop.wait(min(self.window or 1.0, 1.0) / 2):
+            if (
+                self.window
+                and self.dirtySince is not None
+                and time.monotonic() - self.dirtySince >= self.window
+            ):
+                self.commit()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            # bounded, a signal may arrive while this thread holds the lock
+            self._thread.join(timeout=1)
+            self._thread = None
+
+        self.commit()